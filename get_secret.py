@@ -1,40 +1,199 @@
 #!/usr/bin/python3
 
-import sys, getopt
-from azure.keyvault.secrets import SecretClient
-from azure.identity import DefaultAzureCredential
+import os, sys, getopt, json, time, shlex, asyncio
+
+# Default values
+# Secrets are cached in a file only readable by the user, and fetched again from Azure Key Vault after the TTL
+# The cache does not check Key Vault for new versions: until the TTL is over, a secret that is rotated is still served
+# with its previous value, unless a version is pinned (name/version) or --refresh is used
+default_cache_file = os.path.join(os.path.expanduser('~'), '.cache', 'get_secret.json')
+default_ttl = 3600
+
+# Returns the URL of an Azure Key Vault from its name
+def get_vault_url(akv_name):
+    return f"https://{akv_name}.vault.azure.net"
+
+# Returns the cached secrets ({vault: {secret: entry}}), or an empty cache if the file does not exist or is not valid
+def load_cache(cache_file):
+    try:
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+        return cache if isinstance(cache, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+# Saves the cached secrets atomically, in a file (and directory) only accessible by the user
+def save_cache(cache_file, cache):
+    cache_dir = os.path.dirname(cache_file)
+    if cache_dir:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    temp_file = f'{cache_file}.{os.getpid()}.tmp'
+    fd = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    saved = False
+    try:
+        # The mode of os.open is masked by the umask, and an old temp file could have other permissions
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cache, f)
+        os.replace(temp_file, cache_file)
+        saved = True
+    finally:
+        if not saved:
+            os.remove(temp_file)
+
+# Splits a secret name in the form name or name/version
+def parse_secret_name(secret_name):
+    name, _, version = secret_name.partition('/')
+    return name, version or None
+
+# Returns whether a cached secret can be used: a specific version is used until the secret expires (versions cannot
+# change), and the latest version until the TTL of the cache is over, even if a newer version was created since
+def is_cache_entry_valid(entry, version, ttl, now):
+    if not isinstance(entry, dict) or 'value' not in entry:
+        return False
+    if entry.get('expires_on') is not None and entry['expires_on'] <= now:
+        return False
+    if version is not None:
+        return entry.get('version') == version
+    return entry.get('fetched_on', 0) + ttl > now
+
+# Fetches secrets from Azure Key Vault concurrently, with a single credential and client for all of them
+# Returns the secret or the exception raised for each (name, version) pair, in the same order
+async def fetch_secrets(vault_url, secret_versions):
+    from azure.identity.aio import DefaultAzureCredential
+    from azure.keyvault.secrets.aio import SecretClient
+    async with DefaultAzureCredential() as credential:
+        async with SecretClient(vault_url=vault_url, credential=credential) as client:
+            return await asyncio.gather(*[client.get_secret(name, version=version) for name, version in secret_versions], return_exceptions=True)
+
+# Returns a dictionary with the values of secrets of an Azure Key Vault (names in the form name or name/version),
+# from the cache if possible, fetching the others concurrently. If a secret cannot be fetched its cached value is
+# returned even if it is older than the TTL, and if there is none it is missing from the dictionary.
+def get_secrets(akv_name, secret_names, cache_file=default_cache_file, ttl=default_ttl, refresh=False, verbose=False):
+    now = time.time()
+    cache = load_cache(cache_file) if cache_file else {}
+    vault_cache = cache.setdefault(akv_name, {})
+    secrets = {}
+    to_fetch = []
+    for secret_name in secret_names:
+        name, version = parse_secret_name(secret_name)
+        entry = vault_cache.get(secret_name)
+        if not refresh and is_cache_entry_valid(entry, version, ttl, now):
+            secrets[secret_name] = entry['value']
+            if verbose:
+                print(f'DEBUG: secret {secret_name} found in cache {cache_file}')
+        elif (name, version) not in to_fetch:
+            to_fetch.append((name, version))
+    if len(to_fetch) == 0:
+        return secrets
+    if verbose:
+        print(f'DEBUG: getting {len(to_fetch)} secrets from Azure Key Vault {akv_name}')
+    try:
+        results = asyncio.run(fetch_secrets(get_vault_url(akv_name), to_fetch))
+    except Exception as e:
+        results = [e] * len(to_fetch)
+    for (name, version), result in zip(to_fetch, results):
+        secret_name = name if version is None else f'{name}/{version}'
+        if isinstance(result, Exception):
+            entry = vault_cache.get(secret_name)
+            if isinstance(entry, dict) and 'value' in entry:
+                print(f'WARNING: could not get secret {secret_name} from Azure Key Vault {akv_name}, using the cached value: {str(result)}')
+                secrets[secret_name] = entry['value']
+            else:
+                print(f'ERROR: could not get secret {secret_name} from Azure Key Vault {akv_name}: {str(result)}')
+            continue
+        expires_on = result.properties.expires_on
+        vault_cache[secret_name] = {
+            'value': result.value,
+            'version': result.properties.version,
+            'fetched_on': now,
+            'expires_on': expires_on.timestamp() if expires_on is not None else None
+        }
+        secrets[secret_name] = result.value
+    if cache_file:
+        try:
+            save_cache(cache_file, cache)
+        except OSError as e:
+            print(f'WARNING: could not save secrets cache {cache_file}: {str(e)}')
+    return secrets
+
+# Returns the value of one secret of an Azure Key Vault, or None if it cannot be fetched
+def get_secret(akv_name, secret_name, cache_file=default_cache_file, ttl=default_ttl, refresh=False):
+    return get_secrets(akv_name, [secret_name], cache_file=cache_file, ttl=ttl, refresh=refresh).get(secret_name)
+
+# Returns the name of the environment variable for a secret name (e.g. bgp-logws-id -> BGP_LOGWS_ID)
+def get_env_name(secret_name):
+    name = parse_secret_name(secret_name)[0]
+    return ''.join(c if c.isalnum() else '_' for c in name).upper()
+
+# Writes the secrets as NAME='value' lines, which can be sourced by a shell or used as a systemd EnvironmentFile
+# The file is only readable by the user
+def write_env_file(env_file, secrets):
+    lines = ''.join(f'{get_env_name(secret_name)}={shlex.quote(value)}\n' for secret_name, value in secrets.items())
+    fd = os.open(env_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(lines)
 
 def main(argv):
     # Get arguments
     akv_name = None
-    secret_name = None
+    secret_names = []
+    cache_file = default_cache_file
+    ttl = default_ttl
+    refresh = False
+    env_file = None
+    verbose = False
+    usage = ('Options: -v <azure_key_vault_name> -s <secret_name>[/<version>] [-s <secret_name> ...] [--ttl <seconds>] [--cache-file <file>] [--no-cache] [--refresh] [--env-file <file>] [--verbose]\n'
+             f'Secrets without a version are cached for --ttl seconds (default {default_ttl}): a rotated secret is served with its previous value until then, unless --refresh is used')
     try:
-        opts, args = getopt.getopt(argv,"hv:s:",["help", "vault-name=", "secret-name="])
+        opts, args = getopt.getopt(argv,"hv:s:e:",["help", "vault-name=", "secret-name=", "ttl=", "cache-file=", "no-cache", "refresh", "env-file=", "verbose"])
     except getopt.GetoptError:
-        print ('Options: -v <azure_key_vault_name> -s <secret_name>')
+        print (usage)
         sys.exit(2)
     for opt, arg in opts:
-        if opt == '-h':
-            print ('Options: -v <azure_key_vault_name> -s <secret_name>')
+        if opt in ('-h', '--help'):
+            print (usage)
             sys.exit()
         elif opt in ("-v", "--vault-name"):
             akv_name = arg
         elif opt in ("-s", "--secret-name"):
-            secret_name = arg
+            # Several secrets can be given with several -s options, or separated by commas
+            secret_names += [name for name in arg.split(',') if name]
+        elif opt == "--ttl":
+            ttl = int(arg)
+        elif opt == "--cache-file":
+            cache_file = arg
+        elif opt == "--no-cache":
+            cache_file = None
+        elif opt == "--refresh":
+            refresh = True
+        elif opt in ("-e", "--env-file"):
+            env_file = arg
+        elif opt == "--verbose":
+            verbose = True
     # Print vault name
-    if (akv_name == None) or (secret_name == None):
-        print ('Options: -v <azure_key_vault_name> -s <secret_name>')
+    if (akv_name == None) or (len(secret_names) == 0):
+        print (usage)
         sys.exit()
     else:
-        print ('Getting secret', secret_name, 'from Azure Key Vault', akv_name)
-    # Get secret
-    akv_uri = f"https://{akv_name}.vault.azure.net"
-    credential = DefaultAzureCredential()
-    client = SecretClient(vault_url=akv_uri, credential=credential)
-    secret_value = client.get_secret(secret_name)
-
-    # Debug: print secret
-    print('Secret value:', secret_value.value)
+        print ('Getting secret', ', '.join(secret_names), 'from Azure Key Vault', akv_name)
+    # Get secrets
+    secrets = get_secrets(akv_name, secret_names, cache_file=cache_file, ttl=ttl, refresh=refresh, verbose=verbose)
+
+    if env_file is not None:
+        write_env_file(env_file, secrets)
+        print(f'INFO: {len(secrets)} secrets written to {env_file}')
+    else:
+        # Debug: print secrets
+        for secret_name in secret_names:
+            if secret_name in secrets:
+                if len(secret_names) == 1:
+                    print('Secret value:', secrets[secret_name])
+                else:
+                    print(f'Secret {secret_name} value:', secrets[secret_name])
+    if len(secrets) < len(set(secret_names)):
+        sys.exit(1)
 
 if __name__ == "__main__":
    main(sys.argv[1:])
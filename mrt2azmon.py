@@ -1,17 +1,68 @@
 #!/usr/bin/python3
 
-import os, sys, getopt, json, collections, requests
+import os, sys, getopt, json, collections, requests, subprocess, shlex
 import datetime, hashlib, hmac, base64
+import gzip, time, threading, concurrent.futures
+import io, struct, select, ctypes, ctypes.util
+import mmap, heapq, shutil, tempfile, bz2, ipaddress
 import mrtparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from azure.keyvault.secrets import SecretClient
 from azure.identity import DefaultAzureCredential
+# get_secret.py (in the same directory) caches the secrets, so that runs from cron do not call Azure Key Vault every time
+try:
+    import get_secret
+except ImportError:
+    get_secret = None
 
 # Default values
 default_mrt_file = "/tmp/bird-mrtdump_bgp"
 consolidated_mrt_file = "/var/log/bird.mrt"
 temp_mrt_file = "/tmp/bird-mrtdump_bgp.tmp"
 log_type = 'BgpAnalytics'
+# Base URL of the Data Collector API, None for https://<workspace_id>.ods.opinsights.azure.com (set it to test against a local stand-in)
+data_collector_endpoint = None
 send_keepalives = True
+# Raw JSON of the MRT record added to each log record for troubleshooting: 'all', 'none', or 'sample' (one record out of raw_sample_every)
+send_raw = 'all'
+raw_sample_every = 100
+# The Data Collector API accepts up to 30 MB per post, batches are kept below that
+default_batch_mb = 25
+default_max_in_flight = 4
+# Daemon mode: file with the byte offset processed so far, size at which the MRT file is rotated once it has been sent,
+# number of rotated MRT files kept (<consolidated file>, <consolidated file>.1 ... from newest to oldest, so about
+# rotate_keep x rotate_mb of history), and command that makes BIRD reopen the MRT file after it has been renamed
+default_state_file = "/var/tmp/mrt2azmon.state"
+default_rotate_mb = 256
+default_rotate_keep = 4
+default_reopen_command = "birdc configure"
+default_poll_interval = 1.0
+# Daemon mode: maximum delay between attempts to send records again after Azure Monitor did not accept them
+max_retry_delay = 300
+# Every MRT record starts with a 12-byte header (timestamp, type, subtype, length), where length does not include the header
+mrt_header = struct.Struct('!IHHI')
+# Records longer than this are considered corrupt (BGP messages are at most 64 KB)
+max_mrt_record_bytes = 1024 * 1024
+# Maximum number of bytes read from the MRT file at once in daemon mode
+max_read_bytes = 64 * 1024 * 1024
+# Aggregation mode: log type of the interval summaries, file with the RIBs between runs, and number of changes of a prefix
+# in an interval for it to be counted as flapping
+summary_log_type = 'BgpSummary'
+default_rib_file = "/var/tmp/mrt2azmon.rib"
+flap_threshold = 3
+max_flapping_listed = 10
+# Archive: uncompressed size of the blocks of records of a peer compressed together (the unit read by queries), total size
+# of the blocks being filled, size at which segments are closed, and the maximum size and age of the archive (oldest segments
+# are deleted first)
+default_archive_dir = "/var/log/bird-archive"
+archive_block_bytes = 256 * 1024
+archive_buffer_bytes = 4 * 1024 * 1024
+default_archive_segment_mb = 16
+default_archive_max_mb = 1024
+default_archive_max_days = 30
+# Backfill mode: size of the byte ranges of the MRT file parsed by each worker process
+default_range_mb = 8
 
 # Build signature to authenticate message
 # See https://docs.microsoft.com/azure/azure-monitor/logs/data-collector-api
@@ -24,16 +75,38 @@ def build_signature(customer_id, shared_key, date, content_length, method, conte
     authorization = "SharedKey {}:{}".format(customer_id,encoded_hash)
     return authorization
 
-# Build and send a request to the POST API
+# Shared HTTP session, so that connections to the Data Collector API are pooled and kept alive
+http_session = None
+http_session_lock = threading.Lock()
+
+# Returns the shared HTTP session, retrying with exponential backoff on throttling (429) and server errors (5xx)
+# POST requests are retried too: a batch may be logged twice if a response is lost, instead of not being logged
+def get_http_session(pool_size=10):
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            retries = Retry(total=6, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['POST'], respect_retry_after_header=True)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, 10), max_retries=retries)
+            http_session = requests.Session()
+            http_session.mount('https://', adapter)
+            http_session.mount('http://', adapter)
+    return http_session
+
+# Build and send a request to the POST API. The body can be a string or bytes, already compressed if content_encoding is set (e.g. 'gzip').
+# The signature is computed for each request, since it depends on the date and the length of the body.
+# Returns True if the request was accepted.
 # See https://docs.microsoft.com/azure/azure-monitor/logs/data-collector-api
-def post_data(customer_id, shared_key, body, log_type):
+def post_data(customer_id, shared_key, body, log_type, content_encoding=None, quiet=False):
     method = 'POST'
     content_type = 'application/json'
     resource = '/api/logs'
+    if isinstance(body, str):
+        body = body.encode('utf-8')
     rfc1123date = datetime.datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT')
     content_length = len(body)
     signature = build_signature(customer_id, shared_key, rfc1123date, content_length, method, content_type, resource)
-    uri = 'https://' + customer_id + '.ods.opinsights.azure.com' + resource + '?api-version=2016-04-01'
+    endpoint = data_collector_endpoint.rstrip('/') if data_collector_endpoint else 'https://' + customer_id + '.ods.opinsights.azure.com'
+    uri = endpoint + resource + '?api-version=2016-04-01'
     # Headers
     headers = {
         'content-type': content_type,
@@ -41,12 +114,68 @@ def post_data(customer_id, shared_key, body, log_type):
         'Log-Type': log_type,
         'x-ms-date': rfc1123date
     }
+    if content_encoding is not None:
+        headers['Content-Encoding'] = content_encoding
     # Send POST request
-    response = requests.post(uri,data=body, headers=headers)
+    try:
+        response = get_http_session().post(uri, data=body, headers=headers, timeout=120)
+    except requests.exceptions.RequestException as e:
+        print(f'ERROR: API request to Azure Monitor failed: {str(e)}')
+        return False
     if (response.status_code >= 200 and response.status_code <= 299):
-        print('INFO: API request to Azure Monitor accepted')
+        if not quiet:
+            print('INFO: API request to Azure Monitor accepted')
+        return True
     else:
         print(f'ERROR: Response code: {response.status_code}, Response body: {response.content}')
+        return False
+
+# Groups the records into JSON arrays (as bytes) of at most max_batch_bytes, and yields each array with its number of records
+# The records are encoded once and joined at the end of each batch, so building a batch is linear in its size
+def iter_batches(records, max_batch_bytes):
+    batch = []
+    batch_bytes = 2
+    for record in records:
+        # Records can also be passed already encoded, e.g. by the worker processes of backfill mode
+        encoded_record = record if isinstance(record, bytes) else json.dumps(record).encode('utf-8')
+        if len(batch) > 0 and batch_bytes + len(encoded_record) + 2 > max_batch_bytes:
+            yield b'[' + b',\n'.join(batch) + b']', len(batch)
+            batch = []
+            batch_bytes = 2
+        if len(encoded_record) + 2 > max_batch_bytes:
+            print(f'WARNING: a record of {len(encoded_record)} bytes is larger than the batch size, it will probably be rejected')
+        batch.append(encoded_record)
+        batch_bytes += len(encoded_record) + 2
+    if len(batch) > 0:
+        yield b'[' + b',\n'.join(batch) + b']', len(batch)
+
+# Sends the batches to Azure Monitor, with up to max_in_flight batches being sent at the same time
+# Returns statistics about the batches sent
+def send_batches(customer_id, shared_key, batches, log_type, max_in_flight=default_max_in_flight, compress=True):
+    stats = {'batches': 0, 'records': 0, 'bytes': 0, 'bytes_sent': 0, 'failed_batches': 0, 'failed_records': 0}
+    stats_lock = threading.Lock()
+    def send_batch(body, record_count):
+        # Batches are compressed in the worker threads, so that compression overlaps with parsing and sending
+        payload = gzip.compress(body, compresslevel=6) if compress else body
+        accepted = post_data(customer_id, shared_key, payload, log_type, content_encoding='gzip' if compress else None, quiet=True)
+        with stats_lock:
+            stats['batches'] += 1
+            stats['records'] += record_count
+            stats['bytes'] += len(body)
+            stats['bytes_sent'] += len(payload)
+            if not accepted:
+                stats['failed_batches'] += 1
+                stats['failed_records'] += record_count
+    get_http_session(pool_size=max_in_flight)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(max_in_flight, 1)) as executor:
+        in_flight = set()
+        for body, record_count in batches:
+            # Wait for a batch to complete before queueing more, so that at most max_in_flight batches are held in memory
+            if len(in_flight) >= max(max_in_flight, 1):
+                done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            in_flight.add(executor.submit(send_batch, body, record_count))
+        concurrent.futures.wait(in_flight)
+    return stats
 
 # Only 1-level JSON is accepted by Log Analytics
 def flatten(d, parent_key=None, items=None):
@@ -87,20 +216,963 @@ def flatten(d, parent_key=None, items=None):
     # print (json.dumps(items))
     return items
 
+# Flattens the records of one message type exactly like flatten(), following a plan compiled on first sight: for each key,
+# the output key names and how the value is flattened are worked out once, and reused for the next records of the same
+# type. Flattening a record is then a single pass over its keys with no string concatenation for keys already seen.
+# If the type of a value changes (e.g. an attribute list that is empty in some records), the step for that key is compiled again.
+class FlattenPlan:
+    def __init__(self, prefix=None):
+        self.prefix = prefix
+        self.steps = {}
+        self.element_plans = []
+
+    # Returns the plan of the elements at an index of a list of dictionaries (whose keys get the index as prefix)
+    def get_element_plan(self, index):
+        while len(self.element_plans) <= index:
+            self.element_plans.append(FlattenPlan(self.prefix + '_' + str(len(self.element_plans))))
+        return self.element_plans[index]
+
+    # Returns the step for a key: the type of its value, its output key name, and the function that flattens the value
+    # into the items, or None if the value is copied as it is
+    def compile_step(self, key, value):
+        name = key if self.prefix is None else self.prefix + '_' + key
+        if type(value) == collections.OrderedDict:
+            return type(value), name, FlattenPlan(name).flatten
+        if type(value) == list:
+            child = FlattenPlan(name)
+            code_name = name + '_code'
+            join_values = key == 'value'
+            def flatten_list(value, items):
+                if len(value) == 0:
+                    return
+                if type(value[0]) == collections.OrderedDict:
+                    for index, element in enumerate(value):
+                        child.get_element_plan(index).flatten(element, items)
+                # Lists of values are concatenated, unless they are a code/translation value pair
+                elif len(value) == 2 and not join_values:
+                    items[code_name] = value[0]
+                    items[name] = value[1]
+                else:
+                    items[name] = ' '.join(map(str, value))
+            return type(value), name, flatten_list
+        return type(value), name, None
+
+    def flatten(self, d, items):
+        steps = self.steps
+        for key, value in d.items():
+            step = steps.get(key)
+            if step is None or step[0] is not type(value):
+                step = steps[key] = self.compile_step(key, value)
+            value_type, name, flatten_value = step
+            if flatten_value is None:
+                items[name] = value
+            else:
+                flatten_value(value, items)
+        return items
+
+# Flatten plans for each message type, by MRT type, MRT subtype and BGP message type (e.g. UPDATE, OPEN, NOTIFICATION, STATE_CHANGE)
+flatten_plans = {}
+
+# Returns the code of a {code: name} dictionary (mrtparse 2.x) or [code, name] list (mrtparse 1.x), or None
+def get_code(value):
+    if isinstance(value, dict):
+        return next(iter(value), None)
+    if isinstance(value, list) and len(value) == 2:
+        return value[0]
+    return None
+
+# Returns the name of the BGP message type of a parsed MRT record (e.g. 'UPDATE' or 'KEEPALIVE'), or None if it has no BGP message
+def get_bgp_message_type(data):
+    try:
+        message_type = data['bgp_message']['type']
+    except (KeyError, TypeError):
+        return None
+    if isinstance(message_type, dict):
+        return next(iter(message_type.values()), None)
+    if isinstance(message_type, list) and len(message_type) == 2:
+        return message_type[1]
+    return None
+
+# Returns the flattened log record of a parsed MRT record, with the plan of its message type
+def flatten_entry(data, message_type):
+    plan_key = (get_code(data.get('type')), get_code(data.get('subtype')), message_type)
+    plan = flatten_plans.get(plan_key)
+    if plan is None:
+        plan = flatten_plans[plan_key] = FlattenPlan()
+    return plan.flatten(data, {})
+
+# Sets which log records carry the raw JSON of their MRT record (also called in the worker processes of backfill mode)
+def set_raw_mode(mode, sample_every=None):
+    global send_raw, raw_sample_every
+    send_raw = mode
+    if sample_every is not None:
+        raw_sample_every = max(int(sample_every), 1)
+
+# Returns the log record of a parsed MRT record, with the raw JSON of the record if the raw mode says so (record_no starts at 1)
+def build_log_record(data, message_type, record_no):
+    bgp_entry = flatten_entry(data, message_type)
+    if send_raw == 'all' or (send_raw == 'sample' and (record_no - 1) % raw_sample_every == 0):
+        bgp_entry['raw'] = json.dumps(data)   # Add raw JSON for troubleshooting
+    return bgp_entry
+
+# Returns the RIB key of a route of an UPDATE message (prefix/length, with the path identifier if ADD-PATH is used)
+def get_route_key(route):
+    if 'path_id' in route:
+        return f"{route['prefix']}/{route['length']}#{route['path_id']}"
+    return f"{route['prefix']}/{route['length']}"
+
+# Returns the routes announced and withdrawn by a BGP UPDATE message, and its AS path
+def get_update_routes(message):
+    withdrawn_routes = message.get('withdrawn_routes', [])
+    announced_routes = message.get('nlri', [])
+    as_path = ''
+    for attribute in message.get('path_attributes', []):
+        code = get_code(attribute.get('type'))
+        # AS_PATH, MP_REACH_NLRI and MP_UNREACH_NLRI (routes of other address families than IPv4 unicast)
+        if code == 2:
+            as_path = ' '.join(' '.join(map(str, segment.get('value', []))) for segment in attribute.get('value', []))
+        elif code == 14:
+            announced_routes = announced_routes + attribute['value'].get('nlri', [])
+        elif code == 15:
+            withdrawn_routes = withdrawn_routes + attribute['value'].get('withdrawn_routes', [])
+    return announced_routes, withdrawn_routes, as_path
+
+# Maintains the RIB of each BGP peer (prefix -> AS path) from the UPDATE messages and session state changes, and
+# summarizes per peer the changes in each interval (aligned to multiples of its length, by record timestamp): updates,
+# prefixes added and withdrawn, AS path changes and flapping prefixes. Each RIB is a dictionary keyed by prefix, since
+# updates only need exact prefix lookups, and equal AS paths are stored once for all the prefixes of all peers.
+# The summaries of closed intervals that could not be sent are kept in pending_summaries, and saved with the RIBs.
+class RouteAggregator:
+    def __init__(self, interval):
+        self.interval = interval
+        self.interval_start = None
+        self.ribs = {}
+        self.counters = {}
+        self.as_paths = {}
+        self.pending_summaries = []
+
+    # Returns the counters of a peer for the current interval
+    def get_counters(self, peer):
+        counters = self.counters.get(peer)
+        if counters is None:
+            counters = self.counters[peer] = {'updates': 0, 'announcements': 0, 'withdrawals': 0, 'prefixes_added': 0, 'prefixes_withdrawn': 0,
+                                              'as_path_changes': 0, 'session_resets': 0, 'changes': {}}
+        return counters
+
+    # Adds a parsed MRT record, and returns the summaries of the interval that it closes, if any
+    def add(self, data, timestamp):
+        summaries = []
+        interval_start = timestamp - timestamp % self.interval
+        if self.interval_start is None:
+            self.interval_start = interval_start
+        elif interval_start > self.interval_start:
+            summaries = self.flush()
+            self.interval_start = interval_start
+        peer = f"{data.get('peer_ip')}|{data.get('peer_as')}"
+        if get_bgp_message_type(data) == 'UPDATE':
+            self.add_update(peer, data['bgp_message'])
+        elif 'new_state' in data and get_code(data['new_state']) != 6:
+            # The session left the Established state, so all the routes of the peer are withdrawn
+            rib = self.ribs.pop(peer, None)
+            if rib:
+                counters = self.get_counters(peer)
+                counters['session_resets'] += 1
+                counters['prefixes_withdrawn'] += len(rib)
+        return summaries
+
+    def add_update(self, peer, message):
+        rib = self.ribs.get(peer)
+        if rib is None:
+            rib = self.ribs[peer] = {}
+        counters = self.get_counters(peer)
+        changes = counters['changes']
+        counters['updates'] += 1
+        announced_routes, withdrawn_routes, as_path = get_update_routes(message)
+        as_path = self.as_paths.setdefault(as_path, as_path)
+        for route in withdrawn_routes:
+            route_key = get_route_key(route)
+            counters['withdrawals'] += 1
+            if rib.pop(route_key, None) is not None:
+                counters['prefixes_withdrawn'] += 1
+                changes[route_key] = changes.get(route_key, 0) + 1
+        for route in announced_routes:
+            route_key = get_route_key(route)
+            counters['announcements'] += 1
+            previous_as_path = rib.get(route_key)
+            if previous_as_path is None:
+                counters['prefixes_added'] += 1
+                changes[route_key] = changes.get(route_key, 0) + 1
+            elif previous_as_path != as_path:
+                counters['as_path_changes'] += 1
+                changes[route_key] = changes.get(route_key, 0) + 1
+            rib[route_key] = as_path
+
+    # Returns the summaries of the current interval, one per peer with updates or state changes, and starts a new interval
+    def flush(self):
+        summaries = []
+        if self.interval_start is None:
+            return summaries
+        interval_start = datetime.datetime.fromtimestamp(self.interval_start, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        for peer, counters in self.counters.items():
+            peer_ip, peer_as = peer.rsplit('|', 1)
+            changes = counters.pop('changes')
+            flapping = sorted(((count, route_key) for route_key, count in changes.items() if count >= flap_threshold), reverse=True)
+            summary = {'interval_start': interval_start, 'interval_seconds': self.interval, 'peer_ip': peer_ip, 'peer_as': peer_as}
+            summary.update(counters)
+            summary['flapping_prefixes'] = len(flapping)
+            summary['top_flapping_prefixes'] = ' '.join(f'{route_key}:{count}' for count, route_key in flapping[:max_flapping_listed])
+            summary['rib_prefixes'] = len(self.ribs.get(peer, {}))
+            summaries.append(summary)
+        self.counters = {}
+        return summaries
+
+    # Saves the RIBs, the counters of the current interval and the summaries not sent yet, so that the next run continues from them
+    def save(self, rib_file):
+        save_state(rib_file, {'interval': self.interval, 'interval_start': self.interval_start, 'ribs': self.ribs, 'counters': self.counters,
+                              'pending_summaries': self.pending_summaries})
+
+    # Returns an aggregator with the RIBs saved by a previous run, if any (the counters are only kept if the interval is the same)
+    @classmethod
+    def load(cls, rib_file, interval):
+        aggregator = cls(interval)
+        try:
+            with open(rib_file, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return aggregator
+        for peer, rib in state.get('ribs', {}).items():
+            for route_key, as_path in rib.items():
+                rib[route_key] = aggregator.as_paths.setdefault(as_path, as_path)
+            aggregator.ribs[peer] = rib
+        aggregator.pending_summaries = state.get('pending_summaries', [])
+        if state.get('interval') == interval:
+            aggregator.interval_start = state.get('interval_start')
+            aggregator.counters = state.get('counters', {})
+        return aggregator
+
+# Returns the timestamp (seconds) of a parsed MRT record, mrtparse returns it as a {timestamp: date string} dictionary
+def get_entry_timestamp(entry):
+    timestamp = entry.data.get('timestamp', 0)
+    if isinstance(timestamp, dict):
+        timestamp = next(iter(timestamp), 0)
+    return timestamp
+
+# Yields the timestamp and flattened log record of the BGP messages in an MRT file (name or file object), counting messages and keepalives in stats
+# The records are also added to the archive, if any
+def iter_log_entries(mrt_source, stats, dry_run=False, archive=None):
+    for entry in mrtparse.Reader(mrt_source):
+        stats['entries'] += 1
+        # Do not log keepalives
+        add_entry = True
+        message_type = get_bgp_message_type(entry.data)
+        if message_type == 'KEEPALIVE':
+            add_entry = send_keepalives
+            stats['keepalives'] += 1
+        if add_entry:
+            bgp_entry = build_log_record(entry.data, message_type, stats['entries'])
+            if dry_run:
+                print(bgp_entry)
+            if archive is not None and message_type != 'KEEPALIVE':
+                archive.add(get_entry_timestamp(entry), entry.data, bgp_entry)
+            yield get_entry_timestamp(entry), bgp_entry
+
+# Yields the flattened log records of the BGP messages in an MRT file (name or file object), counting messages and keepalives in stats
+def iter_log_records(mrt_source, stats, dry_run=False, archive=None):
+    for timestamp, bgp_entry in iter_log_entries(mrt_source, stats, dry_run=dry_run, archive=archive):
+        yield bgp_entry
+
+# Parses the MRT records of a file (name or file object) and sends them to Azure Monitor in batches, printing statistics
+def process_mrt_records(mrt_source, customer_id, shared_key, batch_bytes, max_in_flight=default_max_in_flight, compress=True, dry_run=False, archive=None):
+    stats = {'entries': 0, 'keepalives': 0}
+    start_time = time.time()
+    batches = iter_batches(iter_log_records(mrt_source, stats, dry_run=dry_run, archive=archive), batch_bytes)
+    if dry_run:
+        batch_no = 0
+        for body, record_count in batches:
+            batch_no += 1
+        print(f'INFO: {stats["entries"]} BGP messages analyzed, out of which {stats["keepalives"]} were keepalives, {batch_no} batches would be sent')
+        return True
+    # Send batches to Azure Monitor
+    send_stats = send_batches(customer_id, shared_key, batches, log_type, max_in_flight=max_in_flight, compress=compress)
+    elapsed = max(time.time() - start_time, 0.001)
+    print(f'INFO: {stats["entries"]} BGP messages analyzed, out of which {stats["keepalives"]} were keepalives')
+    print(f'INFO: {send_stats["records"]} records sent in {send_stats["batches"]} batches in {elapsed:.1f} seconds ({send_stats["records"] / elapsed:.0f} records/sec), '
+          f'{send_stats["bytes"]} bytes of JSON, {send_stats["bytes_sent"]} bytes sent')
+    if send_stats['failed_batches'] > 0:
+        print(f'ERROR: {send_stats["failed_batches"]} batches with {send_stats["failed_records"]} records were not accepted by Azure Monitor')
+        return False
+    return True
+
+# Parses the MRT records of a file (name or file object) into the aggregator, and returns the summaries of the intervals
+# that they close, with those of the current interval too if final is set. The records are also added to the archive, if any.
+def aggregate_mrt_records(mrt_source, aggregator, final=False, archive=None):
+    entries = 0
+    summaries = []
+    for entry in mrtparse.Reader(mrt_source):
+        entries += 1
+        summaries += aggregator.add(entry.data, get_entry_timestamp(entry))
+        if archive is not None:
+            message_type = get_bgp_message_type(entry.data)
+            if message_type != 'KEEPALIVE':
+                archive.add(get_entry_timestamp(entry), entry.data, flatten_entry(entry.data, message_type))
+    if final:
+        summaries += aggregator.flush()
+    print(f'INFO: {entries} BGP messages aggregated, {len(summaries)} interval summaries to send')
+    return summaries
+
+# Parses the MRT records of a file (name or file object) into the aggregator, and sends the summaries of the intervals that
+# they close to Azure Monitor, with those of the current interval too if final is set. The records are also added to the archive, if any.
+# The summaries not sent by a previous run are sent first, and if the summaries cannot be sent they are kept in the aggregator
+# for the next run. Returns whether all the summaries were sent.
+def process_mrt_summaries(mrt_source, aggregator, customer_id, shared_key, batch_bytes, max_in_flight=default_max_in_flight, compress=True, dry_run=False, final=False,
+                          archive=None):
+    if len(aggregator.pending_summaries) > 0:
+        print(f'INFO: sending {len(aggregator.pending_summaries)} interval summaries not sent by a previous run')
+    summaries = aggregator.pending_summaries + aggregate_mrt_records(mrt_source, aggregator, final=final, archive=archive)
+    sent = send_summaries(summaries, customer_id, shared_key, batch_bytes, max_in_flight=max_in_flight, compress=compress, dry_run=dry_run)
+    aggregator.pending_summaries = [] if sent else summaries
+    return sent
+
+# Sends interval summaries to Azure Monitor (or prints them in dry-run mode), and returns whether all of them were accepted
+def send_summaries(summaries, customer_id, shared_key, batch_bytes, max_in_flight=default_max_in_flight, compress=True, dry_run=False):
+    if dry_run:
+        for summary in summaries:
+            print(summary)
+        return True
+    if len(summaries) == 0:
+        return True
+    send_stats = send_batches(customer_id, shared_key, iter_batches(summaries, batch_bytes), summary_log_type, max_in_flight=max_in_flight, compress=compress)
+    if send_stats['failed_batches'] > 0:
+        print(f'ERROR: {send_stats["failed_batches"]} batches with {send_stats["failed_records"]} summaries were not accepted by Azure Monitor')
+        return False
+    return True
+
+# Returns the archive manifest (time range, size and peers of each segment), or an empty manifest if there is none
+def load_archive_manifest(archive_dir):
+    try:
+        with open(os.path.join(archive_dir, 'manifest.json'), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'next_segment': 1, 'segments': []}
+
+# Writes log records to a segmented archive in a directory, for local queries. Each segment is a file of gzip members
+# (so still a valid gzip file) that each compress a block of records of a single peer, one per line as
+# "timestamp<TAB>peer<TAB>prefixes<TAB>JSON". The index file of a segment has the time range and offset of each block, and
+# the blocks of each peer and prefix. The manifest has the time range and peers of each segment, so queries only decompress
+# the blocks of the peer they are about. A block is filled per peer and written when full, when the blocks being filled
+# exceed archive_buffer_bytes (the largest one is written), or on flush.
+# The last segment is continued by the next run until it is full, and closed segments are deleted when too old or too many.
+class ArchiveWriter:
+    def __init__(self, archive_dir, segment_bytes=default_archive_segment_mb * 1024 * 1024, max_bytes=default_archive_max_mb * 1024 * 1024,
+                 max_age=default_archive_max_days * 86400):
+        os.makedirs(archive_dir, exist_ok=True)
+        self.archive_dir = archive_dir
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.manifest = load_archive_manifest(archive_dir)
+        self.segment = None
+        self.index = None
+        # Blocks being filled by peer, and their total size
+        self.blocks = {}
+        self.buffered_bytes = 0
+        if len(self.manifest['segments']) > 0 and not self.manifest['segments'][-1]['closed']:
+            segment = self.manifest['segments'][-1]
+            try:
+                with open(self.get_path(segment['name'] + '.idx'), 'r') as f:
+                    self.index = json.load(f)
+                self.segment = segment
+            except (OSError, ValueError):
+                print(f'WARNING: index of archive segment {segment["name"]} not found, closing the segment')
+                segment['closed'] = True
+
+    def get_path(self, name):
+        return os.path.join(self.archive_dir, name)
+
+    # Adds the log record of a parsed MRT record
+    def add(self, timestamp, data, record):
+        peer = str(data.get('peer_ip', ''))
+        prefixes = []
+        if get_bgp_message_type(data) == 'UPDATE':
+            announced_routes, withdrawn_routes, as_path = get_update_routes(data['bgp_message'])
+            prefixes = [f"{route['prefix']}/{route['length']}" for route in announced_routes + withdrawn_routes]
+        # The raw JSON is not archived, the MRT records are still in the consolidated MRT file
+        if 'raw' in record:
+            record = {key: value for key, value in record.items() if key != 'raw'}
+        line = f'{timestamp}\t{peer}\t{" ".join(prefixes)}\t{json.dumps(record)}\n'.encode('utf-8')
+        block = self.blocks.get(peer)
+        if block is None:
+            block = self.blocks[peer] = {'lines': [], 'bytes': 0, 'start': timestamp, 'end': timestamp, 'prefixes': set(), 'created': time.monotonic()}
+        block['lines'].append(line)
+        block['bytes'] += len(line)
+        block['start'] = min(block['start'], timestamp)
+        block['end'] = max(block['end'], timestamp)
+        block['prefixes'].update(prefixes)
+        self.buffered_bytes += len(line)
+        if block['bytes'] >= archive_block_bytes:
+            self.write_block(peer)
+        elif self.buffered_bytes >= archive_buffer_bytes:
+            self.write_block(max(self.blocks, key=lambda block_peer: self.blocks[block_peer]['bytes']))
+
+    # Compresses the block of a peer and appends it to the open segment, opening a new segment if needed
+    def write_block(self, peer):
+        block = self.blocks.pop(peer, None)
+        if block is None:
+            return
+        self.buffered_bytes -= block['bytes']
+        if self.segment is None:
+            name = f'segment-{self.manifest["next_segment"]:06d}'
+            self.manifest['next_segment'] += 1
+            self.segment = {'name': name, 'start': block['start'], 'end': block['end'], 'records': 0, 'bytes': 0, 'peers': [], 'closed': False}
+            self.manifest['segments'].append(self.segment)
+            self.index = {'blocks': [], 'peers': {}, 'prefixes': {}}
+        compressed = gzip.compress(b''.join(block['lines']), compresslevel=6)
+        with open(self.get_path(self.segment['name'] + '.gz'), 'ab') as f:
+            offset = f.tell()
+            f.write(compressed)
+        block_no = len(self.index['blocks'])
+        self.index['blocks'].append([block['start'], block['end'], offset, len(compressed), len(block['lines'])])
+        self.index['peers'].setdefault(peer, []).append(block_no)
+        for prefix in block['prefixes']:
+            self.index['prefixes'].setdefault(prefix, []).append(block_no)
+        self.segment['start'] = min(self.segment['start'], block['start'])
+        self.segment['end'] = max(self.segment['end'], block['end'])
+        self.segment['records'] += len(block['lines'])
+        self.segment['bytes'] = offset + len(compressed)
+        self.segment['peers'] = sorted(self.index['peers'])
+        if self.segment['bytes'] >= self.segment_bytes:
+            self.segment['closed'] = True
+            self.save()
+            self.segment = None
+            self.index = None
+            self.expire()
+
+    # Writes the blocks that were started more than max_age seconds ago (or all of them if max_age is None), and saves the indexes
+    def flush(self, max_age=None):
+        now = time.monotonic()
+        peers = [peer for peer, block in self.blocks.items() if max_age is None or now - block['created'] >= max_age]
+        if len(peers) == 0:
+            return
+        for peer in peers:
+            self.write_block(peer)
+        self.save()
+        self.expire()
+
+    # Saves the index of the open segment and the manifest, atomically so that queries never see partial files
+    def save(self):
+        if self.segment is not None:
+            save_state(self.get_path(self.segment['name'] + '.idx'), self.index)
+        save_state(self.get_path('manifest.json'), self.manifest)
+
+    # Deletes the oldest closed segments while the archive is larger than max_bytes, or they are older than max_age
+    def expire(self):
+        total_bytes = sum(segment['bytes'] for segment in self.manifest['segments'])
+        for segment in list(self.manifest['segments']):
+            if not segment['closed'] or (total_bytes <= self.max_bytes and segment['end'] >= time.time() - self.max_age):
+                break
+            for suffix in ('.gz', '.idx'):
+                try:
+                    os.remove(self.get_path(segment['name'] + suffix))
+                except FileNotFoundError:
+                    pass
+            self.manifest['segments'].remove(segment)
+            total_bytes -= segment['bytes']
+            print(f'INFO: archive segment {segment["name"]} with {segment["records"]} records deleted')
+        save_state(self.get_path('manifest.json'), self.manifest)
+
+# Returns the timestamp of a time given as seconds since the epoch or as an ISO date and time in UTC (e.g. 2023-11-14T02:15)
+def parse_time(value):
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return int(datetime.datetime.fromisoformat(value.rstrip('Z')).replace(tzinfo=datetime.timezone.utc).timestamp())
+
+# Yields the JSON log records of the archive in a time range (start <= timestamp < end, either can be None), optionally
+# only those of a peer IP and/or about a prefix, counting the segments and blocks read in stats. The records of the
+# matching blocks of all segments are merged in timestamp order, a block being only read once all the records before
+# its first timestamp have been yielded.
+def query_archive(archive_dir, start=None, end=None, peer=None, prefix=None, stats=None):
+    if stats is None:
+        stats = {}
+    stats.update({'segments': 0, 'blocks': 0, 'records': 0})
+    if prefix is not None and '/' in prefix:
+        try:
+            prefix = str(ipaddress.ip_network(prefix, strict=False))
+        except ValueError:
+            pass
+    # Blocks that can match as (first timestamp, segment, block)
+    candidates = []
+    for segment in load_archive_manifest(archive_dir)['segments']:
+        if (start is not None and segment['end'] < start) or (end is not None and segment['start'] >= end) or (peer is not None and peer not in segment['peers']):
+            continue
+        try:
+            with open(os.path.join(archive_dir, segment['name'] + '.idx'), 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            print(f'WARNING: index of archive segment {segment["name"]} not found, skipping the segment')
+            continue
+        block_numbers = set(range(len(index['blocks'])))
+        if peer is not None:
+            block_numbers &= set(index['peers'].get(peer, []))
+        if prefix is not None:
+            block_numbers &= set(index['prefixes'].get(prefix, []))
+        block_numbers = [block_no for block_no in sorted(block_numbers) if (start is None or index['blocks'][block_no][1] >= start) and (end is None or index['blocks'][block_no][0] < end)]
+        if len(block_numbers) == 0:
+            continue
+        stats['segments'] += 1
+        candidates += [(index['blocks'][block_no][0], segment['name'], index['blocks'][block_no]) for block_no in block_numbers]
+    candidates.sort(key=lambda candidate: (candidate[0], candidate[1], candidate[2][2]))
+    # Heap of the matching records of the blocks read as (timestamp, block number, line number, record)
+    records = []
+    segment_files = {}
+    next_block = 0
+    try:
+        while next_block < len(candidates) or len(records) > 0:
+            while next_block < len(candidates) and (len(records) == 0 or candidates[next_block][0] <= records[0][0]):
+                block_start, name, (block_start, block_end, offset, length, block_records) = candidates[next_block]
+                if name not in segment_files:
+                    segment_files[name] = open(os.path.join(archive_dir, name + '.gz'), 'rb')
+                segment_files[name].seek(offset)
+                stats['blocks'] += 1
+                for line_no, line in enumerate(gzip.decompress(segment_files[name].read(length)).decode('utf-8').splitlines()):
+                    timestamp, line_peer, line_prefixes, record = line.split('\t', 3)
+                    timestamp = int(timestamp)
+                    if (start is not None and timestamp < start) or (end is not None and timestamp >= end):
+                        continue
+                    if (peer is not None and line_peer != peer) or (prefix is not None and prefix not in line_prefixes.split(' ')):
+                        continue
+                    heapq.heappush(records, (timestamp, next_block, line_no, record))
+                next_block += 1
+            if len(records) > 0:
+                stats['records'] += 1
+                yield heapq.heappop(records)[3]
+    finally:
+        for f in segment_files.values():
+            f.close()
+
+# Returns the length of the complete MRT records at the start of a buffer, and whether a corrupt record header was found
+def get_complete_records_length(buffer):
+    position = 0
+    while position + mrt_header.size <= len(buffer):
+        record_length = mrt_header.size + mrt_header.unpack_from(buffer, position)[3]
+        if record_length > max_mrt_record_bytes:
+            return position, True
+        if position + record_length > len(buffer):
+            break
+        position += record_length
+    return position, False
+
+# Returns the state of daemon mode (inode and byte offset of the MRT file processed so far)
+def load_state(state_file):
+    try:
+        with open(state_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'inode': None, 'offset': 0}
+
+# Saves the state of daemon mode atomically, so that a crash never leaves a partial state file
+def save_state(state_file, state):
+    temp_file = state_file + '.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(state, f)
+    os.replace(temp_file, state_file)
+
+# Moves a rotated MRT file to the consolidated MRT file, after renaming the previous ones to <file>.1, <file>.2 ... and
+# deleting the oldest, so that rotate_keep files are kept. The move is a rename if both files are in the same file system.
+def keep_rotated_file(rotated_file, consolidated_file, rotate_keep):
+    for generation in range(rotate_keep - 1, 0, -1):
+        newer_file = f'{consolidated_file}.{generation - 1}' if generation > 1 else consolidated_file
+        if os.path.exists(newer_file):
+            os.replace(newer_file, f'{consolidated_file}.{generation}')
+    shutil.move(rotated_file, consolidated_file)
+    print(f'INFO: rotated MRT file moved to {consolidated_file}, keeping {rotate_keep} rotated files')
+
+# Renames the MRT file once it has been sent, and runs reopen_command so that the writer (BIRD) creates a new one
+def rotate_mrt_file(mrt_file, rotated_file, reopen_command):
+    os.replace(mrt_file, rotated_file)
+    print(f'INFO: rotated {mrt_file} to {rotated_file}, waiting for the new MRT file')
+    if reopen_command:
+        try:
+            subprocess.run(shlex.split(reopen_command), check=True, stdout=subprocess.DEVNULL, timeout=60)
+        except (OSError, subprocess.SubprocessError) as e:
+            print(f'WARNING: could not run "{reopen_command}", {rotated_file} is still followed until a new {mrt_file} is created: {str(e)}')
+
+# Waits for changes of a file with inotify (called through ctypes), or by polling if inotify is not available
+class FileWatcher:
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+
+    def __init__(self):
+        self.fd = None
+        self.watch = None
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            # IN_NONBLOCK and IN_CLOEXEC have the same values as O_NONBLOCK and O_CLOEXEC
+            fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd >= 0:
+                self.fd = fd
+        except (OSError, AttributeError):
+            pass
+        if self.fd is None:
+            print('WARNING: inotify is not available, polling the MRT file for changes')
+
+    def watch_file(self, path):
+        if self.fd is None:
+            return
+        if self.watch is not None:
+            self.libc.inotify_rm_watch(self.fd, self.watch)
+        watch = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.IN_MODIFY | self.IN_ATTRIB | self.IN_CLOSE_WRITE | self.IN_DELETE_SELF | self.IN_MOVE_SELF)
+        self.watch = watch if watch >= 0 else None
+
+    # Returns when the file changes, or after timeout seconds at most
+    def wait(self, timeout):
+        if self.fd is None or self.watch is None:
+            time.sleep(timeout)
+            return
+        if select.select([self.fd], [], [], timeout)[0]:
+            # Drain the events, only the wake-up matters
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+
+# Runs forever, sending the MRT records appended to mrt_file as soon as they are written. The byte offset up to which the
+# records have been sent is saved in state_file after every chunk, always at a record boundary, so a restart resumes
+# where the previous run stopped and a partially written record is only read once it is complete. If Azure Monitor does
+# not accept the records, the offset is not advanced and the same records are sent again after a delay that doubles
+# after each failure (records of batches that had been accepted may then be sent twice). If the MRT file is replaced
+# (new inode) the rest of the previous file is processed first, and if it is truncated it is read again from the start.
+# The records are not copied: once the MRT file has been sent up to its end and is larger than rotate_bytes, it is
+# renamed to <mrt_file>.rotated and reopen_command makes BIRD create a new one. The renamed file is still followed until
+# the new one appears, and is then moved to the consolidated MRT file, keeping rotate_keep rotated files.
+# With an aggregator, interval summaries are sent instead of the records. The records are only aggregated once, so the
+# summaries that could not be sent are kept and sent again, and the offset (and the RIBs, saved to rib_file once per
+# interval since saving them after every chunk would be too slow with full tables) are only saved once all summaries
+# have been sent. Archive blocks are written when full, or after a minute at most.
+def run_daemon(mrt_file, customer_id, shared_key, state_file=default_state_file, consolidated_file=consolidated_mrt_file, rotate_bytes=default_rotate_mb * 1024 * 1024,
+               rotate_keep=default_rotate_keep, reopen_command=default_reopen_command, batch_bytes=default_batch_mb * 1024 * 1024, max_in_flight=default_max_in_flight,
+               compress=True, poll_interval=default_poll_interval, dry_run=False, aggregator=None, rib_file=default_rib_file, archive=None):
+    state = load_state(state_file)
+    saved_offset = state['offset']
+    watcher = FileWatcher()
+    source = None
+    rotated_file = mrt_file + '.rotated'
+    rotating = False
+    replaced = False
+    # Resume a rotation interrupted by a restart: keep following the renamed file until the new one appears
+    try:
+        if os.stat(rotated_file).st_ino == state['inode']:
+            source = open(rotated_file, 'rb')
+            rotating = True
+            watcher.watch_file(rotated_file)
+        else:
+            print(f'WARNING: {rotated_file} is not the MRT file of {state_file}, leaving it as it is')
+    except FileNotFoundError:
+        pass
+    # Length of the records to send again after a failure (they have already been archived), and delay before that
+    retry_length = None
+    retry_delay = 0
+    # Summaries not sent by a previous run are sent first, and removed from the RIB file once sent
+    rib_changed = aggregator is not None and len(aggregator.pending_summaries) > 0
+    print(f'INFO: running in daemon mode, following {mrt_file}')
+    while True:
+        # Process all complete records after the offset
+        while source is not None:
+            source.seek(state['offset'])
+            data = source.read(retry_length or max_read_bytes)
+            length, corrupt = get_complete_records_length(data)
+            if length > 0 and retry_length is None and aggregator is not None:
+                interval_start = aggregator.interval_start
+                aggregator.pending_summaries += aggregate_mrt_records(io.BytesIO(data[:length]), aggregator, archive=archive)
+                rib_changed = rib_changed or aggregator.interval_start != interval_start
+            sent = True
+            if aggregator is None and length > 0:
+                sent = process_mrt_records(io.BytesIO(data[:length]), customer_id, shared_key, batch_bytes, max_in_flight=max_in_flight, compress=compress, dry_run=dry_run,
+                                           archive=archive if retry_length is None else None)
+            elif aggregator is not None and len(aggregator.pending_summaries) > 0:
+                sent = send_summaries(aggregator.pending_summaries, customer_id, shared_key, batch_bytes, max_in_flight=max_in_flight, compress=compress, dry_run=dry_run)
+                if sent:
+                    aggregator.pending_summaries = []
+            if not sent:
+                retry_delay = min(retry_delay * 2, max_retry_delay) if retry_delay > 0 else max(poll_interval, 1)
+                print(f'WARNING: sending again in {retry_delay:.0f} seconds, the offset of {mrt_file} stays at {saved_offset}')
+                time.sleep(retry_delay)
+                if aggregator is None:
+                    # Send the same records again, the summaries are kept in the pending summaries of the aggregator instead
+                    retry_length = length
+                    continue
+            else:
+                retry_delay = 0
+            retry_length = None
+            if corrupt:
+                # There is no way to find the next record boundary, so skip what has been written so far
+                print(f'ERROR: corrupt MRT record header at offset {state["offset"] + length} of {mrt_file}, skipping {len(data) - length} bytes')
+                length = len(data)
+            state['offset'] += length
+            if sent and (state['offset'] != saved_offset or rib_changed) and not dry_run:
+                if rib_changed:
+                    aggregator.save(rib_file)
+                    rib_changed = False
+                save_state(state_file, state)
+                saved_offset = state['offset']
+            if length < max_read_bytes // 2:
+                break
+        try:
+            stat = os.stat(mrt_file)
+        except FileNotFoundError:
+            stat = None
+        if stat is not None and (source is None or stat.st_ino != state['inode']):
+            # The MRT file was created or replaced: follow the new file, starting from the saved offset if it is the same file
+            if source is not None:
+                if not replaced:
+                    # Read the previous file once more, it may have been written to until the new one was created
+                    replaced = True
+                    continue
+                source.close()
+                if rotating:
+                    keep_rotated_file(rotated_file, consolidated_file, rotate_keep)
+                    rotating = False
+                else:
+                    print(f'INFO: {mrt_file} was replaced, following the new file')
+            replaced = False
+            source = open(mrt_file, 'rb')
+            if stat.st_ino != state['inode']:
+                state = {'inode': stat.st_ino, 'offset': 0}
+            watcher.watch_file(mrt_file)
+            continue
+        if stat is not None and stat.st_size < state['offset']:
+            print(f'WARNING: {mrt_file} was truncated, reading it again from the start')
+            state['offset'] = 0
+            continue
+        if (stat is not None and not dry_run and rotate_bytes > 0 and state['offset'] >= rotate_bytes and state['offset'] == stat.st_size
+                and state['offset'] == saved_offset):
+            rotate_mrt_file(mrt_file, rotated_file, reopen_command)
+            rotating = True
+            continue
+        if archive is not None:
+            archive.flush(max_age=60)
+        watcher.wait(poll_interval)
+
+# Splits an uncompressed MRT file into byte ranges of about range_bytes that start and end at record boundaries. Only the
+# 12-byte record headers are read, jumping from one header to the next, which is much faster than parsing the records.
+# Returns a list of (start, end, earliest timestamp in the range) tuples.
+def split_mrt_file(mrt_file, range_bytes):
+    ranges = []
+    with open(mrt_file, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return ranges
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            position = 0
+            start = 0
+            min_timestamp = None
+            length = 0
+            while position + mrt_header.size <= size:
+                timestamp, record_type, subtype, length = mrt_header.unpack_from(data, position)
+                if length > max_mrt_record_bytes:
+                    print(f'ERROR: corrupt MRT record header at offset {position} of {mrt_file}, ignoring the rest of the file')
+                    break
+                if position + mrt_header.size + length > size:
+                    break
+                if min_timestamp is None or timestamp < min_timestamp:
+                    min_timestamp = timestamp
+                position += mrt_header.size + length
+                if position - start >= range_bytes:
+                    ranges.append((start, position, min_timestamp))
+                    start = position
+                    min_timestamp = None
+            if position < size and length <= max_mrt_record_bytes:
+                print(f'WARNING: the last MRT record of {mrt_file} is incomplete, ignoring it')
+            if position > start:
+                ranges.append((start, position, min_timestamp))
+    return ranges
+
+# Parses the MRT records between two byte offsets of a file, and returns their timestamps and JSON-encoded log records
+# sorted by timestamp (keeping the file order for equal timestamps), with the message statistics.
+# Runs in the worker processes of backfill mode, so the records are encoded here and not in the main process.
+def parse_mrt_range(mrt_file, start, end):
+    with open(mrt_file, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    stats = {'entries': 0, 'keepalives': 0}
+    records = [(timestamp, json.dumps(bgp_entry).encode('utf-8')) for timestamp, bgp_entry in iter_log_entries(io.BytesIO(data), stats)]
+    records.sort(key=lambda record: record[0])
+    return records, stats
+
+# Yields the JSON-encoded log records of an uncompressed MRT file in timestamp order, parsing its byte ranges in parallel
+# in a pool of worker processes. The ranges are parsed in file order with at most two ranges per worker in flight, and a
+# record is only yielded once no range still to be merged can have an earlier record, which is known from the earliest
+# timestamp of each range found by split_mrt_file. MRT files are mostly in time order, so only a few ranges are held in memory.
+def iter_backfill_records(mrt_file, stats, workers, range_bytes=default_range_mb * 1024 * 1024):
+    # Smaller files are split in at least 4 ranges per worker, so that all workers are busy until the end
+    range_bytes = max(min(range_bytes, os.path.getsize(mrt_file) // (4 * workers)), 64 * 1024)
+    ranges = split_mrt_file(mrt_file, range_bytes)
+    print(f'INFO: {mrt_file} split into {len(ranges)} ranges, parsing them with {workers} worker processes')
+    # Earliest timestamp of the ranges from each index to the end
+    later_min_timestamps = [None] * len(ranges)
+    for index in range(len(ranges) - 1, -1, -1):
+        later_min_timestamps[index] = ranges[index][2] if index == len(ranges) - 1 else min(ranges[index][2], later_min_timestamps[index + 1])
+    pending = []
+    sequence = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=set_raw_mode, initargs=(send_raw, raw_sample_every)) as executor:
+        futures = collections.deque()
+        next_range = 0
+        for index in range(len(ranges)):
+            while next_range < len(ranges) and len(futures) < 2 * workers:
+                futures.append(executor.submit(parse_mrt_range, mrt_file, ranges[next_range][0], ranges[next_range][1]))
+                next_range += 1
+            records, range_stats = futures.popleft().result()
+            for key in range_stats:
+                stats[key] += range_stats[key]
+            for timestamp, record in records:
+                heapq.heappush(pending, (timestamp, sequence, record))
+                sequence += 1
+            # Records from later ranges have a greater sequence number, so records with the same timestamp keep the file order
+            while pending and (index == len(ranges) - 1 or pending[0][0] <= later_min_timestamps[index + 1]):
+                yield heapq.heappop(pending)[2]
+
+# Returns the name of an uncompressed copy of an MRT file compressed with gzip or bzip2 (as RIPE RIS and RouteViews
+# dumps are), since compressed files cannot be split into byte ranges, or None if the file is not compressed
+def get_uncompressed_mrt_file(mrt_file):
+    with open(mrt_file, 'rb') as f:
+        magic = f.read(3)
+    if magic[:2] == b'\x1f\x8b':
+        opener = gzip.open
+    elif magic == b'BZh':
+        opener = bz2.open
+    else:
+        return None
+    temp_file = tempfile.NamedTemporaryFile(prefix='mrt2azmon-', suffix='.mrt', delete=False)
+    print(f'INFO: decompressing {mrt_file} to {temp_file.name}')
+    with opener(mrt_file, 'rb') as source, temp_file:
+        shutil.copyfileobj(source, temp_file, 1024 * 1024)
+    return temp_file.name
+
+# Sends all the records of an MRT file (e.g. the consolidated MRT file, or a RIB dump) to Azure Monitor in timestamp order,
+# parsing the file in parallel. The file is read in place: it is neither truncated nor appended to the consolidated MRT file.
+def run_backfill(mrt_file, customer_id, shared_key, workers=None, range_bytes=default_range_mb * 1024 * 1024, batch_bytes=default_batch_mb * 1024 * 1024,
+                 max_in_flight=default_max_in_flight, compress=True, dry_run=False):
+    workers = max(workers or os.cpu_count() or 1, 1)
+    stats = {'entries': 0, 'keepalives': 0}
+    start_time = time.time()
+    uncompressed_file = get_uncompressed_mrt_file(mrt_file)
+    try:
+        batches = iter_batches(iter_backfill_records(uncompressed_file or mrt_file, stats, workers, range_bytes=range_bytes), batch_bytes)
+        if dry_run:
+            batch_no = 0
+            record_no = 0
+            for body, record_count in batches:
+                batch_no += 1
+                record_no += record_count
+            elapsed = max(time.time() - start_time, 0.001)
+            print(f'INFO: {stats["entries"]} BGP messages analyzed in {elapsed:.1f} seconds ({stats["entries"] / elapsed:.0f} messages/sec), '
+                  f'out of which {stats["keepalives"]} were keepalives, {record_no} records in {batch_no} batches would be sent')
+            return True
+        send_stats = send_batches(customer_id, shared_key, batches, log_type, max_in_flight=max_in_flight, compress=compress)
+    finally:
+        if uncompressed_file is not None:
+            os.remove(uncompressed_file)
+    elapsed = max(time.time() - start_time, 0.001)
+    print(f'INFO: {stats["entries"]} BGP messages analyzed, out of which {stats["keepalives"]} were keepalives')
+    print(f'INFO: {send_stats["records"]} records sent in {send_stats["batches"]} batches in {elapsed:.1f} seconds ({send_stats["records"] / elapsed:.0f} records/sec), '
+          f'{send_stats["bytes"]} bytes of JSON, {send_stats["bytes_sent"]} bytes sent')
+    if send_stats['failed_batches'] > 0:
+        print(f'ERROR: {send_stats["failed_batches"]} batches with {send_stats["failed_records"]} records were not accepted by Azure Monitor')
+        return False
+    return True
+
+# Measures the cost per record of flattening the records of an MRT file with flatten() and with the flatten plans, and of
+# building and JSON-encoding the log records as before (raw JSON in every record) and for each raw mode. Parsing is not included.
+def benchmark_flatten(mrt_file, repeat=3):
+    entries = [entry.data for entry in mrtparse.Reader(mrt_file)]
+    if len(entries) == 0:
+        print(f'ERROR: no MRT records in {mrt_file}')
+        return
+    def flatten_only():
+        for data in entries:
+            flatten(data)
+        return 0
+    def flatten_with_plans_only():
+        for data in entries:
+            flatten_entry(data, get_bgp_message_type(data))
+        return 0
+    def encode_with_flatten():
+        encoded_bytes = 0
+        for data in entries:
+            bgp_entry = flatten(data)
+            bgp_entry['raw'] = str(json.dumps(data))
+            encoded_bytes += len(json.dumps(bgp_entry))
+        return encoded_bytes
+    def encode_with_plans():
+        encoded_bytes = 0
+        for record_no, data in enumerate(entries, 1):
+            encoded_bytes += len(json.dumps(build_log_record(data, get_bgp_message_type(data), record_no)))
+        return encoded_bytes
+    print(f'INFO: flattening {len(entries)} records of {mrt_file}, best of {repeat} runs')
+    runs = [('flatten() only', None, flatten_only), ('flatten plans only', None, flatten_with_plans_only), ('flatten(), raw in all records', None, encode_with_flatten)]
+    runs += [(f'flatten plans, raw {mode}', mode, encode_with_plans) for mode in ('all', 'sample', 'none')]
+    saved_mode = send_raw
+    for description, mode, encode in runs:
+        if mode is not None:
+            set_raw_mode(mode)
+        best = None
+        for run in range(repeat):
+            start_time = time.perf_counter()
+            encoded_bytes = encode()
+            elapsed = time.perf_counter() - start_time
+            best = elapsed if best is None else min(best, elapsed)
+        size = f', {encoded_bytes / len(entries):7.0f} bytes/record' if encoded_bytes > 0 else ''
+        print(f'INFO: {description:32} {best * 1e6 / len(entries):7.1f} us/record{size}')
+    set_raw_mode(saved_mode)
+
 # Main
 def main(argv):
+    global data_collector_endpoint
     # Get arguments
     akv_name = None
     mrt_file = default_mrt_file
     dry_run = False
+    batch_mb = default_batch_mb
+    max_in_flight = default_max_in_flight
+    compress = True
+    daemon = False
+    state_file = default_state_file
+    rotate_mb = default_rotate_mb
+    rotate_keep = default_rotate_keep
+    reopen_command = default_reopen_command
+    backfill = False
+    workers = None
+    range_mb = default_range_mb
+    benchmark = False
+    aggregate_seconds = None
+    rib_file = default_rib_file
+    archive_dir = None
+    archive_mb = default_archive_max_mb
+    archive_days = default_archive_max_days
+    query = False
+    query_start = None
+    query_end = None
+    query_peer = None
+    query_prefix = None
+    usage = ('Options: -v <azure_key_vault_name> -f <mrt_file_name> [--batch-mb <MB>] [--max-in-flight <N>] [--no-gzip] [--daemon [--state-file <file>] [--rotate-mb <MB>] [--rotate-keep <N>] [--reopen-command <command>]]'
+             ' [--backfill [--workers <N>] [--range-mb <MB>]] [--raw all|none|sample] [--raw-sample <N>] [--benchmark]'
+             ' [--aggregate <seconds> [--rib-file <file>]] [--archive <dir> [--archive-mb <MB>] [--archive-days <days>]]'
+             ' [--query [--archive <dir>] [--from <time>] [--to <time>] [--peer <ip>] [--prefix <prefix>]] [--endpoint <url>]')
     try:
-        opts, args = getopt.getopt(argv,"hdv:f:",["help", "dry-run", "vault-name=", "mrt-file="])
+        opts, args = getopt.getopt(argv,"hdv:f:",["help", "dry-run", "vault-name=", "mrt-file=", "batch-mb=", "max-in-flight=", "no-gzip", "daemon", "state-file=", "rotate-mb=", "rotate-keep=", "reopen-command=", "backfill", "workers=", "range-mb=", "raw=", "raw-sample=", "benchmark", "aggregate=", "rib-file=",
+                                                    "archive=", "archive-mb=", "archive-days=", "query", "from=", "to=", "peer=", "prefix=", "endpoint="])
     except getopt.GetoptError:
-        print ('Options: -v <azure_key_vault_name> -f <mrt_file_name>')
+        print (usage)
         sys.exit(2)
     for opt, arg in opts:
-        if opt == '-h':
-            print ('Options: -v <azure_key_vault_name> -f <mrt_file_name>')
+        if opt in ("-h", "--help"):
+            print (usage)
             sys.exit()
         if opt in ("-d", "--dry-run"):
             print ("INFO: running in dry-run mode")
@@ -109,66 +1181,133 @@ def main(argv):
             akv_name = arg
         elif opt in ("-f", "--mrt-file"):
             mrt_file = arg
+        elif opt == "--batch-mb":
+            batch_mb = float(arg)
+        elif opt == "--max-in-flight":
+            max_in_flight = int(arg)
+        elif opt == "--no-gzip":
+            compress = False
+        elif opt == "--daemon":
+            daemon = True
+        elif opt == "--state-file":
+            state_file = arg
+        elif opt == "--rotate-mb":
+            rotate_mb = float(arg)
+        elif opt == "--rotate-keep":
+            rotate_keep = max(int(arg), 1)
+        elif opt == "--reopen-command":
+            reopen_command = arg
+        elif opt == "--backfill":
+            backfill = True
+        elif opt == "--workers":
+            workers = int(arg)
+        elif opt == "--range-mb":
+            range_mb = float(arg)
+        elif opt == "--raw":
+            if arg not in ('all', 'none', 'sample'):
+                print (usage)
+                sys.exit(2)
+            set_raw_mode(arg)
+        elif opt == "--raw-sample":
+            set_raw_mode(send_raw, int(arg))
+        elif opt == "--benchmark":
+            benchmark = True
+        elif opt == "--aggregate":
+            aggregate_seconds = int(arg)
+        elif opt == "--rib-file":
+            rib_file = arg
+        elif opt == "--archive":
+            archive_dir = arg
+        elif opt == "--archive-mb":
+            archive_mb = float(arg)
+        elif opt == "--archive-days":
+            archive_days = float(arg)
+        elif opt == "--query":
+            query = True
+        elif opt == "--from":
+            query_start = parse_time(arg)
+        elif opt == "--to":
+            query_end = parse_time(arg)
+        elif opt == "--peer":
+            query_peer = arg
+        elif opt == "--prefix":
+            query_prefix = arg
+        elif opt == "--endpoint":
+            data_collector_endpoint = arg
+    # Queries only read the local archive, they do not need the Azure Key Vault
+    if query:
+        stats = {}
+        for record in query_archive(archive_dir or default_archive_dir, start=query_start, end=query_end, peer=query_peer, prefix=query_prefix, stats=stats):
+            print(record)
+        print(f'INFO: {stats["records"]} records found in {stats["blocks"]} blocks of {stats["segments"]} archive segments')
+        return
+    # Backfill sends the records in parallel, aggregation needs them in order in a single process
+    if aggregate_seconds is not None and (aggregate_seconds <= 0 or backfill):
+        print ('ERROR: --aggregate needs a positive number of seconds, and cannot be used with --backfill')
+        sys.exit(2)
+    # The benchmark only reads the MRT file, it does not need the Azure Key Vault
+    if benchmark:
+        benchmark_flatten(mrt_file)
+        return
     # Print vault name
     if (akv_name == None):
-        print ('Options: -v <azure_key_vault_name> -f <mrt_file_name>')
+        print (usage)
         sys.exit()
     else:
         print ('INFO: Getting configuration from Azure Key Vault', akv_name)
     # Get secrets
-    akv_uri = f"https://{akv_name}.vault.azure.net"
-    credential = DefaultAzureCredential()
-    client = SecretClient(vault_url=akv_uri, credential=credential)
-    logws_id = client.get_secret('bgp-logws-id').value
-    logws_key = client.get_secret('bgp-logws-key').value
+    if get_secret is not None:
+        secrets = get_secret.get_secrets(akv_name, ['bgp-logws-id', 'bgp-logws-key'])
+        if len(secrets) < 2:
+            sys.exit(1)
+        logws_id = secrets['bgp-logws-id']
+        logws_key = secrets['bgp-logws-key']
+    else:
+        akv_uri = f"https://{akv_name}.vault.azure.net"
+        credential = DefaultAzureCredential()
+        client = SecretClient(vault_url=akv_uri, credential=credential)
+        logws_id = client.get_secret('bgp-logws-id').value
+        logws_key = client.get_secret('bgp-logws-key').value
 
     # Debug: print configuration
     print('INFO: Log Analytics workspace is', logws_id, 'and key is', logws_key)
 
+    archive = None
+    if archive_dir is not None and not dry_run and not backfill:
+        archive = ArchiveWriter(archive_dir, max_bytes=int(archive_mb * 1024 * 1024), max_age=archive_days * 86400)
+
+    if backfill:
+        if not run_backfill(mrt_file, logws_id, logws_key, workers=workers, range_bytes=int(range_mb * 1024 * 1024), batch_bytes=int(batch_mb * 1024 * 1024),
+                            max_in_flight=max_in_flight, compress=compress, dry_run=dry_run):
+            sys.exit(1)
+    elif daemon:
+        aggregator = RouteAggregator.load(rib_file, aggregate_seconds) if aggregate_seconds is not None else None
+        run_daemon(mrt_file, logws_id, logws_key, state_file=state_file, rotate_bytes=int(rotate_mb * 1024 * 1024), rotate_keep=rotate_keep, reopen_command=reopen_command,
+                   batch_bytes=int(batch_mb * 1024 * 1024), max_in_flight=max_in_flight, compress=compress, dry_run=dry_run, aggregator=aggregator, rib_file=rib_file,
+                   archive=archive)
     # Only do something if file is actually not empty
-    if os.stat(mrt_file).st_size > 0:
+    elif os.stat(mrt_file).st_size > 0:
 
         # Move mrt_file to temp_mrt_file, and append it to the consolidated_mrt_file
         os.system(f'cat {mrt_file} >{temp_mrt_file}')
         os.system(f'> {mrt_file}')
         os.system(f'cat {temp_mrt_file} >> {consolidated_mrt_file}')
 
-        # Analyze temp MRT file and dump JSON into a flattened string variable
-        body='['
-        entry_no = 0
-        keepalive_no = 0
-        for entry in mrtparse.Reader(temp_mrt_file):
-            entry_no += 1
-            # Do not log keepalives
-            add_entry = True
-            try:
-                if entry.data['bgp_message']['type'][1] == 'KEEPALIVE':
-                    add_entry = send_keepalives
-                    keepalive_no += 1
-            except:
-                pass
-            if add_entry:
-                bgp_entry=flatten(entry.data)
-                bgp_entry['raw']=str(json.dumps(entry.data))   # Add raw JSON for troubleshooting
-                if dry_run:
-                    print(bgp_entry)
-                # First run
-                if body == '[':
-                    body += json.dumps(bgp_entry)
-                # After the first run, append a comma and a line break to keep JSON syntax
-                else:
-                    body += ',\n'
-                    body += json.dumps(bgp_entry)
-        body += ']'
-
-        if dry_run:
-            # Print the JSON variable
-            # print('INFO: Dry-run mode. Data to send:')
-            # print(body)
-            print(f'INFO: {entry_no} BGP messages analyzed, out of which {keepalive_no} were keepalives')
+        if aggregate_seconds is not None:
+            # Aggregate the temp MRT file into the RIBs of the previous run, and send the summaries of the intervals closed since then
+            # The summaries that cannot be sent are saved in the RIB file, and sent again by the next run
+            aggregator = RouteAggregator.load(rib_file, aggregate_seconds)
+            if not process_mrt_summaries(temp_mrt_file, aggregator, logws_id, logws_key, int(batch_mb * 1024 * 1024), max_in_flight=max_in_flight, compress=compress, dry_run=dry_run,
+                                         archive=archive):
+                print(f'WARNING: {len(aggregator.pending_summaries)} interval summaries saved in {rib_file}, they will be sent again by the next run')
+            if not dry_run:
+                aggregator.save(rib_file)
         else:
-            # Send message to Azure Monitor
-            post_data(logws_id, logws_key, body, log_type)
+            # Analyze temp MRT file and stream the flattened records into batches of JSON arrays
+            process_mrt_records(temp_mrt_file, logws_id, logws_key, int(batch_mb * 1024 * 1024), max_in_flight=max_in_flight, compress=compress, dry_run=dry_run,
+                                archive=archive)
+        if archive is not None:
+            archive.flush()
     else:
         print (f'INFO: MRT file {mrt_file} is empty, not sending any logs')
 
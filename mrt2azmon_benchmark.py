@@ -0,0 +1,373 @@
+#!/usr/bin/python3
+# Offline benchmark suite for mrt2azmon.py
+# A local stand-in for the Azure Monitor Data Collector API validates every request like the real API does (SharedKey
+# signature, Log-Type header, JSON array of records), and can add latency and inject throttling (429) and server errors
+# (5xx). Synthetic MRT files (UPDATE storms, keepalive-heavy sessions) are replayed end to end through mrt2azmon.py,
+# each scenario in a separate process, reporting records/sec, bytes/record and peak memory.
+import argparse
+import base64
+import email.utils
+import gzip
+import http.server
+import ipaddress
+import json
+import os
+import random
+import re
+import resource
+import statistics
+import struct
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mrt2azmon
+
+# Workspace ID and key accepted by the stand-in server
+workspace_id = '00000000-0000-0000-0000-000000000000'
+workspace_key = base64.b64encode(b'mrt2azmon-benchmark-shared-key').decode()
+
+# Get input arguments
+parser = argparse.ArgumentParser(description='Offline benchmark suite for mrt2azmon', prog='mrt2azmon_benchmark')
+subparsers = parser.add_subparsers(dest='command', help='Command help')
+# Create the 'run' command
+run_parser = subparsers.add_parser('run', help='Replay synthetic MRT files through mrt2azmon.py against a local stand-in of the Data Collector API')
+run_parser.add_argument('--scenarios', dest='scenarios', metavar= 'SCENARIOS', action='store', default='update-storm,keepalive-heavy',
+                    help='Comma-separated MRT scenarios to replay (default: update-storm,keepalive-heavy)')
+run_parser.add_argument('--modes', dest='modes', metavar= 'MODES', action='store', default='messages,messages-no-raw,aggregate',
+                    help='Comma-separated mrt2azmon.py modes to benchmark: messages, messages-no-raw, aggregate (default: all)')
+run_parser.add_argument('--records', dest='records', metavar= 'N', action='store', type=int, default=20000,
+                    help='Number of MRT records of each synthetic file (default: 20000)')
+run_parser.add_argument('--repeat', dest='repeat', metavar= 'N', action='store', type=int, default=3,
+                    help='Number of timed runs per scenario, the median is reported (default: 3)')
+run_parser.add_argument('--batch-mb', dest='batch_mb', metavar= 'MB', action='store', type=float, default=mrt2azmon.default_batch_mb,
+                    help='Maximum size of the batches sent (default: {0})'.format(mrt2azmon.default_batch_mb))
+run_parser.add_argument('--max-in-flight', dest='max_in_flight', metavar= 'N', action='store', type=int, default=mrt2azmon.default_max_in_flight,
+                    help='Maximum number of batches sent at the same time (default: {0})'.format(mrt2azmon.default_max_in_flight))
+# Create the 'serve' command
+serve_parser = subparsers.add_parser('serve', help='Run the stand-in Data Collector API, to use with mrt2azmon.py --endpoint')
+serve_parser.add_argument('--port', dest='port', metavar= 'PORT', action='store', type=int, default=8080,
+                    help='Port to listen on (default: 8080)')
+# Create the 'generate' command
+generate_parser = subparsers.add_parser('generate', help='Write a synthetic MRT file')
+generate_parser.add_argument('--scenario', dest='scenario', metavar= 'SCENARIO', action='store', default='update-storm',
+                    help='MRT scenario: update-storm or keepalive-heavy (default: update-storm)')
+generate_parser.add_argument('--records', dest='records', metavar= 'N', action='store', type=int, default=20000,
+                    help='Number of MRT records (default: 20000)')
+generate_parser.add_argument('--output', '-o', dest='output', metavar= 'FILE', action='store', required=True,
+                    help='MRT file to write')
+# Fault injection settings, common to the 'run' and 'serve' commands
+for fault_parser in (run_parser, serve_parser):
+    fault_parser.add_argument('--latency-ms', dest='latency_ms', metavar= 'MS', action='store', type=int, default=20,
+                        help='Latency added by the stand-in server to every request, to simulate the round-trip time (default: 20)')
+    fault_parser.add_argument('--throttle-rate', dest='throttle_rate', metavar= 'RATE', action='store', type=float, default=0.0,
+                        help='Fraction of requests answered with 429 Too Many Requests (default: 0)')
+    fault_parser.add_argument('--error-rate', dest='error_rate', metavar= 'RATE', action='store', type=float, default=0.0,
+                        help='Fraction of requests answered with 503 Service Unavailable (default: 0)')
+    fault_parser.add_argument('--retry-after', dest='retry_after', metavar= 'SECONDS', action='store', type=int, default=1,
+                        help='Retry-After header of the 429 responses (default: 1)')
+# Internal command to run a single scenario in a separate process
+scenario_parser = subparsers.add_parser('run-scenario')
+scenario_parser.add_argument('--mrt-file', dest='mrt_file', action='store', required=True)
+scenario_parser.add_argument('--endpoint', dest='endpoint', action='store', required=True)
+scenario_parser.add_argument('--mode', dest='mode', action='store', required=True)
+scenario_parser.add_argument('--repeat', dest='repeat', action='store', type=int, default=3)
+scenario_parser.add_argument('--batch-mb', dest='batch_mb', action='store', type=float, default=mrt2azmon.default_batch_mb)
+scenario_parser.add_argument('--max-in-flight', dest='max_in_flight', action='store', type=int, default=mrt2azmon.default_max_in_flight)
+
+#############
+# MRT files #
+#############
+
+# Returns the NLRI encoding of a prefix
+def encode_prefix(prefix):
+    network = ipaddress.ip_network(prefix)
+    return bytes([network.prefixlen]) + network.network_address.packed[:(network.prefixlen + 7) // 8]
+
+# Returns a BGP UPDATE message announcing IPv4 and IPv6 prefixes (with MP_REACH_NLRI) with an AS path, and withdrawing IPv4 prefixes
+def encode_update(announced=(), announced_v6=(), withdrawn=(), as_path=()):
+    attributes = b''
+    if announced or announced_v6:
+        attributes += bytes([0x40, 1, 1, 0])
+        segment = bytes([2, len(as_path)]) + b''.join(struct.pack('!I', asn) for asn in as_path)
+        attributes += bytes([0x40, 2, len(segment)]) + segment
+        if announced:
+            attributes += bytes([0x40, 3, 4]) + ipaddress.ip_address('192.0.2.1').packed
+        if announced_v6:
+            value = struct.pack('!HBB', 2, 1, 16) + ipaddress.ip_address('2001:db8::1').packed + b'\x00' + b''.join(encode_prefix(prefix) for prefix in announced_v6)
+            attributes += bytes([0x90, 14]) + struct.pack('!H', len(value)) + value
+    withdrawn_routes = b''.join(encode_prefix(prefix) for prefix in withdrawn)
+    body = struct.pack('!H', len(withdrawn_routes)) + withdrawn_routes + struct.pack('!H', len(attributes)) + attributes + b''.join(encode_prefix(prefix) for prefix in announced)
+    return b'\xff' * 16 + struct.pack('!HB', 19 + len(body), 2) + body
+
+# Returns a BGP KEEPALIVE message
+def encode_keepalive():
+    return b'\xff' * 16 + struct.pack('!HB', 19, 4)
+
+# Returns a BGP4MP_MESSAGE_AS4 MRT record with a BGP message of a peer, or a BGP4MP_STATE_CHANGE_AS4 record if states are given
+def encode_mrt_record(timestamp, peer_ip, peer_as, message=None, states=None):
+    data = struct.pack('!IIHH', peer_as, 65000, 0, 1) + ipaddress.ip_address(peer_ip).packed + ipaddress.ip_address('192.0.2.254').packed
+    if states is not None:
+        data += struct.pack('!HH', *states)
+        return struct.pack('!IHHI', timestamp, 16, 5, len(data)) + data
+    data += message
+    return struct.pack('!IHHI', timestamp, 16, 4, len(data)) + data
+
+# Writes a synthetic MRT file, as dumped by BIRD:
+# - update-storm: 4 peers re-announcing and withdrawing batches of up to 20 prefixes from a pool of 20000, some IPv6
+# - keepalive-heavy: 40 peers mostly sending keepalives, with a few updates and session flaps
+def generate_mrt_file(path, scenario, records=20000, seed=0):
+    rnd = random.Random(seed)
+    timestamp = 1700000000
+    with open(path, 'wb') as f:
+        for record_no in range(records):
+            if scenario == 'update-storm':
+                peer_no = rnd.randrange(4)
+                timestamp += rnd.random() < 0.05
+                prefixes = ['10.{0}.{1}.0/24'.format(*divmod(rnd.randrange(20000), 256)) for _ in range(rnd.randint(1, 20))]
+                if rnd.random() < 0.3:
+                    message = encode_update(withdrawn=prefixes)
+                elif rnd.random() < 0.1:
+                    message = encode_update(announced_v6=['2001:db8:{0:x}::/48'.format(rnd.randrange(4096)) for _ in range(rnd.randint(1, 5))], as_path=[65001 + peer_no, 3356, 174])
+                else:
+                    message = encode_update(announced=prefixes, as_path=[65001 + peer_no] + [rnd.randrange(64512, 65000) for _ in range(rnd.randint(1, 5))])
+                f.write(encode_mrt_record(timestamp, f'192.0.2.{peer_no + 1}', 65001 + peer_no, message))
+            elif scenario == 'keepalive-heavy':
+                peer_no = record_no % 40
+                timestamp += record_no % 40 == 0
+                draw = rnd.random()
+                if draw < 0.9:
+                    f.write(encode_mrt_record(timestamp, f'192.0.2.{peer_no + 1}', 65001 + peer_no, encode_keepalive()))
+                elif draw < 0.99:
+                    message = encode_update(announced=['10.{0}.{1}.0/24'.format(*divmod(rnd.randrange(2000), 256))], as_path=[65001 + peer_no, 3356])
+                    f.write(encode_mrt_record(timestamp, f'192.0.2.{peer_no + 1}', 65001 + peer_no, message))
+                else:
+                    f.write(encode_mrt_record(timestamp, f'192.0.2.{peer_no + 1}', 65001 + peer_no, states=(6, 1) if rnd.random() < 0.5 else (5, 6)))
+            else:
+                raise ValueError("unknown scenario '{0}'".format(scenario))
+
+###############################
+# Data Collector API stand-in #
+###############################
+
+# HTTP handler validating the requests of the Data Collector API, with optional latency, throttling and server errors
+class DataCollectorStandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if server.latency_ms > 0:
+            time.sleep(server.latency_ms / 1000)
+        with server.lock:
+            server.counters['requests'] += 1
+            draw = server.random.random()
+        if draw < server.throttle_rate:
+            self.respond(429, 'throttled', headers={'Retry-After': str(server.retry_after)})
+            return
+        if draw < server.throttle_rate + server.error_rate:
+            self.respond(503, 'server_errors')
+            return
+        status, error, records = self.validate(body)
+        if error is not None:
+            with server.lock:
+                server.rejections[error] = server.rejections.get(error, 0) + 1
+            self.respond(status, 'rejected', message=error)
+            return
+        with server.lock:
+            server.counters['records'] += records
+            server.counters['bytes'] += len(body)
+        self.respond(200, 'accepted')
+
+    # Returns the status, the error (None if the request is valid) and the number of records of a request
+    def validate(self, body):
+        server = self.server
+        url = urllib.parse.urlparse(self.path)
+        if url.path != '/api/logs' or urllib.parse.parse_qs(url.query).get('api-version') != ['2016-04-01']:
+            return 404, 'NotFound', 0
+        if not re.fullmatch(r'[A-Za-z0-9_]{1,100}', self.headers.get('Log-Type', '')):
+            return 400, 'InvalidLogType', 0
+        if self.headers.get('content-type') != 'application/json':
+            return 400, 'InvalidContentType', 0
+        date = self.headers.get('x-ms-date', '')
+        try:
+            skew = abs(time.time() - email.utils.parsedate_to_datetime(date).timestamp())
+        except (TypeError, ValueError):
+            return 403, 'InvalidDate', 0
+        if skew > 900:
+            return 403, 'InvalidDate', 0
+        # The signature covers the length of the body as sent, compressed or not
+        expected = mrt2azmon.build_signature(server.customer_id, server.shared_key, date, len(body), 'POST', 'application/json', '/api/logs')
+        if self.headers.get('Authorization') != expected:
+            return 403, 'InvalidAuthorization', 0
+        if len(body) > 30 * 1024 * 1024:
+            return 413, 'RequestTooLarge', 0
+        if self.headers.get('Content-Encoding') == 'gzip':
+            try:
+                body = gzip.decompress(body)
+            except (OSError, EOFError):
+                return 400, 'InvalidContentEncoding', 0
+        try:
+            records = json.loads(body)
+        except ValueError:
+            return 400, 'InvalidJson', 0
+        if isinstance(records, dict):
+            records = [records]
+        if not isinstance(records, list) or len(records) == 0 or not all(isinstance(record, dict) for record in records):
+            return 400, 'InvalidDataFormat', 0
+        return 200, None, len(records)
+
+    def respond(self, status, counter, headers=None, message=None):
+        body = json.dumps({'Error': message}).encode('utf-8') if message else b''
+        with self.server.lock:
+            self.server.counters[counter] += 1
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *log_args):
+        pass
+
+# Threaded HTTP server with a listen backlog large enough for the parallel batches of mrt2azmon.py
+class StandInHTTPServer(http.server.ThreadingHTTPServer):
+    request_queue_size = 128
+
+# Starts the stand-in server in a background thread (on a free local port if port is 0)
+def start_stand_in_server(port=0, latency_ms=20, throttle_rate=0.0, error_rate=0.0, retry_after=1):
+    server = StandInHTTPServer(('127.0.0.1', port), DataCollectorStandInHandler)
+    server.daemon_threads = True
+    server.customer_id = workspace_id
+    server.shared_key = workspace_key
+    server.latency_ms = latency_ms
+    server.throttle_rate = throttle_rate
+    server.error_rate = error_rate
+    server.retry_after = retry_after
+    server.random = random.Random(0)
+    server.lock = threading.Lock()
+    server.counters = {'requests': 0, 'accepted': 0, 'rejected': 0, 'throttled': 0, 'server_errors': 0, 'records': 0, 'bytes': 0}
+    server.rejections = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+#############
+# Scenarios #
+#############
+
+# Sends the records (or the interval summaries in aggregate mode) of an MRT file to the endpoint once, returning the statistics
+def replay_mrt_file(mrt_file, mode, batch_bytes, max_in_flight):
+    stats = {'entries': 0, 'keepalives': 0}
+    if mode == 'aggregate':
+        aggregator = mrt2azmon.RouteAggregator(300)
+        summaries = []
+        for entry in mrt2azmon.mrtparse.Reader(mrt_file):
+            stats['entries'] += 1
+            summaries += aggregator.add(entry.data, mrt2azmon.get_entry_timestamp(entry))
+        summaries += aggregator.flush()
+        send_stats = mrt2azmon.send_batches(workspace_id, workspace_key, mrt2azmon.iter_batches(summaries, batch_bytes), mrt2azmon.summary_log_type, max_in_flight=max_in_flight)
+    else:
+        mrt2azmon.set_raw_mode('none' if mode == 'messages-no-raw' else 'all')
+        batches = mrt2azmon.iter_batches(mrt2azmon.iter_log_records(mrt_file, stats), batch_bytes)
+        send_stats = mrt2azmon.send_batches(workspace_id, workspace_key, batches, mrt2azmon.log_type, max_in_flight=max_in_flight)
+    send_stats.update(stats)
+    return send_stats
+
+# Returns the peak RSS of this process in KB. VmHWM is used when available, since ru_maxrss keeps the peak RSS of the
+# parent process from before the fork of the subprocess.
+def get_peak_rss_kb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# Replays an MRT file repeat times (plus one run under tracemalloc) and prints its measurements as JSON
+def run_scenario(mrt_file, endpoint, mode, repeat=3, batch_mb=mrt2azmon.default_batch_mb, max_in_flight=mrt2azmon.default_max_in_flight):
+    mrt2azmon.data_collector_endpoint = endpoint
+    batch_bytes = int(batch_mb * 1024 * 1024)
+    elapsed = []
+    for _ in range(max(repeat, 1)):
+        start_time = time.perf_counter()
+        send_stats = replay_mrt_file(mrt_file, mode, batch_bytes, max_in_flight)
+        elapsed.append(time.perf_counter() - start_time)
+    # Memory is traced in a separate run, since tracemalloc slows everything down
+    tracemalloc.start()
+    replay_mrt_file(mrt_file, mode, batch_bytes, max_in_flight)
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    send_stats.update({'elapsed': elapsed, 'peak_rss_kb': get_peak_rss_kb(), 'traced_peak_bytes': traced_peak})
+    print(json.dumps(send_stats))
+
+# Replays all scenarios and modes against a stand-in server, each in a separate process, and prints a results table
+def run_benchmark(scenarios, modes, records=20000, repeat=3, batch_mb=mrt2azmon.default_batch_mb, max_in_flight=mrt2azmon.default_max_in_flight,
+                  latency_ms=20, throttle_rate=0.0, error_rate=0.0, retry_after=1):
+    import tempfile
+    temp_dir = tempfile.TemporaryDirectory()
+    server = start_stand_in_server(latency_ms=latency_ms, throttle_rate=throttle_rate, error_rate=error_rate, retry_after=retry_after)
+    endpoint = "http://{0}:{1}".format(server.server_address[0], server.server_address[1])
+    print("INFO: stand-in Data Collector API at {0} with {1} ms latency, {2:.0%} throttling and {3:.0%} server errors".format(endpoint, latency_ms, throttle_rate, error_rate))
+    print(f"{'Scenario':<16} {'Mode':<16} {'MRT records':>11} {'Sent':>7} {'Median (s)':>10} {'MRT rec/sec':>11} {'JSON B/rec':>10} {'Sent B/rec':>10} "
+          f"{'Requests':>8} {'429':>5} {'5xx':>5} {'Peak RSS (MB)':>14} {'Traced peak (MB)':>17}")
+    print("-" * 152)
+    for scenario in scenarios:
+        mrt_file = os.path.join(temp_dir.name, scenario + '.mrt')
+        generate_mrt_file(mrt_file, scenario, records=records)
+        for mode in modes:
+            with server.lock:
+                counters_before = dict(server.counters)
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), 'run-scenario', '--mrt-file', mrt_file, '--endpoint', endpoint, '--mode', mode,
+                                     '--repeat', str(repeat), '--batch-mb', str(batch_mb), '--max-in-flight', str(max_in_flight)], capture_output=True, text=True)
+            if output.returncode != 0:
+                print("ERROR: scenario '{0}' in mode '{1}' failed: {2}".format(scenario, mode, output.stderr.strip().splitlines()[-1] if output.stderr.strip() else output.returncode))
+                continue
+            result = json.loads(output.stdout.strip().splitlines()[-1])
+            with server.lock:
+                counters = {key: (value - counters_before[key]) / (max(repeat, 1) + 1) for key, value in server.counters.items()}
+            median = statistics.median(result['elapsed'])
+            sent = max(result['records'], 1)
+            print(f"{scenario:<16} {mode:<16} {result['entries']:>11} {result['records']:>7} {median:>10.2f} {result['entries'] / median:>11.0f} {result['bytes'] / sent:>10.0f} "
+                  f"{result['bytes_sent'] / sent:>10.1f} {counters['requests']:>8.1f} {counters['throttled']:>5.1f} {counters['server_errors']:>5.1f} "
+                  f"{result['peak_rss_kb'] / 1024:>14.1f} {result['traced_peak_bytes'] / 1048576:>17.1f}")
+            if result['failed_batches'] > 0:
+                print("ERROR: {0} batches with {1} records were not accepted".format(result['failed_batches'], result['failed_records']))
+    if server.rejections:
+        print("ERROR: requests rejected by the stand-in server: {0}".format(', '.join(f'{error} ({count})' for error, count in sorted(server.rejections.items()))))
+    server.shutdown()
+    temp_dir.cleanup()
+
+################
+# Main program #
+################
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.command == 'run':
+        run_benchmark([s.strip() for s in args.scenarios.split(',') if s.strip()], [m.strip() for m in args.modes.split(',') if m.strip()], records=args.records, repeat=args.repeat,
+                      batch_mb=args.batch_mb, max_in_flight=args.max_in_flight, latency_ms=args.latency_ms, throttle_rate=args.throttle_rate, error_rate=args.error_rate,
+                      retry_after=args.retry_after)
+    elif args.command == 'serve':
+        server = start_stand_in_server(port=args.port, latency_ms=args.latency_ms, throttle_rate=args.throttle_rate, error_rate=args.error_rate, retry_after=args.retry_after)
+        print("INFO: stand-in Data Collector API listening on http://{0}:{1}, workspace ID {2} and key {3}".format(server.server_address[0], server.server_address[1], workspace_id, workspace_key))
+        try:
+            while True:
+                time.sleep(10)
+                with server.lock:
+                    print("INFO: {0}, rejections: {1}".format(json.dumps(server.counters), json.dumps(server.rejections)))
+        except KeyboardInterrupt:
+            server.shutdown()
+    elif args.command == 'generate':
+        generate_mrt_file(args.output, args.scenario, records=args.records)
+        print("INFO: {0} records of scenario '{1}' written to {2}".format(args.records, args.scenario, args.output))
+    elif args.command == 'run-scenario':
+        run_scenario(args.mrt_file, args.endpoint, args.mode, repeat=args.repeat, batch_mb=args.batch_mb, max_in_flight=args.max_in_flight)
+    else:
+        parser.print_help()
@@ -1,10 +1,14 @@
 import os
+import asyncio
+import contextlib
+import hashlib
 import socket, struct
 import sys
+import threading
 import time
 import warnings
 import requests
-from flask import Flask
+from flask import Flask, Request, Response
 from flask import request
 from flask import jsonify
 
@@ -29,22 +33,251 @@ def get_ip(d):
     except Exception:
         return False
 
+# Get IP for a DNS name, without blocking the event loop of the ASGI app
+async def get_ip_async(d):
+    try:
+        addresses = await asyncio.get_running_loop().getaddrinfo(d, None, family=socket.AF_INET, type=socket.SOCK_STREAM)
+        return addresses[0][4][0]
+    except Exception:
+        return False
+
+# Uploads are read in chunks of this size, and downloads sent in chunks of this size out of a buffer allocated once
+# The buffer has random bytes, so that compression by proxies or firewalls does not change the measured throughput
+upload_chunk_size = 256 * 1024
+download_chunk_size = 1024 * 1024
+download_buffer = os.urandom(download_chunk_size)
+
+# Counts the bytes of an upload as it is received, and optionally computes its SHA-256, without storing it
+# It is also the file object Flask writes uploaded files to (see StreamingRequest), so it has the methods it uses
+class UploadCounter:
+    def __init__(self, sha256=False):
+        self.size = 0
+        self.sha256 = hashlib.sha256() if sha256 else None
+
+    def write(self, data):
+        self.size += len(data)
+        if self.sha256 is not None:
+            self.sha256.update(data)
+        return len(data)
+
+    def seek(self, *args):
+        return 0
+
+    def read(self, *args):
+        return b''
+
+    # Returns the answer of /api/filesize, with the throughput since started_at (time.perf_counter())
+    def get_result(self, started_at):
+        elapsed = time.perf_counter() - started_at
+        msg = {
+            'size': self.size,
+            'elapsed_seconds': round(elapsed, 6),
+            'throughput_mbps': round(self.size * 8 / elapsed / 1000000, 3) if elapsed > 0 else None
+        }
+        if self.sha256 is not None:
+            msg['sha256'] = self.sha256.hexdigest()
+        return msg
+
+# Flask request whose uploaded files are counted instead of being stored in memory or in temporary files
+class StreamingRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return UploadCounter(sha256=is_true(self.args.get('sha256')))
+
+# Returns True for query parameters like ?sha256=true or ?sha256=1
+def is_true(value):
+    return value is not None and value.lower() in ('1', 'true', 'yes')
+
+# Parses a size in bytes, with an optional K, M or G suffix (powers of 1024), up to max_size bytes if specified
+# Raises ValueError with a message for the client if the size is missing, not valid or too large
+def parse_size(value, max_size=None):
+    if value is None or value.strip() == '':
+        raise ValueError('size is required, for example ?size=10M')
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    number = value.strip().upper()
+    multiplier = 1
+    if number[-1:] in units:
+        multiplier = units[number[-1]]
+        number = number[:-1]
+    if not (number.isascii() and number.isdigit()):
+        raise ValueError(f"size must be a number of bytes with an optional K, M or G suffix (for example ?size=10M), not '{value}'")
+    size = int(number) * multiplier
+    if max_size is not None and size > max_size:
+        raise ValueError(f'size cannot be larger than {max_size} bytes')
+    return size
+
+# Downloads larger than this (DOWNLOAD_MAX_SIZE, with an optional K, M or G suffix) are refused, since the buffer would be
+# sent over and over for too long
+download_max_size = parse_size(os.environ.get('DOWNLOAD_MAX_SIZE', '10G'))
+
+# Yields size bytes out of buffer (the download buffer, or a memoryview of it). Full chunks are the buffer itself, and
+# only the last one is a slice of it (which does not copy it if it is a memoryview)
+def iter_download(size, buffer=download_buffer):
+    full_chunks, remainder = divmod(size, len(buffer))
+    for _ in range(full_chunks):
+        yield buffer
+    if remainder > 0:
+        yield buffer[:remainder]
+
+# Headers of /api/download
+def get_download_headers(size):
+    return {
+        'Content-Length': str(size),
+        'Content-Disposition': 'attachment; filename="download.bin"',
+        'Cache-Control': 'no-store'
+    }
+
 app = Flask(__name__)
+app.request_class = StreamingRequest
+
+# Results cached in memory: {key: (file stamp, time, result)}
+cache = {}
+cache_lock = threading.Lock()
+# TTL of the results that do not depend on a file, or depend on a file in /proc (whose modification time does not change)
+cache_ttl = 5
+private_ip_ttl = 60
+
+# Returns the cached result of compute() for a key. If it is computed from a file, the result is computed again when the
+# file changes (modification time, size or inode), otherwise (or for files in /proc) when it is older than ttl seconds.
+def get_cached_result(key, compute, path=None, ttl=cache_ttl):
+    now = time.monotonic()
+    stamp = None
+    if path is not None and not path.startswith('/proc/'):
+        try:
+            stat = os.stat(path)
+            stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        except OSError:
+            pass
+    with cache_lock:
+        entry = cache.get(key)
+    if entry is not None and entry[0] == stamp and (stamp is not None or now - entry[1] < ttl):
+        return entry[2]
+    result = compute()
+    with cache_lock:
+        cache[key] = (stamp, now, result)
+    return result
+
+# Caches the public IP address, refreshed in the background every ttl seconds. Requests get the cached address even
+# if it is older than the TTL (stale-while-revalidate), and only wait (at most timeout seconds) if there is none yet.
+# Failures are retried after retry_interval seconds, so blocked egress does not slow down requests.
+class PublicIPCache:
+    def __init__(self, url, ttl=300, timeout=2, retry_interval=30):
+        self.url = url
+        self.ttl = ttl
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.value = None
+        self.error = None
+        self.fetched_at = None
+        self.attempted_at = None
+        self.lock = threading.Lock()
+        self.refreshing = False
+        self.refreshed = threading.Event()
+
+    # Stores the JSON answer of the URL, or the error if it could not be fetched
+    def store(self, mypip_json=None, error=None):
+        with self.lock:
+            if error is None:
+                try:
+                    self.value = mypip_json['ip']
+                except:
+                    self.value = "Could not extract public IP from JSON: " + str(mypip_json)
+                self.error = None
+                self.fetched_at = time.monotonic()
+            else:
+                self.error = "Could not get public IP from " + self.url + ": " + str(error)
+            self.attempted_at = time.monotonic()
+        self.refreshed.set()
+
+    # Gets the public IP address from the URL, and returns True if it worked
+    def refresh(self):
+        with self.lock:
+            if self.refreshing:
+                return False
+            self.refreshing = True
+        try:
+            self.store(requests.get(self.url, timeout=self.timeout).json())
+            return True
+        except Exception as e:
+            self.store(error=e)
+            return False
+        finally:
+            with self.lock:
+                self.refreshing = False
 
-# Get IP addresses of DNS servers
+    # Same as refresh, with the async HTTP client of the ASGI app
+    async def refresh_async(self, client):
+        try:
+            response = await client.get(self.url, timeout=self.timeout)
+            self.store(response.json())
+            return True
+        except Exception as e:
+            self.store(error=e)
+            return False
+
+    # Refreshes the address every ttl seconds in the event loop of the ASGI app, after a first refresh that returned refreshed
+    async def refresh_forever_async(self, client, refreshed):
+        while True:
+            await asyncio.sleep(self.ttl if refreshed else self.retry_interval)
+            refreshed = await self.refresh_async(client)
+
+    # Refreshes the address in a background thread, until the process ends
+    def start(self):
+        def refresh_forever():
+            while True:
+                time.sleep(self.ttl if self.refresh() else self.retry_interval)
+        threading.Thread(target=refresh_forever, daemon=True).start()
+
+    # Returns the cached address (or the last error if there is none), refreshing it in the background if it is stale
+    # If blocking is False it never waits nor refreshes, the ASGI app refreshes the address in its event loop instead
+    def get(self, blocking=True):
+        with self.lock:
+            value, error, fetched_at, attempted_at = self.value, self.error, self.fetched_at, self.attempted_at
+        now = time.monotonic()
+        if not blocking:
+            return value if value is not None else error
+        if value is None:
+            if attempted_at is None:
+                # No answer yet: run the first refresh (the app may be served without start(), e.g. by a WSGI server),
+                # or wait for the one in progress
+                if not self.refresh():
+                    self.refreshed.wait(self.timeout)
+            elif now - attempted_at >= self.retry_interval:
+                self.refresh()
+            with self.lock:
+                return self.value if self.value is not None else self.error
+        if now - fetched_at >= self.ttl and (attempted_at is None or now - attempted_at >= self.retry_interval):
+            threading.Thread(target=self.refresh, daemon=True).start()
+        return value
+
+public_ip_cache = PublicIPCache(os.environ.get('PUBLIC_IP_URL', 'http://jsonip.com'), ttl=int(os.environ.get('PUBLIC_IP_TTL', 300)),
+                                timeout=float(os.environ.get('PUBLIC_IP_TIMEOUT', 2)))
+
+# Get IP addresses of DNS servers, cached until /etc/resolv.conf changes
 def get_dns_ips():
+    return get_cached_result('dns_ips', read_dns_ips, path='/etc/resolv.conf')
+
+# Get IP addresses of DNS servers from /etc/resolv.conf
+def read_dns_ips():
     dns_ips = []
     with open('/etc/resolv.conf') as fp:
         for cnt, line in enumerate(fp):
             columns = line.split()
-            if columns[0] == 'nameserver':
+            if len(columns) > 1 and columns[0] == 'nameserver':
                 ip = columns[1:][0]
                 if is_valid_ipv4_address(ip):
                     dns_ips.append(ip)
     return dns_ips
 
-# Get default gateway
+# Get default gateway, cached for a few seconds
 def get_default_gateway():
+    return get_cached_result('default_gateway', read_default_gateway, path='/proc/net/route')
+
+# Get private IP address, from the name of the host
+def get_private_ip():
+    return get_cached_result('private_ip', lambda: get_ip(socket.gethostname()), ttl=private_ip_ttl)
+
+# Get default gateway
+def read_default_gateway():
     """Read the default gateway directly from /proc."""
     with open("/proc/net/route") as fh:
         for line in fh:
@@ -76,15 +309,21 @@ def healthcheck():
           return jsonify(str(e))
 
 # Route to uplode file and return file size
+# The file can be sent as the field 'data' of a form (curl -F data=@file) or as the body (curl --data-binary @file), it
+# is read in chunks and not stored. With ?sha256=true its SHA-256 is returned too.
 @app.route('/api/filesize', methods=['POST'])
 def getsize():
     try:
-      uploaded_file = request.files['data']
-      if uploaded_file:
-          f = uploaded_file.read()
-          msg = {
-             'size': len(f)
-          }
+      started_at = time.perf_counter()
+      if request.mimetype == 'multipart/form-data':
+          uploaded_file = request.files.get('data')
+          counter = uploaded_file.stream if uploaded_file else None
+      else:
+          counter = UploadCounter(sha256=is_true(request.args.get('sha256')))
+          for chunk in iter(lambda: request.stream.read(upload_chunk_size), b''):
+              counter.write(chunk)
+      if counter:
+          msg = counter.get_result(started_at)
       else:
          msg = {
              'size': 'unknown'
@@ -93,6 +332,19 @@ def getsize():
     except Exception as e:
         return jsonify(str(e))
 
+# Route to download N bytes (?size=N, with an optional K, M or G suffix), to measure throughput like an iperf server
+# A missing, invalid or too large size is answered with a 400 error
+@app.route('/api/download', methods=['GET'])
+def download():
+    try:
+        size = parse_size(request.args.get('size'), max_size=download_max_size)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        return Response(iter_download(size), mimetype='application/octet-stream', headers=get_download_headers(size), direct_passthrough=True)
+    except Exception as e:
+        return jsonify(str(e))
+
 # Flask route to provide the container's IP address
 @app.route("/api/dns", methods=['GET'])
 def dns():
@@ -113,14 +365,9 @@ def dns():
 def ip():
     if request.method == 'GET':
         try:
-            app.logger.info('Getting public IP address...')     # DEBUG
+            # app.logger.info('Getting public IP address...')   # DEBUG
             # url = 'http://ifconfig.co/json'
-            url = 'http://jsonip.com'
-            mypip_json = requests.get(url).json()
-            try:
-                mypip = mypip_json['ip']
-            except:
-                mypip = "Could not extract public IP from JSON: " + str(mypip_json)
+            mypip = public_ip_cache.get()
             app.logger.info('Getting X-Forwarded-For header...')        # DEBUG
             if request.headers.getlist("X-Forwarded-For"):
                 try:
@@ -150,7 +397,7 @@ def ip():
             except:
                 path_accessed = ""
             msg = {
-                'my_private_ip': get_ip(socket.gethostname()),
+                'my_private_ip': get_private_ip(),
                 'my_public_ip': mypip,
                 'my_dns_servers': dns_servers,
                 'my_default_gateway': default_gateway,
@@ -191,6 +438,223 @@ def curl():
         except Exception as e:
             return jsonify(str(e))
 
+##############
+# ASGI mode  #
+##############
+
+# Settings of the ASGI server, out of environment variables:
+# - WORKERS: number of worker processes (default: number of CPUs)
+# - KEEPALIVE_TIMEOUT: seconds an idle keep-alive connection is kept open. It should be longer than the idle timeout of the
+#   load balancer or reverse proxy in front (4 minutes for the Azure Load Balancer), so that they close idle connections
+#   first instead of sending requests on connections being closed
+# - GRACEFUL_TIMEOUT: seconds in-flight requests are given to complete after SIGTERM
+# - OUTBOUND_TIMEOUT: timeout of the outbound HTTP requests of /api/curl and /api/ip
+asgi_workers = int(os.environ.get('WORKERS', os.cpu_count() or 1))
+keepalive_timeout = int(os.environ.get('KEEPALIVE_TIMEOUT', 300))
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 30))
+outbound_timeout = float(os.environ.get('OUTBOUND_TIMEOUT', 10))
+
+# Returns an ASGI version of the Flask app, using Starlette, with non-blocking outbound requests over a shared pooled
+# httpx client. It can also be served by gunicorn: gunicorn -k uvicorn.workers.UvicornWorker 'myip:create_asgi_app()'
+def create_asgi_app():
+    import httpx
+    from starlette.applications import Starlette
+    from python_multipart.multipart import MultipartParser, parse_options_header
+    from starlette.responses import JSONResponse, StreamingResponse
+    from starlette.routing import Route
+    from werkzeug.user_agent import UserAgent
+
+    # The client is created when the worker starts and closed when it stops, and the public IP is refreshed meanwhile
+    @contextlib.asynccontextmanager
+    async def lifespan(asgi_app):
+        client = httpx.AsyncClient(timeout=httpx.Timeout(outbound_timeout, connect=min(outbound_timeout, 5)), follow_redirects=True,
+                                   limits=httpx.Limits(max_connections=200, max_keepalive_connections=50, keepalive_expiry=30))
+        asgi_app.state.client = client
+        refreshed = await public_ip_cache.refresh_async(client)
+        refresher = asyncio.create_task(public_ip_cache.refresh_forever_async(client, refreshed))
+        try:
+            yield
+        finally:
+            refresher.cancel()
+            await client.aclose()
+
+    # Route to print all HTTP headers
+    async def headers(request):
+        try:
+            return JSONResponse(dict(request.headers))
+        except Exception as e:
+            return JSONResponse(str(e))
+
+    # Route for healthchecks
+    async def healthcheck(request):
+        return JSONResponse({'health': 'OK'})
+
+    # Returns the counter of the file 'data' of a multipart upload, counted as it is received, or None if there is none
+    async def count_multipart_upload(request, sha256):
+        _, params = parse_options_header(request.headers.get('content-type'))
+        part = {'field': b'', 'value': b'', 'headers': {}, 'counter': None}
+        counters = []
+
+        def on_part_begin():
+            part.update(headers={}, counter=None)
+
+        def on_header_field(data, start, end):
+            part['field'] += data[start:end]
+
+        def on_header_value(data, start, end):
+            part['value'] += data[start:end]
+
+        def on_header_end():
+            part['headers'][part['field'].lower()] = part['value']
+            part.update(field=b'', value=b'')
+
+        def on_headers_finished():
+            _, options = parse_options_header(part['headers'].get(b'content-disposition', b''))
+            if options.get(b'name') == b'data' and b'filename' in options:
+                part['counter'] = UploadCounter(sha256)
+                counters.append(part['counter'])
+
+        def on_part_data(data, start, end):
+            if part['counter'] is not None:
+                part['counter'].write(memoryview(data)[start:end])
+
+        parser = MultipartParser(params.get(b'boundary'), {
+            'on_part_begin': on_part_begin,
+            'on_header_field': on_header_field,
+            'on_header_value': on_header_value,
+            'on_header_end': on_header_end,
+            'on_headers_finished': on_headers_finished,
+            'on_part_data': on_part_data,
+        })
+        async for chunk in request.stream():
+            parser.write(chunk)
+        parser.finalize()
+        return counters[0] if counters else None
+
+    # Route to uplode file and return file size, read in chunks like in the Flask route
+    async def getsize(request):
+        try:
+            started_at = time.perf_counter()
+            sha256 = is_true(request.query_params.get('sha256'))
+            if request.headers.get('content-type', '').startswith('multipart/form-data'):
+                counter = await count_multipart_upload(request, sha256)
+            else:
+                counter = UploadCounter(sha256)
+                async for chunk in request.stream():
+                    counter.write(chunk)
+            if counter:
+                msg = counter.get_result(started_at)
+            else:
+                msg = {
+                    'size': 'unknown'
+                }
+            return JSONResponse(msg)
+        except Exception as e:
+            return JSONResponse(str(e))
+
+    # Route to download N bytes, sent as slices of a memoryview of the download buffer, which are not copies
+    download_view = memoryview(download_buffer)
+
+    async def iter_download_async(size):
+        for chunk in iter_download(size, download_view):
+            yield chunk
+
+    async def download(request):
+        try:
+            size = parse_size(request.query_params.get('size'), max_size=download_max_size)
+        except ValueError as e:
+            return JSONResponse({'error': str(e)}, status_code=400)
+        try:
+            return StreamingResponse(iter_download_async(size), media_type='application/octet-stream', headers=get_download_headers(size))
+        except Exception as e:
+            return JSONResponse(str(e))
+
+    # Route to resolve a DNS name
+    async def dns(request):
+        try:
+            fqdn = request.query_params.get('fqdn')
+            msg = {
+                'fqdn': fqdn,
+                'ip': await get_ip_async(fqdn)
+            }
+            return JSONResponse(msg)
+        except Exception as e:
+            return JSONResponse(str(e))
+
+    # Route to provide the container's IP address
+    async def ip(request):
+        try:
+            forwarded_for = request.headers.getlist('x-forwarded-for')[0] if request.headers.getlist('x-forwarded-for') else None
+            user_agent = UserAgent(request.headers.get('user-agent', ''))
+            try:
+                dns_servers = str(get_dns_ips())
+            except:
+                dns_servers = ""
+            try:
+                default_gateway = str(get_default_gateway())
+            except:
+                default_gateway = ""
+            msg = {
+                'my_private_ip': get_private_ip(),
+                'my_public_ip': public_ip_cache.get(blocking=False),
+                'my_dns_servers': dns_servers,
+                'my_default_gateway': default_gateway,
+                'your_address': request.client.host if request.client else "",
+                'x-forwarded-for': forwarded_for,
+                'path_accessed': request.headers.get('host', '') + request.url.path,
+                'your_platform': str(user_agent.platform),
+                'your_browser': str(user_agent.browser),
+            }
+            return JSONResponse(msg)
+        except Exception as e:
+            return JSONResponse(str(e))
+
+    # Route to provide the container's environment variables
+    async def printenv(request):
+        try:
+            return JSONResponse(dict(os.environ))
+        except Exception as e:
+            return JSONResponse(str(e))
+
+    # Route to run a HTTP GET to a target URL and return the answer
+    async def curl(request):
+        try:
+            url = request.query_params.get('url')
+            if url == None:
+                url='http://jsonip.com'
+            response = await request.app.state.client.get(url)
+            msg = {
+                'url': url,
+                'method': 'GET',
+                'answer': response.text
+            }
+            return JSONResponse(msg)
+        except Exception as e:
+            return JSONResponse(str(e))
+
+    return Starlette(lifespan=lifespan, routes=[
+        Route('/api/headers', headers, methods=['GET']),
+        Route('/api/healthcheck', healthcheck, methods=['GET']),
+        Route('/api/filesize', getsize, methods=['POST']),
+        Route('/api/download', download, methods=['GET']),
+        Route('/api/dns', dns, methods=['GET']),
+        Route('/api/ip', ip, methods=['GET']),
+        Route('/api/printenv', printenv, methods=['GET']),
+        Route('/api/curl', curl, methods=['GET']),
+    ])
+
+# Runs the ASGI app with uvicorn and several worker processes. On SIGTERM, uvicorn stops accepting connections, lets
+# in-flight requests complete for up to graceful_timeout seconds, and closes the outbound client of each worker.
+def run_asgi(web_port):
+    try:
+        import uvicorn
+    except ImportError:
+        print("ERROR: the ASGI mode needs uvicorn, starlette and httpx (pip install uvicorn starlette httpx python-multipart)")
+        sys.exit(1)
+    print("Starting ASGI server with", asgi_workers, "workers")
+    uvicorn.run('myip:create_asgi_app', factory=True, host='0.0.0.0', port=int(web_port), workers=asgi_workers, backlog=2048,
+                timeout_keep_alive=keepalive_timeout, timeout_graceful_shutdown=graceful_timeout, access_log=False)
+
 # Gets the web port out of an environment variable, or defaults to 8080
 def get_web_port():
     web_port=os.environ.get('PORT')
@@ -201,11 +665,18 @@ def get_web_port():
         print("Port supplied as environment variable:", web_port)
     return web_port
 
-# Ignore warnings
-with warnings.catch_warnings():
-    warnings.simplefilter("ignore")
+if __name__ == "__main__":
+    # Ignore warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
 
-# Set web port
-web_port=get_web_port()
+    # Set web port
+    web_port=get_web_port()
 
-app.run(host='0.0.0.0', port=web_port, debug=True, use_reloader=False)
+    # WEB_SERVER=asgi runs the production ASGI server, otherwise the Flask development server is used
+    if os.environ.get('WEB_SERVER', 'flask') == 'asgi':
+        run_asgi(web_port)
+    else:
+        # Get the public IP address in the background
+        public_ip_cache.start()
+        app.run(host='0.0.0.0', port=web_port, debug=True, use_reloader=False)
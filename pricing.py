@@ -1,151 +1,823 @@
 #!/usr/bin/python
-from azure.mgmt.compute import ComputeManagementClient
-from azure.identity import DefaultAzureCredential
-import requests
+# Azure pricing CLI and library. Heavy dependencies (requests, numpy, the Azure SDK, asyncio and http.server)
+# are imported lazily by the functions that need them, to keep the startup time of each command low.
 import json
 import argparse
+import os
+import sys
+import csv
+import urllib.parse
+import re
+import time
+import hashlib
+import sqlite3
+import zlib
+import mmap
+import struct
+import datetime
+import threading
+import concurrent.futures
+import functools
 
-# Get input arguments
-parser = argparse.ArgumentParser(description='Azure pricing CLI', prog='pricing')
-subparsers = parser.add_subparsers(dest='command', help='Command help')
-# Define common shared arguments
-base_subparser = argparse.ArgumentParser(add_help=False)
-base_subparser.add_argument('--verbose', dest='verbose', action='store_true',
-                    default=False,
-                    help='run in verbose mode (default: False)')
-# Create the 'compare-regions' command
-compare_parser = subparsers.add_parser('compare-regions', help='Compare prices of a SKU across regions', parents=[base_subparser])
-compare_parser.add_argument('--sku', '-s', dest='sku', metavar= 'SKU', action='store',
-                    help='SKU to be analyzed across regions, for example Standard_NC24ads_A100_v4')
-# Create the 'get-skus' command
-get_skus_parser = subparsers.add_parser('get-skus', help='Get available VM sizes in a region', parents=[base_subparser])
-get_skus_parser.add_argument('--region', '--location', '-l', dest='region', metavar= 'REGION', action='store',
-                    help='Azure region to get available VM sizes for, for example eastus2')
-get_skus_parser.add_argument('--cores', '-c', dest='cores', metavar= 'CORES', action='store',
-                    help='Number of CPUs for the VM sizes to be listed. Either single number or range (e.g., 4-16)')
-get_skus_parser.add_argument('--memory', '-m', dest='memory', metavar= 'MEMORY_GB', action='store',
-                    help='Amount of memory (in GB) for the VM sizes to be listed. Either single number or range (e.g., 16-64)')
-get_skus_parser.add_argument('--cpu-arch', dest='cpu_arch', metavar= 'CPU_ARCH', action='store',
-                    help='Comma-separated CPU architectures for the VM sizes to be listed ("i" for Intel, "a" for AMD, "p" for ARM)'),
-get_skus_parser.add_argument('--sku-family', dest='sku_family', metavar= 'SKU_FAMILY', action='store',
-                    help='Comma-separated SKU families for the VM sizes to be listed (e.g., "A,N,D,E")'),
-get_skus_parser.add_argument('--sku-version', dest='sku_version', metavar= 'VM_SKU_VERSION', action='store',
-                    help='VM SKU version to filter the VM sizes to be listed (e.g., "6" or "5-6")')
-get_skus_parser.add_argument('--subscription-id', dest='subscription_id', metavar= 'SUBSCRIPTION_ID', action='store',
-                    help='Azure Subscription ID to use for authentication')
-get_skus_parser.add_argument('--only-cheapest', dest='only_cheapest', action='store_true',
-                    default=False, help='only return the cheapest SKU (default: False)')
-# Create the 'get-price' command
-get_price_parser = subparsers.add_parser('get-price', help='Get price for a specific SKU in a region', parents=[base_subparser])
-get_price_parser.add_argument('--region', '--location', '-l', dest='region', metavar= 'REGION', action='store',
-                    help='Azure region to get the price for, for example eastus2')
-get_price_parser.add_argument('--sku', '-s', dest='sku', metavar= 'SKU', action='store',
-                    help='SKU to get the price for, for example Standard_NC24ads_A100_v4')
-get_price_parser.add_argument('--format', '-f', '-o', dest='format', metavar= 'FORMAT', action='store', default='details',
-                    help='Output format: details (default), json, table')
-
-# Parse the command-line arguments
-args = parser.parse_args()
+# numpy is imported by load_numpy() when needed
+np = None
+
+# Default location of the local cache for Retail Prices API responses
+default_cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'azure-pricing')
+default_cache_file = os.path.join(default_cache_dir, 'prices.sqlite')
+default_snapshot_file = os.path.join(default_cache_dir, 'vm-prices.snapshot')
+default_token_cache_file = os.path.join(default_cache_dir, 'tokens.json')
+default_history_file = os.path.join(default_cache_dir, 'price-history.sqlite')
+
+# Settings used by the functions of this module. The CLI sets them from the command-line arguments,
+# and they can be changed with configure() when using this module as a library
+settings = argparse.Namespace(verbose=False, no_cache=False, refresh=False, cache_ttl=86400, cache_max_mb=256, cache_file=default_cache_file,
+                              concurrency=8, offline=False, snapshot_file=default_snapshot_file, vm_sizes_ttl=604800, token_cache_file=default_token_cache_file,
+                              history_file=default_history_file)
+
+# Updates the settings of the module, for example configure(verbose=True, offline=True)
+def configure(**kwargs):
+    for key, value in kwargs.items():
+        if not hasattr(settings, key):
+            raise ValueError("unknown setting '{0}'".format(key))
+        setattr(settings, key, value)
+
+# Imports numpy on first use, since it is only needed to get VM sizes. Returns False if it is not installed
+def load_numpy():
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            print("ERROR: the numpy package is required to get VM sizes, you can install it with 'pip install numpy'.")
+            return False
+        np = numpy
+    return True
+
+
+# Open (and create if required) the SQLite database used as local cache for Retail Prices API responses
+def open_cache(cache_file):
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+    db = sqlite3.connect(cache_file, timeout=30)
+    db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, created REAL NOT NULL, accessed REAL NOT NULL, size INTEGER NOT NULL, data BLOB NOT NULL)")
+    db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+    db.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, created REAL NOT NULL, data TEXT NOT NULL)")
+    return db
+
+# Returns the cache key for a Retail Prices API query (filter, currency, API version and endpoint)
+# Full responses and projected items (kind='items') of the same query are stored under different keys
+def get_cache_key(query, base_url, api_version, currency, kind=None):
+    parts = [base_url, api_version, currency, str(query)]
+    if kind is not None:
+        parts.insert(0, kind)
+    return hashlib.sha256("|".join(parts).encode('utf-8')).hexdigest()
+
+# Returns the cached JSON for a key, or None if it is not in the cache or it is older than ttl seconds
+def cache_get(db, key, ttl):
+    row = db.execute("SELECT created, data FROM responses WHERE key = ?", (key,)).fetchone()
+    if row is None:
+        return None
+    now = time.time()
+    if now - row[0] > ttl:
+        db.execute("DELETE FROM responses WHERE key = ?", (key,))
+        db.commit()
+        return None
+    db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+    db.commit()
+    return json.loads(zlib.decompress(row[1]))
+
+# Stores a JSON response in the cache, evicting the least recently used responses if the cache grows over max_bytes
+def cache_put(db, key, json_data, max_bytes):
+    data = zlib.compress(json.dumps(json_data, separators=(',', ':')).encode('utf-8'))
+    now = time.time()
+    db.execute("INSERT OR REPLACE INTO responses (key, created, accessed, size, data) VALUES (?, ?, ?, ?, ?)", (key, now, now, len(data), data))
+    total_size = db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+    if total_size > max_bytes:
+        evicted = 0
+        for old_key, old_size in db.execute("SELECT key, size FROM responses WHERE key != ? ORDER BY accessed ASC", (key,)).fetchall():
+            if total_size <= max_bytes:
+                break
+            db.execute("DELETE FROM responses WHERE key = ?", (old_key,))
+            total_size -= old_size
+            evicted += 1
+        if settings.verbose:
+            print("DEBUG: evicted {0} responses from the cache, cache size is now {1} bytes".format(evicted, total_size))
+    db.commit()
+
+# Returns a value of the metadata cache (VM sizes and regions of a subscription), or None if it is not cached,
+# it is older than --vm-sizes-ttl, or the cache is disabled or being refreshed
+def metadata_cache_get(key, refresh=None):
+    if refresh is None:
+        refresh = settings.refresh
+    if settings.no_cache or refresh:
+        return None
+    try:
+        db = open_cache(settings.cache_file)
+        try:
+            row = db.execute("SELECT created, data FROM metadata WHERE key = ?", (key,)).fetchone()
+        finally:
+            db.close()
+    except sqlite3.Error as e:
+        print("WARNING: could not use the cache file '{0}': {1}".format(settings.cache_file, str(e)))
+        return None
+    if row is None or time.time() - row[0] > settings.vm_sizes_ttl:
+        return None
+    return json.loads(row[1])
+
+# Stores a value in the metadata cache, unless the cache is disabled
+def metadata_cache_put(key, value):
+    if settings.no_cache:
+        return
+    try:
+        db = open_cache(settings.cache_file)
+        try:
+            db.execute("INSERT OR REPLACE INTO metadata (key, created, data) VALUES (?, ?, ?)", (key, time.time(), json.dumps(value, separators=(',', ':'))))
+            db.commit()
+        finally:
+            db.close()
+    except sqlite3.Error as e:
+        print("WARNING: could not write to the cache file '{0}': {1}".format(settings.cache_file, str(e)))
 
 # Returns JSON from a REST API call to the Azure Retail Prices API with a specific filter
-def get_prices_json(query=None, base_url="https://prices.azure.com/api/retail/prices", api_version="2023-01-01-preview", currency="USD"):
+# Responses are cached locally unless the --no-cache flag is supplied
+# refresh=True ignores cached responses, refresh=None uses the --refresh flag
+def get_prices_json(query=None, base_url="https://prices.azure.com/api/retail/prices", api_version="2023-01-01-preview", currency="USD", refresh=None):
+    if refresh is None:
+        refresh = settings.refresh
+    db = None
+    if not settings.no_cache:
+        cache_key = get_cache_key(query, base_url, api_version, currency)
+        try:
+            db = open_cache(settings.cache_file)
+            if not refresh:
+                json_data = cache_get(db, cache_key, settings.cache_ttl)
+                if json_data is not None:
+                    if settings.verbose:
+                        print("DEBUG: cache hit for query '{0}' ({1} items)".format(query, len(json_data.get('Items', []))))
+                    db.close()
+                    return json_data
+            if settings.verbose:
+                print("DEBUG: cache {0} for query '{1}'".format("refresh" if refresh else "miss", query))
+        except sqlite3.Error as e:
+            print("WARNING: could not use the cache file '{0}': {1}".format(settings.cache_file, str(e)))
+            db = None
+    try:
+        json_data = get_prices_json_from_api(query=query, base_url=base_url, api_version=api_version, currency=currency)
+    except Exception:
+        if db is not None:
+            db.close()
+        raise
+    if db is not None:
+        try:
+            # Only store complete, successful responses
+            if 'Items' in json_data:
+                cache_put(db, cache_key, json_data, settings.cache_max_mb * 1024 * 1024)
+        except sqlite3.Error as e:
+            print("WARNING: could not write to the cache file '{0}': {1}".format(settings.cache_file, str(e)))
+        db.close()
+    return json_data
+
+# Shared HTTP session, so that connections to the Retail Prices API are pooled and kept alive
+http_session = None
+http_session_lock = threading.Lock()
+
+# Returns the shared HTTP session, retrying with exponential backoff on throttling (429) and server errors (5xx)
+def get_http_session(pool_size=10):
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            retries = Retry(total=6, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['GET'], respect_retry_after_header=True)
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(pool_size, 10), max_retries=retries)
+            http_session = requests.Session()
+            http_session.mount('https://', adapter)
+            http_session.mount('http://', adapter)
+    return http_session
+
+# Fields of the Retail Prices API items that are kept when parsing pages into price items
+price_item_fields = ('armRegionName', 'armSkuName', 'skuName', 'productName', 'type', 'reservationTerm', 'retailPrice', 'meterId', 'effectiveStartDate')
+
+# Compact record with the fields of a Retail Prices API item used by the price index and the snapshot.
+# It supports the item.get() and item[field] accesses of the API items, so both can be used interchangeably.
+# Fields missing from the API item are stored as None, so item.get() returns its default for them like dict.get() would.
+class PriceItem:
+    __slots__ = price_item_fields
+
+    def __init__(self, values):
+        for field, value in zip(price_item_fields, values):
+            setattr(self, field, value)
+
+    @classmethod
+    def from_item(cls, item):
+        return cls([item.get(field) for field in price_item_fields])
+
+    def get(self, field, default=None):
+        if field not in price_item_fields:
+            return default
+        value = getattr(self, field)
+        return default if value is None else value
+
+    def __getitem__(self, field):
+        if field not in price_item_fields:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def to_list(self):
+        return [getattr(self, field) for field in price_item_fields]
+
+# Returns the JSON of a single page of the Retail Prices API
+# If a projection is supplied, the items are converted with it as soon as the page is parsed, so that
+# the full parse tree of a page is only held while the page is being processed
+# Error responses (4xx, or 429/5xx once the retries are exhausted) raise requests.HTTPError instead of being
+# parsed as a page, so that they never reach the response cache
+def get_prices_page(page_url, params=None, projection=None):
+    response = get_http_session(settings.concurrency).get(page_url, params=params, timeout=60)
+    response.raise_for_status()
+    page_data = json.loads(response.content)
+    if projection is not None and 'Items' in page_data:
+        page_data['Items'] = [projection(item) for item in page_data['Items']]
+    return page_data
+
+# Returns a NextPageLink URL modified to point to a different $skip offset
+def set_page_skip(page_url, skip):
+    return re.sub(r'\$skip=\d+', '$skip=' + str(skip), page_url)
+
+# Yields the pages of a REST API call to the Azure Retail Prices API, following all NextPageLink pages
+# Since the NextPageLink URLs are $skip-based, the following pages are predicted and fetched in parallel
+# waves of --concurrency pages. Pages are always yielded in order, and at most one wave is held in memory.
+def iter_prices_pages(query=None, base_url="https://prices.azure.com/api/retail/prices", api_version="2023-01-01-preview", currency="USD", projection=None):
     api_url = base_url + "?api-version=" + api_version + "&currencyCode=" + currency
-    if args.verbose:
+    if settings.verbose:
         print("DEBUG: sending REST request to URL '{0}'".format(api_url))
-    response = requests.get(api_url, params={'$filter': query})
-    json_data = json.loads(response.text)
-    while 'NextPageLink' in json_data and json_data['NextPageLink']:
-        next_page_url = json_data['NextPageLink']
-        if args.verbose:
-            print("DEBUG: retrieving next page from URL '{0}'".format(next_page_url))
-        response = requests.get(next_page_url)
-        next_page_data = json.loads(response.text)
-        json_data['Items'].extend(next_page_data['Items'])
-        json_data['NextPageLink'] = next_page_data.get('NextPageLink', None)
+    page_data = get_prices_page(api_url, params={'$filter': query}, projection=projection)
+    next_page_url = page_data.get('NextPageLink', None)
+    yield page_data
+    page_data = None
+    skip_match = re.search(r'\$skip=(\d+)', next_page_url) if next_page_url else None
+    if settings.concurrency > 1 and skip_match and int(skip_match.group(1)) > 0:
+        page_size = int(skip_match.group(1))
+        next_skip = page_size
+        get_page = functools.partial(get_prices_page, projection=projection)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=settings.concurrency) as executor:
+            last_page = False
+            while not last_page:
+                page_urls = [set_page_skip(next_page_url, next_skip + (i * page_size)) for i in range(settings.concurrency)]
+                if settings.verbose:
+                    print("DEBUG: retrieving {0} pages in parallel starting at offset {1}".format(len(page_urls), next_skip))
+                # executor.map returns the pages in the same order as the URLs
+                for page_data in executor.map(get_page, page_urls):
+                    yield page_data
+                    if not page_data.get('NextPageLink', None) or not page_data.get('Items', []):
+                        last_page = True
+                        break
+                next_skip += settings.concurrency * page_size
+    else:
+        while next_page_url:
+            if settings.verbose:
+                print("DEBUG: retrieving next page from URL '{0}'".format(next_page_url))
+            page_data = get_prices_page(next_page_url, projection=projection)
+            next_page_url = page_data.get('NextPageLink', None)
+            yield page_data
+
+# Returns JSON from a REST API call to the Azure Retail Prices API, with the items of all pages
+def get_prices_json_from_api(query=None, base_url="https://prices.azure.com/api/retail/prices", api_version="2023-01-01-preview", currency="USD"):
+    json_data = None
+    for page_data in iter_prices_pages(query=query, base_url=base_url, api_version=api_version, currency=currency):
+        if json_data is None:
+            json_data = page_data
+        else:
+            json_data['Items'].extend(page_data.get('Items', []))
+    if 'Items' in json_data:
+        json_data['NextPageLink'] = None
     return json_data
 
+# Yields the items of a Retail Prices API query as PriceItem records, as the pages arrive
+# The projected items are cached locally (separately from the full responses) unless the --no-cache flag is supplied.
+# Raises ValueError if no pricing data could be retrieved.
+def iter_price_items(query=None, base_url="https://prices.azure.com/api/retail/prices", api_version="2023-01-01-preview", currency="USD", refresh=None):
+    if refresh is None:
+        refresh = settings.refresh
+    db = None
+    if not settings.no_cache:
+        cache_key = get_cache_key(query, base_url, api_version, currency, kind='items')
+        try:
+            db = open_cache(settings.cache_file)
+            if not refresh:
+                cached_items = cache_get(db, cache_key, settings.cache_ttl)
+                if cached_items is not None:
+                    if settings.verbose:
+                        print("DEBUG: cache hit for query '{0}' ({1} items)".format(query, len(cached_items)))
+                    db.close()
+                    for values in cached_items:
+                        yield PriceItem(values)
+                    return
+            if settings.verbose:
+                print("DEBUG: cache {0} for query '{1}'".format("refresh" if refresh else "miss", query))
+        except sqlite3.Error as e:
+            print("WARNING: could not use the cache file '{0}': {1}".format(settings.cache_file, str(e)))
+            db = None
+    # Only the compact values are kept for the cache, and only if the cache is enabled
+    cached_items = [] if db is not None else None
+    try:
+        for page_data in iter_prices_pages(query=query, base_url=base_url, api_version=api_version, currency=currency, projection=PriceItem.from_item):
+            if 'Items' not in page_data:
+                raise ValueError("no pricing data found: {0}".format(json.dumps(page_data)[:500]))
+            for item in page_data['Items']:
+                if cached_items is not None:
+                    cached_items.append(item.to_list())
+                yield item
+        if db is not None:
+            try:
+                cache_put(db, cache_key, cached_items, settings.cache_max_mb * 1024 * 1024)
+            except sqlite3.Error as e:
+                print("WARNING: could not write to the cache file '{0}': {1}".format(settings.cache_file, str(e)))
+    finally:
+        if db is not None:
+            db.close()
+
+# The local snapshot of the VM price catalog is a binary file designed to be memory-mapped:
+# - Header: magic, format version, number of strings, number of rows, string ID of the most recent effectiveStartDate,
+#   offsets of the string table, the rows and the region index, and the time of the last sync
+# - String table: (number of strings + 1) uint32 offsets followed by the UTF-8 encoded strings
+# - Rows: one fixed-size record per price, with string IDs for the text fields and a double for the price.
+#   Rows are sorted by (SKU, region) in lower case, so that SKU lookups are a binary search.
+# - Region index: uint32 row numbers sorted by (region, SKU) in lower case, for region lookups
+snapshot_magic = b'AZPRICE1'
+snapshot_version = 1
+snapshot_header = struct.Struct('<8sIIIIQQQd')
+snapshot_row = struct.Struct('<IIIIIIIId')
+snapshot_uint = struct.Struct('<I')
+snapshot_string_fields = ['meterId', 'armRegionName', 'armSkuName', 'skuName', 'productName', 'type', 'reservationTerm', 'effectiveStartDate']
+
+# Writes the items of the VM price catalog into a snapshot file (atomically replacing any previous snapshot)
+def write_price_snapshot(snapshot_file, items, synced_at=None):
+    items = sorted(items, key=lambda item: ((item.get('armSkuName') or '').lower(), (item.get('armRegionName') or '').lower()))
+    string_ids = {}
+    strings = []
+    def get_string_id(value):
+        value = '' if value is None else str(value)
+        string_id = string_ids.get(value)
+        if string_id is None:
+            string_id = len(strings)
+            string_ids[value] = string_id
+            strings.append(value)
+        return string_id
+    get_string_id('')
+    rows = bytearray()
+    for item in items:
+        rows += snapshot_row.pack(*[get_string_id(item.get(field)) for field in snapshot_string_fields], float(item.get('retailPrice') or 0.0))
+    region_index = sorted(range(len(items)), key=lambda i: ((items[i].get('armRegionName') or '').lower(), (items[i].get('armSkuName') or '').lower()))
+    max_effective_start_date = max([item.get('effectiveStartDate') or '' for item in items], default='')
+    max_effective_start_date_id = get_string_id(max_effective_start_date)
+    # String table
+    encoded_strings = [string.encode('utf-8') for string in strings]
+    string_offsets = [0]
+    for encoded_string in encoded_strings:
+        string_offsets.append(string_offsets[-1] + len(encoded_string))
+    string_table = struct.pack('<%dI' % len(string_offsets), *string_offsets) + b''.join(encoded_strings)
+    strings_offset = snapshot_header.size
+    rows_offset = strings_offset + len(string_table)
+    region_index_offset = rows_offset + len(rows)
+    header = snapshot_header.pack(snapshot_magic, snapshot_version, len(strings), len(items), max_effective_start_date_id, strings_offset, rows_offset, region_index_offset, synced_at or time.time())
+    os.makedirs(os.path.dirname(os.path.abspath(snapshot_file)), exist_ok=True)
+    temp_file = snapshot_file + '.tmp'
+    with open(temp_file, 'wb') as f:
+        f.write(header)
+        f.write(string_table)
+        f.write(rows)
+        f.write(struct.pack('<%dI' % len(region_index), *region_index))
+    os.replace(temp_file, snapshot_file)
+
+# Read-only, memory-mapped view of a snapshot file
+class PriceSnapshot:
+    def __init__(self, snapshot_file):
+        self.file = open(snapshot_file, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.n_strings, self.n_rows, max_effective_start_date_id, self.strings_offset, self.rows_offset, self.region_index_offset, self.synced_at) = snapshot_header.unpack_from(self.mm, 0)
+        if magic != snapshot_magic or version != snapshot_version:
+            raise ValueError("'{0}' is not a valid price snapshot file".format(snapshot_file))
+        self.blob_offset = self.strings_offset + (self.n_strings + 1) * snapshot_uint.size
+        self.string_cache = {}
+        self.max_effective_start_date = self.get_string(max_effective_start_date_id)
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+    def get_string(self, string_id):
+        string = self.string_cache.get(string_id)
+        if string is None:
+            start, end = struct.unpack_from('<2I', self.mm, self.strings_offset + string_id * snapshot_uint.size)
+            string = self.mm[self.blob_offset + start:self.blob_offset + end].decode('utf-8')
+            self.string_cache[string_id] = string
+        return string
+
+    def get_row(self, row_id):
+        return snapshot_row.unpack_from(self.mm, self.rows_offset + row_id * snapshot_row.size)
+
+    # Returns a row as a dictionary with the same field names as the Retail Prices API items
+    def get_item(self, row_id):
+        row = self.get_row(row_id)
+        item = {field: self.get_string(string_id) for field, string_id in zip(snapshot_string_fields, row[:-1])}
+        item['reservationTerm'] = item['reservationTerm'] or None
+        item['retailPrice'] = row[-1]
+        item['serviceName'] = 'Virtual Machines'
+        return item
+
+    def get_sku_key(self, row_id):
+        row = self.get_row(row_id)
+        return (self.get_string(row[2]).lower(), self.get_string(row[1]).lower())
+
+    def get_region_key(self, position):
+        row = self.get_row(snapshot_uint.unpack_from(self.mm, self.region_index_offset + position * snapshot_uint.size)[0])
+        return (self.get_string(row[1]).lower(), self.get_string(row[2]).lower())
+
+    # Binary search of the first position whose key is greater or equal than the given key prefix
+    def bisect(self, get_key, prefix, upper=False):
+        lo, hi = 0, self.n_rows
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key = get_key(mid)[:len(prefix)]
+            if key < prefix or (upper and key == prefix):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # Returns the row IDs matching a SKU and/or a region
+    def find_rows(self, region=None, sku=None):
+        if sku is not None:
+            prefix = (sku.lower(),) if region is None else (sku.lower(), region.lower())
+            return list(range(self.bisect(self.get_sku_key, prefix), self.bisect(self.get_sku_key, prefix, upper=True)))
+        elif region is not None:
+            prefix = (region.lower(),)
+            start, end = self.bisect(self.get_region_key, prefix), self.bisect(self.get_region_key, prefix, upper=True)
+            return list(struct.unpack_from('<%dI' % (end - start), self.mm, self.region_index_offset + start * snapshot_uint.size))
+        return list(range(self.n_rows))
+
+    # Returns the items matching a SKU and/or a region, optionally only consumption prices
+    def get_items(self, region=None, sku=None, consumption_only=False):
+        items = [self.get_item(row_id) for row_id in self.find_rows(region=region, sku=sku)]
+        if consumption_only:
+            items = [item for item in items if item['type'] == 'Consumption']
+        return items
+
+    # Yields the rows matching a SKU and/or a region as PriceItem records, optionally only consumption prices
+    def iter_items(self, region=None, sku=None, consumption_only=False):
+        for row_id in self.find_rows(region=region, sku=sku):
+            row = self.get_row(row_id)
+            values = {field: self.get_string(string_id) for field, string_id in zip(snapshot_string_fields, row[:-1])}
+            if consumption_only and values['type'] != 'Consumption':
+                continue
+            values['reservationTerm'] = values['reservationTerm'] or None
+            values['retailPrice'] = row[-1]
+            yield PriceItem([values[field] for field in price_item_fields])
+
+# Snapshot opened by open_price_snapshot(), kept open for the lifetime of the process
+price_snapshot = None
+
+# Returns the snapshot in snapshot_file, or None if it does not exist or is not valid
+def open_price_snapshot(snapshot_file):
+    global price_snapshot
+    if price_snapshot is None:
+        try:
+            price_snapshot = PriceSnapshot(snapshot_file)
+        except (OSError, ValueError) as e:
+            print("ERROR: could not open the price snapshot '{0}', you can create it with the sync command: {1}".format(snapshot_file, str(e)))
+            return None
+        if settings.verbose:
+            print("DEBUG: opened price snapshot '{0}' with {1} prices, last synced on {2}".format(snapshot_file, price_snapshot.n_rows, datetime.datetime.fromtimestamp(price_snapshot.synced_at).isoformat()))
+    return price_snapshot
+
+# Returns the Retail Prices API items for a query, or None if no pricing data could be retrieved
+# The items are full API items, use load_price_index() when only the prices are needed
+# With --offline, the items are looked up in the local snapshot by region and/or SKU instead of running the query
+def get_price_items(query, region=None, sku=None, consumption_only=False, base_url="https://prices.azure.com/api/retail/prices", api_version="2023-01-01-preview", currency="USD", refresh=None):
+    if settings.offline:
+        snapshot = open_price_snapshot(settings.snapshot_file)
+        if snapshot is None:
+            return None
+        return snapshot.get_items(region=region, sku=sku, consumption_only=consumption_only)
+    json_data = get_prices_json(query=query, base_url=base_url, api_version=api_version, currency=currency, refresh=refresh)
+    if json_data is None or 'Items' not in json_data:
+        return None
+    return json_data['Items']
+
+# Returns the price index (see build_price_index) of a query, or None if no pricing data could be retrieved
+# The index is built as the items arrive, so only the index and the pages in flight are held in memory
+# With --offline, the items are looked up in the local snapshot by region and/or SKU instead of running the query
+def load_price_index(query, region=None, sku=None, consumption_only=False, base_url="https://prices.azure.com/api/retail/prices", api_version="2023-01-01-preview", currency="USD", refresh=None):
+    if settings.offline:
+        snapshot = open_price_snapshot(settings.snapshot_file)
+        if snapshot is None:
+            return None
+        return build_price_index(snapshot.iter_items(region=region, sku=sku, consumption_only=consumption_only))
+    try:
+        return build_price_index(iter_price_items(query=query, base_url=base_url, api_version=api_version, currency=currency, refresh=refresh))
+    except ValueError as e:
+        if settings.verbose:
+            print("DEBUG: {0}".format(str(e)))
+        return None
+
+# Downloads the VM price catalog into the local snapshot
+# If a snapshot exists, only the prices with an effectiveStartDate on or after the most recent one in the
+# snapshot are downloaded and merged into it, unless full is True
+# The downloaded prices are also appended to the price history, unless record_history is False
+def sync_price_snapshot(snapshot_file, full=False, record_history=True, base_url="https://prices.azure.com/api/retail/prices", api_version="2023-01-01-preview", currency="USD"):
+    query = "serviceName eq 'Virtual Machines'"
+    items_by_key = {}
+    if not full and os.path.exists(snapshot_file):
+        try:
+            snapshot = PriceSnapshot(snapshot_file)
+        except (OSError, ValueError) as e:
+            print("WARNING: could not read the existing snapshot, downloading the full catalog: {0}".format(str(e)))
+        else:
+            for row_id in range(snapshot.n_rows):
+                item = snapshot.get_item(row_id)
+                items_by_key[(item['meterId'], item['type'], item['reservationTerm'])] = item
+            if snapshot.max_effective_start_date:
+                query += " and effectiveStartDate ge {0}".format(snapshot.max_effective_start_date)
+            snapshot.close()
+    if settings.verbose:
+        print("DEBUG: {0} prices in the existing snapshot, downloading prices with query '{1}'".format(len(items_by_key), query))
+    start_time = time.time()
+    new_items = []
+    for page_data in iter_prices_pages(query=query, base_url=base_url, api_version=api_version, currency=currency, projection=PriceItem.from_item):
+        if 'Items' not in page_data:
+            print("ERROR: Could not download the VM price catalog: {0}".format(json.dumps(page_data)[:500]))
+            return
+        for item in page_data['Items']:
+            if not item.get('armSkuName'):
+                continue
+            new_items.append(item)
+            key = (item.get('meterId'), item.get('type'), item.get('reservationTerm'))
+            previous_item = items_by_key.get(key)
+            if previous_item is None or (item.get('effectiveStartDate') or '') >= (previous_item.get('effectiveStartDate') or ''):
+                items_by_key[key] = item
+    write_price_snapshot(snapshot_file, items_by_key.values())
+    print("INFO: {0} prices downloaded in {1} seconds, snapshot '{2}' contains {3} prices".format(len(new_items), round(time.time() - start_time, 1), snapshot_file, len(items_by_key)))
+    if record_history:
+        try:
+            added_prices = append_price_history(new_items)
+        except sqlite3.Error as e:
+            print("WARNING: could not write to the price history '{0}': {1}".format(settings.history_file, str(e)))
+        else:
+            print("INFO: {0} new prices added to the price history '{1}'".format(added_prices, settings.history_file))
+
+# The price history is a SQLite database with one row per price of a meter and effectiveStartDate, in the order in
+# which they were first seen. The primary key (meter, type, reservation term, effectiveStartDate) de-duplicates the
+# prices appended by each sync and orders the prices of a meter by date, and secondary indexes by SKU and region and
+# by effectiveStartDate answer the history queries without scanning the whole table.
+def open_history(history_file):
+    os.makedirs(os.path.dirname(os.path.abspath(history_file)), exist_ok=True)
+    db = sqlite3.connect(history_file, timeout=30)
+    db.execute("CREATE TABLE IF NOT EXISTS prices (meter_id TEXT NOT NULL, type TEXT NOT NULL, reservation_term TEXT NOT NULL, effective_start_date TEXT NOT NULL, "
+               "region TEXT NOT NULL, sku TEXT NOT NULL, sku_name TEXT, product_name TEXT, price REAL NOT NULL, first_seen REAL NOT NULL, "
+               "PRIMARY KEY (meter_id, type, reservation_term, effective_start_date)) WITHOUT ROWID")
+    db.execute("CREATE INDEX IF NOT EXISTS prices_sku_region ON prices (sku, region, effective_start_date)")
+    db.execute("CREATE INDEX IF NOT EXISTS prices_effective_start_date ON prices (effective_start_date)")
+    return db
+
+# Appends Retail Prices API items to the price history, ignoring the prices already in it. Returns the number of new prices.
+def append_price_history(items, history_file=None):
+    db = open_history(history_file or settings.history_file)
+    try:
+        changes_before = db.total_changes
+        now = time.time()
+        db.executemany("INSERT OR IGNORE INTO prices (meter_id, type, reservation_term, effective_start_date, region, sku, sku_name, product_name, price, first_seen) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                       [(item.get('meterId') or '', item.get('type') or '', item.get('reservationTerm') or '', item.get('effectiveStartDate') or '', (item.get('armRegionName') or '').lower(),
+                         (item.get('armSkuName') or '').lower(), item.get('skuName'), item.get('productName'), float(item.get('retailPrice') or 0.0), now) for item in items if item.get('meterId')])
+        db.commit()
+        return db.total_changes - changes_before
+    finally:
+        db.close()
+
+# Returns the price field (see get_price_field) of a row of the price history
+def get_history_price_field(row_type, reservation_term, sku_name, product_name):
+    return get_price_field({'type': row_type, 'reservationTerm': reservation_term or None, 'skuName': sku_name or '', 'productName': product_name or ''})
+
+# Returns the prices of a SKU over time, optionally only in some regions and with an effectiveStartDate on or after since,
+# sorted by region, price field and date. Each price includes its change from the previous price of the same meter.
+def get_price_history(sku, regions=None, since=None, history_file=None):
+    db = open_history(history_file or settings.history_file)
+    try:
+        query = "SELECT region, meter_id, type, reservation_term, sku_name, product_name, effective_start_date, price FROM prices WHERE sku = ?"
+        params = [sku.lower()]
+        if regions:
+            query += " AND region IN ({0})".format(','.join('?' * len(regions)))
+            params += [region.lower() for region in regions]
+        rows = db.execute(query + " ORDER BY region, meter_id, type, reservation_term, effective_start_date", params).fetchall()
+    finally:
+        db.close()
+    history = []
+    previous_row = None
+    for region, meter_id, row_type, reservation_term, sku_name, product_name, effective_start_date, price in rows:
+        same_meter = previous_row is not None and previous_row[:4] == (region, meter_id, row_type, reservation_term)
+        previous_price = previous_row[4] if same_meter else None
+        previous_row = (region, meter_id, row_type, reservation_term, price)
+        if since is not None and effective_start_date < since:
+            continue
+        change = round((price - previous_price) / previous_price * 100, 2) if previous_price else None
+        history.append({'region': region, 'price_field': get_history_price_field(row_type, reservation_term, sku_name, product_name), 'sku_name': sku_name,
+                        'effective_start_date': effective_start_date, 'price': price, 'previous_price': previous_price, 'change_pct': change})
+    history.sort(key=lambda entry: (entry['region'], entry['price_field'] or '', entry['effective_start_date']))
+    return history
+
+# Returns the prices with the largest relative change since a date: for each meter with a price effective on or after since,
+# its latest price is compared with the price in effect before since. Meters without a price before since are not included.
+def get_price_movers(since, regions=None, sku=None, top=20, history_file=None):
+    db = open_history(history_file or settings.history_file)
+    try:
+        # The changed meters come from the effectiveStartDate index, and their prices from the primary key
+        query = ("SELECT changed.meter_id, changed.type, changed.reservation_term, "
+                 "(SELECT price FROM prices AS p WHERE p.meter_id = changed.meter_id AND p.type = changed.type AND p.reservation_term = changed.reservation_term AND p.effective_start_date < ? ORDER BY p.effective_start_date DESC LIMIT 1), "
+                 "latest.price, latest.effective_start_date, latest.region, latest.sku, latest.sku_name, latest.product_name "
+                 "FROM (SELECT DISTINCT meter_id, type, reservation_term FROM prices INDEXED BY prices_effective_start_date WHERE effective_start_date >= ?) AS changed "
+                 "JOIN prices AS latest ON latest.meter_id = changed.meter_id AND latest.type = changed.type AND latest.reservation_term = changed.reservation_term "
+                 "AND latest.effective_start_date = (SELECT MAX(effective_start_date) FROM prices AS l WHERE l.meter_id = changed.meter_id AND l.type = changed.type AND l.reservation_term = changed.reservation_term)")
+        rows = db.execute(query, (since, since)).fetchall()
+    finally:
+        db.close()
+    region_filter = set(region.lower() for region in regions) if regions else None
+    movers = []
+    for meter_id, row_type, reservation_term, previous_price, price, effective_start_date, region, row_sku, sku_name, product_name in rows:
+        if not previous_price or (region_filter is not None and region not in region_filter) or (sku is not None and row_sku != sku.lower()):
+            continue
+        movers.append({'region': region, 'sku': row_sku, 'price_field': get_history_price_field(row_type, reservation_term, sku_name, product_name), 'sku_name': sku_name,
+                       'effective_start_date': effective_start_date, 'previous_price': previous_price, 'price': price, 'change_pct': round((price - previous_price) / previous_price * 100, 2)})
+    movers.sort(key=lambda entry: -abs(entry['change_pct']))
+    return movers[:top] if top is not None else movers
+
+# Prints the prices of a SKU over time generated by get_price_history() in a table format
+def print_price_history(history):
+    print(f"{'Region':<20} {'Price type':<15} {'Effective date':<22} {'Price':>12} {'Change':>9}")
+    print("-" * 82)
+    for entry in history:
+        change = f"{entry['change_pct']:+.2f}%" if entry['change_pct'] is not None else '-'
+        print(f"{entry['region']:<20} {entry['price_field'] or '?':<15} {entry['effective_start_date']:<22} {entry['price']:>12.4f} {change:>9}")
+
+# Prints the biggest price changes generated by get_price_movers() in a table format
+def print_price_movers(movers):
+    print(f"{'Region':<20} {'ARM SKU':<28} {'Price type':<15} {'Effective date':<22} {'Previous':>12} {'Price':>12} {'Change':>9}")
+    print("-" * 124)
+    for entry in movers:
+        print(f"{entry['region']:<20} {entry['sku']:<28} {entry['price_field'] or '?':<15} {entry['effective_start_date']:<22} {entry['previous_price']:>12.4f} {entry['price']:>12.4f} {entry['change_pct']:>+8.2f}%")
+
+# Price fields of the records in a price index
+price_fields = ['linux', 'linux_spot', 'linux_lp', 'windows', 'windows_spot', 'windows_lp', 'reservation_1y', 'reservation_3y']
+
+# Returns the price field of a price record that a Retail Prices API item corresponds to, or None if not relevant
+def get_price_field(item):
+    if item.get("type") == "Reservation":
+        if item.get("reservationTerm") == "1 Year":
+            return 'reservation_1y'
+        elif item.get("reservationTerm") == "3 Years":
+            return 'reservation_3y'
+        else:
+            print("ERROR: reservation term {0} could not be interpreted".format(item.get("reservationTerm")))
+            return None
+    elif item.get("type") == "Consumption":
+        os_name = 'windows' if 'Windows' in item.get("productName", "") else 'linux'
+        if 'Spot' in item.get("skuName", ""):
+            return os_name + '_spot'
+        elif 'Low Priority' in item.get("skuName", ""):
+            return os_name + '_lp'
+        else:
+            return os_name
+    return None
+
+# Builds in a single pass over the Retail Prices API items an index of price records, keyed by
+# (region, ARM SKU name) in lower case. Each record contains one price per price field (or None),
+# so that joining VM sizes and prices is a dictionary lookup. If several items map to the same
+# price field, the first one wins.
+def build_price_index(items):
+    price_index = {}
+    for item in items:
+        field = get_price_field(item)
+        if field is None:
+            continue
+        key = (item.get('armRegionName', '').lower(), item.get('armSkuName', '').lower())
+        record = price_index.get(key)
+        if record is None:
+            record = {'region': item.get('armRegionName'), 'sku': item.get('armSkuName'), 'product_name': item.get('productName'), 'sku_name': item.get('skuName')}
+            for price_field in price_fields:
+                record[price_field] = None
+            price_index[key] = record
+        if record[field] is None:
+            record[field] = item.get('retailPrice')
+            # Product and SKU names are reported for the Linux on-demand price
+            if field == 'linux':
+                record['product_name'] = item.get('productName')
+                record['sku_name'] = item.get('skuName')
+    return price_index
+
+# Returns the price details of a price record: the prices of the record plus monthly prices,
+# and reservation prices without Azure Hybrid Benefit (adding the Windows license to the reservation price)
+def get_price_details(record):
+    details = {'region': record['region'], 'sku': record['sku']}
+    for price_field in price_fields:
+        details[price_field] = record[price_field]
+    for price_field in ('linux', 'windows'):
+        details[price_field + '_month'] = round(record[price_field] * 730, 2) if record[price_field] is not None else None
+    # Windows license cost per month
+    win_license = None
+    if record['windows'] is not None and record['linux'] is not None:
+        win_license = (record['windows'] - record['linux']) * 730
+    for price_field, months in (('reservation_1y', 12), ('reservation_3y', 36)):
+        if record[price_field] is not None:
+            details[price_field + '_month'] = round(record[price_field] / months, 2)
+            if win_license is not None:
+                details[price_field + '_windows'] = round(record[price_field] + (win_license * months), 2)
+                details[price_field + '_windows_month'] = round(details[price_field + '_windows'] / months, 2)
+    return details
+
+# Prints the price details returned by get_price_details()
+def print_price_details(details):
+    print("Pricing for SKU '{0}' in region '{1}':".format(details['sku'], details['region']))
+    if details['linux'] is not None:
+        print("  Linux on-demand price: ${0}/hour, ${1}/month".format(details['linux'], details['linux_month']))
+    if details['linux_spot'] is not None:
+        print("    Linux spot price: ${0}/hour".format(details['linux_spot']))
+    if details['linux_lp'] is not None:
+        print("    Linux low-priority price: (for Azure Batch) ${0}/hour".format(details['linux_lp']))
+    if details['windows'] is not None:
+        print("  Windows on-demand price: ${0}/hour, ${1}/month".format(details['windows'], details['windows_month']))
+    if details['windows_spot'] is not None:
+        print("    Windows spot price: ${0}/hour".format(details['windows_spot']))
+    if details['windows_lp'] is not None:
+        print("    Windows low-priority price (for Azure Batch): ${0}/hour".format(details['windows_lp']))
+    if details['reservation_1y'] is not None:
+        print("  1Y reservation price (Linux/AHB): ${0}, ${1}/month".format(details['reservation_1y'], details['reservation_1y_month']))
+        if 'reservation_1y_windows' in details:
+            print("  1Y reservation price (Windows, no AHB): ${0}, ${1}/month".format(details['reservation_1y_windows'], details['reservation_1y_windows_month']))
+    if details['reservation_3y'] is not None:
+        print("  3Y reservation price (Linux/AHB): ${0}, ${1}/month".format(details['reservation_3y'], details['reservation_3y_month']))
+        if 'reservation_3y_windows' in details:
+            print("  3Y reservation price (Windows, no AHB): ${0}, ${1}/month".format(details['reservation_3y_windows'], details['reservation_3y_windows_month']))
+
 # Returns the price for a specific SKU and region
 def get_prices_sku(region, sku, base_url="https://prices.azure.com/api/retail/prices", api_version="2023-01-01-preview", currency="USD", format="details"):
-    api_url = base_url + "?api-version=" + api_version + "&currencyCode=" + currency
     query = f"armRegionName eq '{region}' and armSkuName eq '{sku}'"
-    if args.verbose:
+    if settings.verbose:
         print("DEBUG: sending REST request with query '{0}'".format(query))
-    json_data = get_prices_json(query=query, base_url=base_url, api_version=api_version, currency=currency)
-    if 'Items' in json_data:
+    items = get_price_items(query, region=region, sku=sku, base_url=base_url, api_version=api_version, currency=currency)
+    if items is not None:
         if format == "json":
-            print(json.dumps(json_data['Items'], indent=4))
-            return json_data['Items']
+            print(json.dumps(items, indent=4))
+            return items
         elif format == "table":
             # Print header row using text padding for constant width
             print(f"{'ARM SKU':<20} {'SKU':<20} {'Price':<10} {'Region':<15} {'Product':<50} {'Type':<20}")
             print("-" * 140)
             # Print rows
-            for item in json_data['Items']:
+            for item in items:
                 print(f"{item['armSkuName']:<20} {item['skuName']:<20} {item['retailPrice']:<10} {item['armRegionName']:<15} {item['productName']:<50} {item['type']:<20}")
         elif format == "details":
-            for item in json_data['Items']:
-                if item.get("type") == "Reservation":
-                    if item.get("reservationTerm") == "1 Year":
-                        price_r1y = item['retailPrice']
-                    elif item.get("reservationTerm") == "3 Years":
-                        price_r3y = item['retailPrice']
-                    else:
-                        print("ERROR: reservation term {0} could not be interpreted".format(item.get("reservationTerm")))
-                elif item.get("type") == "Consumption":
-                    if 'Windows' in item.get("productName", ""):
-                        if 'Spot' in item.get("skuName", ""):
-                            price_win_spot = item['retailPrice']
-                        elif 'Low Priority' in item.get("skuName", ""):
-                            price_win_lp = item['retailPrice']
-                        else:
-                            price_win = item['retailPrice']
-                    else:
-                        if 'Spot' in item.get("skuName", ""):
-                            price_lin_spot = item['retailPrice']
-                        elif 'Low Priority' in item.get("skuName", ""):
-                            price_lin_lp = item['retailPrice']
-                        else:
-                            price_lin = item['retailPrice']
-            print("Pricing for SKU '{0}' in region '{1}':".format(sku, region))
-            print("  Linux on-demand price: ${0}/hour, ${1}/month".format(price_lin, round(price_lin * 730, 2)))
-            if 'price_lin_spot' in locals():
-                print("    Linux spot price: ${0}/hour".format(price_lin_spot))
-            if 'price_lin_lp' in locals():
-                print("    Linux low-priority price: (for Azure Batch) ${0}/hour".format(price_lin_lp))
-            print("  Windows on-demand price: ${0}/hour, ${1}/month".format(price_win, round(price_win * 730, 2)))
-            if 'price_win_spot' in locals():
-                print("    Windows spot price: ${0}/hour".format(price_win_spot))
-            if 'price_win_lp' in locals():
-                print("    Windows low-priority price (for Azure Batch): ${0}/hour".format(price_win_lp))
-            if 'price_r1y' in locals():
-                print("  1Y reservation price (Linux/AHB): ${0}, ${1}/month".format(price_r1y, round(price_r1y / 12, 2)))
-                win_license = (price_win - price_lin) * 730
-                price_r1y_win = round(price_r1y + (win_license * 12), 2)
-                print("  1Y reservation price (Windows, no AHB): ${0}, ${1}/month".format(price_r1y_win, round(price_r1y_win / 12, 2)))
-            if 'price_r3y' in locals():
-                print("  3Y reservation price (Linux/AHB): ${0}, ${1}/month".format(price_r3y, round(price_r3y / 36, 2)))
-                win_license = (price_win - price_lin) * 730
-                price_r3y_win = round(price_r3y + (win_license * 36), 2)
-                print("  3Y reservation price (Windows, no AHB): ${0}, ${1}/month".format(price_r3y_win, round(price_r3y_win / 36, 2)))
+            record = build_price_index(items).get((region.lower(), sku.lower()))
+            details = get_price_details(record) if record is not None else None
+            if details is None:
+                print("ERROR: No pricing data found for the specified SKU ({0}) and region ({1}).".format(sku, region))
+                return None
+            print_price_details(details)
+            return details
         else:
             print("ERROR: Unsupported format specified ({0}).".format(format))
     else:
         print("ERROR: No pricing data found for the specified SKU ({0}) and region ({1}).".format(sku, region))
         return None
 
-# Returns a sorted listed with the on-demand Linux prices in all available regions for a specific SKU
-def get_prices_sku_all_regions(sku, base_url="https://prices.azure.com/api/retail/prices", api_version="2023-01-01-preview", currency="USD", format="table"):
+# Returns the Linux on-demand price of a SKU in all regions of a price index, sorted by price
+def get_region_prices(price_index):
+    prices = [{'region': record['region'], 'price': record['linux'], 'product_name': record['product_name'], 'sku_name': record['sku_name']} for record in price_index.values() if record['linux'] is not None]
+    prices.sort(key=lambda x: x['price'])
+    return prices
+
+# Returns the price details of a SKU in a region (see get_price_details), or None if there is no pricing data
+def get_price(region, sku, base_url="https://prices.azure.com/api/retail/prices", api_version="2023-01-01-preview", currency="USD"):
+    query = f"armRegionName eq '{region}' and armSkuName eq '{sku}'"
+    price_index = load_price_index(query, region=region, sku=sku, base_url=base_url, api_version=api_version, currency=currency)
+    if price_index is None:
+        return None
+    record = price_index.get((region.lower(), sku.lower()))
+    return get_price_details(record) if record is not None else None
+
+# Returns the Linux on-demand prices of a SKU in all regions sorted by price (see get_region_prices), or None if there is no pricing data
+def compare_regions(sku, base_url="https://prices.azure.com/api/retail/prices", api_version="2023-01-01-preview", currency="USD"):
     query = f"armSkuName eq '{sku}' and type eq 'Consumption'"
-    if args.verbose:
+    if settings.verbose:
         print("DEBUG: sending REST request with query '{0}'".format(query))
-    json_data = get_prices_json(query=query, base_url=base_url, api_version=api_version, currency=currency)
-    prices = []
-    if 'Items' in json_data:
-        for item in json_data['Items']:
-            if not ('Windows' in item.get("productName", "") or "Low Priority" in item.get("skuName", "") or "Spot" in item.get("skuName", "")):
-                prices.append((item['armRegionName'], item['retailPrice'], item['productName'], item['skuName']))
-        # Sort prices by price
-        prices.sort(key=lambda x: x[1])
+    price_index = load_price_index(query, sku=sku, consumption_only=True, base_url=base_url, api_version=api_version, currency=currency)
+    if price_index is None:
+        return None
+    return get_region_prices(price_index)
+
+# Prints a sorted listed with the on-demand Linux prices in all available regions for a specific SKU
+def get_prices_sku_all_regions(sku, base_url="https://prices.azure.com/api/retail/prices", api_version="2023-01-01-preview", currency="USD", format="table"):
+    region_prices = compare_regions(sku, base_url=base_url, api_version=api_version, currency=currency)
+    if region_prices is not None:
+        prices = [(entry['region'], entry['price'], entry['product_name'], entry['sku_name']) for entry in region_prices]
         if format == "json":
             print(json.dumps(prices, indent=4))
         elif format == "table":
@@ -159,25 +831,128 @@ def get_prices_sku_all_regions(sku, base_url="https://prices.azure.com/api/retai
         print("ERROR: No pricing data found for the specified SKU ({0}).".format(sku))
         return None
 
-# Helper function to check if a number is in a range or equals a single value
+# Reads the (region, SKU) queries of a batch from a JSONL or CSV file ('-' for stdin)
+# Returns a list with one dictionary per input line
+def read_batch_queries(input_file):
+    input_stream = sys.stdin if input_file == '-' else open(input_file, newline='')
+    try:
+        lines = [line for line in input_stream.read().splitlines() if line.strip()]
+    finally:
+        if input_stream is not sys.stdin:
+            input_stream.close()
+    if len(lines) == 0:
+        return []
+    if lines[0].lstrip().startswith('{'):
+        batch_queries = [json.loads(line) for line in lines]
+    else:
+        batch_queries = list(csv.DictReader(lines))
+    # Accept the Retail Prices API field names too
+    for batch_query in batch_queries:
+        batch_query.setdefault('region', batch_query.get('armRegionName'))
+        batch_query.setdefault('sku', batch_query.get('armSkuName'))
+    return batch_queries
+
+# Coalesces (region, SKU) pairs into the minimum number of OR-combined $filter queries whose URL-encoded
+# length stays under max_length. Each query looks like:
+#   (armRegionName eq 'r1' and (armSkuName eq 's1' or armSkuName eq 's2')) or (armRegionName eq 'r2' and ...)
+# Returns a list of (query, list of (region, SKU) pairs in lower case)
+def coalesce_batch_queries(pairs, max_length=1500):
+    def encoded_length(query):
+        return len(urllib.parse.quote(query))
+    # Unique SKUs per region, keeping the input order. Regions and SKUs are compared in lower case, as the results are
+    # looked up in lower case; region names are lower case in the API, the first spelling of a SKU is kept.
+    region_skus = {}
+    for region, sku in pairs:
+        skus = region_skus.setdefault(region.lower(), [])
+        if sku.lower() not in (s.lower() for s in skus):
+            skus.append(sku)
+    # Build one clause per region, split if a single region has too many SKUs for one query
+    clauses = []
+    for region, skus in region_skus.items():
+        clause_skus = []
+        for sku in skus:
+            candidate = clause_skus + [sku]
+            if len(clause_skus) > 0 and encoded_length("(armRegionName eq '{0}' and ({1}))".format(region, ' or '.join(f"armSkuName eq '{s}'" for s in candidate))) > max_length:
+                clauses.append((region, clause_skus))
+                candidate = [sku]
+            clause_skus = candidate
+        clauses.append((region, clause_skus))
+    # Pack the clauses into as few queries as possible
+    coalesced_queries = []
+    query_parts, query_pairs = [], []
+    for region, skus in clauses:
+        clause = "(armRegionName eq '{0}' and ({1}))".format(region, ' or '.join(f"armSkuName eq '{s}'" for s in skus))
+        if len(query_parts) > 0 and encoded_length(' or '.join(query_parts + [clause])) > max_length:
+            coalesced_queries.append((' or '.join(query_parts), query_pairs))
+            query_parts, query_pairs = [], []
+        query_parts.append(clause)
+        query_pairs += [(region.lower(), sku.lower()) for sku in skus]
+    if len(query_parts) > 0:
+        coalesced_queries.append((' or '.join(query_parts), query_pairs))
+    return coalesced_queries
+
+# Gets the prices of a batch of (region, SKU) queries, sending the coalesced queries in parallel
+# Prints one JSON line per input line, in input order, as soon as the prices for that line are available
+def get_prices_batch(batch_queries, base_url="https://prices.azure.com/api/retail/prices", api_version="2023-01-01-preview", currency="USD", max_filter_length=1500, parallel_queries=4):
+    pairs = [(str(q['region']), str(q['sku'])) for q in batch_queries if q.get('region') and q.get('sku')]
+    coalesced_queries = coalesce_batch_queries(pairs, max_length=max_filter_length)
+    if settings.verbose:
+        print("DEBUG: {0} input lines coalesced into {1} queries".format(len(batch_queries), len(coalesced_queries)), file=sys.stderr)
+    def get_query_price_index(query, query_pairs):
+        if settings.offline:
+            price_index = {}
+            for region, sku in query_pairs:
+                price_index.update(load_price_index(query, region=region, sku=sku) or {})
+            return price_index
+        return load_price_index(query, base_url=base_url, api_version=api_version, currency=currency) or {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(parallel_queries, 1)) as executor:
+        pair_futures = {}
+        for query, query_pairs in coalesced_queries:
+            future = executor.submit(get_query_price_index, query, query_pairs)
+            for pair in query_pairs:
+                pair_futures[pair] = future
+        for batch_query in batch_queries:
+            result = {'input': batch_query}
+            if not batch_query.get('region') or not batch_query.get('sku'):
+                result['error'] = 'region and sku are required'
+            else:
+                key = (str(batch_query['region']).lower(), str(batch_query['sku']).lower())
+                try:
+                    record = pair_futures[key].result().get(key)
+                    if record is None:
+                        result['error'] = 'no pricing data found'
+                    else:
+                        result['prices'] = get_price_details(record)
+                except Exception as e:
+                    result['error'] = str(e)
+            print(json.dumps(result))
+            sys.stdout.flush()
+
+# Helper function to parse a range parameter into a (lower, upper) tuple, or None if it is not valid
 # The parameter can be a single digit (e.g., 4) or a range (e.g., 4-16)
-def number_in_range(value, range_param):
+def parse_range(range_param):
     if isinstance(range_param, int) or range_param.isnumeric():
-        return value == int(range_param)
+        return (int(range_param), int(range_param))
     elif isinstance(range_param, str) and '-' in range_param:
         parts = range_param.split('-')
         if len(parts) == 2:
             try:
-                lower = int(parts[0])
-                upper = int(parts[1])
-                return ((lower <= value) and (value <= upper))
+                return (int(parts[0]), int(parts[1]))
             except ValueError:
-                if args.verbose:
+                if settings.verbose:
                     print("DEBUG: could not convert range parts to integers: '{0}'".format(range_param))
-                return False
-    if args.verbose:
+                return None
+    if settings.verbose:
         print("DEBUG: range_param '{0}' is not valid".format(range_param))
-    return False
+    return None
+
+# Helper function to check if a number is in a range or equals a single value
+# The parameter can be a single digit (e.g., 4) or a range (e.g., 4-16)
+def number_in_range(value, range_param):
+    bounds = parse_range(range_param)
+    if bounds is None:
+        return False
+    return ((bounds[0] <= value) and (value <= bounds[1]))
 
 # Helper function to check if an architecture is in a comma-separated list of architectures
 def arch_in_list(arch, arch_list):
@@ -189,110 +964,722 @@ def arch_in_list(arch, arch_list):
         return ("p" in arch_list)
     return False
 
-# Get available VM sizes from the region, equivalent to the Azure CLI command `az vm list-sizes --location <region>`
+# Extracts the SKU family, SKU version and CPU architecture out of a VM size name such as Standard_D4as_v5
+def parse_vm_size_name(size_name):
+    this_size = {}
+    this_size['name'] = size_name
+    this_size['prefix'] = size_name.split('_')[0]
+    this_size['sku_family'] = size_name.split('_')[1]
+    this_size['sku_version'] = size_name.split('_')[-1].split('v')[-1]
+    if 'a' in str(this_size['sku_family']):
+        this_size['cpu_arch'] = 'amd'
+    elif 'p' in str(this_size['sku_family']):
+        this_size['cpu_arch'] = 'arm'
+    else:
+        this_size['cpu_arch'] = 'intel'
+    # Looks like the API doesnt return the capabilities
+    # https://learn.microsoft.com/rest/api/compute/virtual-machine-sizes/list?view=rest-compute-2025-04-01
+    # if 'EphemeralOSDiskSupported' in size['capabilities']:
+    #     size['ephemeral_os_disk'] = (size['capabilities']['EphemeralOSDiskSupported'].lower() == 'true')
+    # if 'vCPUsPerCore' in size['capabilities']:
+    #     size['hyperthreading'] = (size['capabilities']['vCPUsPerCore'] == '2')
+    return this_size
+
+# Returns the metadata of a VM size returned by the Microsoft.Compute API that get-skus uses: the fields
+# extracted by parse_vm_size_name() plus the number of cores and the memory. Size records are plain
+# dictionaries, so that they can be stored in the metadata cache.
+def get_vm_size_record(size):
+    size_record = parse_vm_size_name(size.name)
+    size_record['cores'] = size.number_of_cores
+    size_record['memory_mb'] = size.memory_in_mb
+    return size_record
+
+# Builds a columnar representation (one NumPy array per attribute) of the VM size records of a region,
+# joined with their Linux on-demand price from the price index (NaN if there is no price)
+def build_size_columns(region, size_records, price_index):
+    prices = []
+    for size_record in size_records:
+        price_record = price_index.get((region.lower(), size_record['name'].lower()))
+        if price_record is None or price_record['linux'] is None:
+            prices.append(np.nan)
+            if settings.verbose:
+                print("DEBUG: No price found for VM size '{0}' in region '{1}'.".format(size_record['name'], region))
+        else:
+            prices.append(price_record['linux'])
+    columns = {
+        'size': np.array([size_record['name'] for size_record in size_records], dtype=object),
+        'region': np.array([region] * len(size_records), dtype=object),
+        'cores': np.array([size_record['cores'] for size_record in size_records], dtype=np.int32),
+        'memory_mb': np.array([size_record['memory_mb'] for size_record in size_records], dtype=np.float64),
+        'price': np.array(prices, dtype=np.float64),
+        'sku_family': np.array([size_record['sku_family'] for size_record in size_records], dtype=object),
+        'family_letter': np.array([size_record['sku_family'][0].lower() for size_record in size_records], dtype='U1'),
+        'cpu_arch': np.array([size_record['cpu_arch'] for size_record in size_records], dtype='U5'),
+        'sku_version': np.array([size_record['sku_version'] for size_record in size_records], dtype=object),
+        # Sizes without a version suffix (such as Standard_D2s) are treated as version 1
+        'sku_version_number': np.array([int(size_record['sku_version']) if size_record['sku_version'].isnumeric() else 1 for size_record in size_records], dtype=np.int32),
+    }
+    columns['memory_gb'] = np.round(columns['memory_mb'] / 1024, 0)
+    return columns
+
+# Compiles the get-skus filters into a single boolean mask over the size columns
+# Sizes without a price are always filtered out
+def compile_size_filters(columns, cores=None, memory=None, cpu_arch=None, sku_version=None, sku_family=None):
+    mask = ~np.isnan(columns['price'])
+    for column_name, range_param in (('cores', cores), ('memory_gb', memory), ('sku_version_number', sku_version)):
+        if range_param is not None:
+            bounds = parse_range(range_param)
+            if bounds is None:
+                mask[:] = False
+            else:
+                mask &= (columns[column_name] >= bounds[0]) & (columns[column_name] <= bounds[1])
+    if cpu_arch is not None:
+        allowed_archs = [arch for arch in ('intel', 'amd', 'arm') if arch_in_list(arch, cpu_arch.lower())]
+        mask &= np.isin(columns['cpu_arch'], allowed_archs)
+    if sku_family is not None:
+        allowed_letters = [letter for letter in set(sku_family.lower()) if letter.isalpha()]
+        mask &= np.isin(columns['family_letter'], allowed_letters)
+    return mask
+
+# Ranks the sizes selected by the mask according to sort_by (price-per-core, price-per-gb or price)
+# If top is specified only the top N sizes are selected (with argpartition) before sorting them
+# Returns a list of dictionaries, one per size
+def rank_sizes(columns, mask, sort_by='price-per-core', top=None):
+    selected = np.flatnonzero(mask)
+    price_month = columns['price'][selected] * 730
+    if sort_by == 'price-per-gb':
+        sort_key = price_month / (columns['memory_mb'][selected] / 1024)
+    elif sort_by == 'price':
+        sort_key = price_month
+    else:
+        sort_key = price_month / columns['cores'][selected]
+    if top is not None and top < len(selected):
+        top_n = np.argpartition(sort_key, max(top - 1, 0))[:max(top, 0)]
+        selected = selected[top_n]
+        sort_key = sort_key[top_n]
+    order = np.argsort(sort_key, kind='stable')
+    size_list = []
+    for i in selected[order]:
+        price = float(columns['price'][i])
+        size_list.append({'size': columns['size'][i], 'region': columns['region'][i], 'price': price, 'cores': int(columns['cores'][i]), 'memory_gb': float(columns['memory_gb'][i]),
+                          'price_per_core_month': round((price * 730) / int(columns['cores'][i]), 2), 'price_per_gb_month': round((price * 730) / (float(columns['memory_mb'][i]) / 1024), 2),
+                          'sku_family': columns['sku_family'][i], 'cpu_arch': columns['cpu_arch'][i], 'sku_version': columns['sku_version'][i]})
+    return size_list
+
+# Concatenates the size columns of several regions into a single set of columns
+def concat_size_columns(columns_list):
+    return {column_name: np.concatenate([columns[column_name] for columns in columns_list]) for column_name in columns_list[0]}
+
+# Async credential that keeps the access tokens of DefaultAzureCredential in a file only readable by the user,
+# so that later runs reuse a valid token instead of going through the credential chain again.
+# DefaultAzureCredential is only created when no valid token is cached. Tokens are not cached with --no-cache.
+# Tokens are cached per identity (see get_identity), so that switching accounts does not reuse the previous one's tokens.
+class CachedTokenCredential:
+    # Cached tokens are not used if they expire in less than this number of seconds
+    expiry_margin = 300
+
+    def __init__(self, token_cache_file=None):
+        self.token_cache_file = token_cache_file or settings.token_cache_file
+        self.credential = None
+        self.identity = self.get_identity()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self.credential is not None:
+            await self.credential.close()
+            self.credential = None
+
+    # Returns the identity DefaultAzureCredential authenticates as, without going through the credential chain: the
+    # variables of the environment and managed identity credentials, and the default account of the Azure CLI
+    @staticmethod
+    def get_identity():
+        identity = [os.environ.get(name, '') for name in ('AZURE_CLIENT_ID', 'AZURE_TENANT_ID', 'AZURE_USERNAME', 'AZURE_CLIENT_CERTIFICATE_PATH')]
+        config_dir = os.environ.get('AZURE_CONFIG_DIR') or os.path.join(os.path.expanduser('~'), '.azure')
+        try:
+            with open(os.path.join(config_dir, 'azureProfile.json'), 'r', encoding='utf-8-sig') as f:
+                profile = json.load(f)
+            account = next(subscription for subscription in profile['subscriptions'] if subscription.get('isDefault'))
+            identity += [account['user']['name'], account['tenantId']]
+        except (OSError, ValueError, KeyError, TypeError, StopIteration):
+            identity += ['', '']
+        return '|'.join(identity)
+
+    def read_tokens(self):
+        try:
+            with open(self.token_cache_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    # Writes the tokens atomically, the file is created with 0600 permissions
+    def write_tokens(self, tokens):
+        os.makedirs(os.path.dirname(os.path.abspath(self.token_cache_file)), exist_ok=True)
+        temp_file = self.token_cache_file + '.tmp'
+        fd = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(tokens, f)
+        os.replace(temp_file, self.token_cache_file)
+
+    async def get_token(self, *scopes, claims=None, tenant_id=None, **kwargs):
+        from azure.core.credentials import AccessToken
+        token_key = ' '.join(sorted(scopes)) + '|' + (tenant_id or '') + '|' + self.identity
+        # Claims challenges always go to the credential chain
+        if not settings.no_cache and claims is None:
+            cached_token = self.read_tokens().get(token_key)
+            if cached_token is not None and cached_token['expires_on'] - time.time() > self.expiry_margin:
+                if settings.verbose:
+                    print("DEBUG: using cached access token for '{0}'".format(token_key))
+                return AccessToken(cached_token['token'], cached_token['expires_on'])
+        if self.credential is None:
+            from azure.identity.aio import DefaultAzureCredential
+            self.credential = DefaultAzureCredential()
+        access_token = await self.credential.get_token(*scopes, claims=claims, tenant_id=tenant_id, **kwargs)
+        if not settings.no_cache:
+            try:
+                tokens = {key: token for key, token in self.read_tokens().items() if token.get('expires_on', 0) > time.time()}
+                tokens[token_key] = {'token': access_token.token, 'expires_on': access_token.expires_on}
+                self.write_tokens(tokens)
+            except OSError as e:
+                print("WARNING: could not write the token cache file '{0}': {1}".format(self.token_cache_file, str(e)))
+        return access_token
+
+# Returns the names of the physical regions available to a subscription
+async def get_subscription_regions(credential, subscription_id):
+    try:
+        from azure.mgmt.resource.subscriptions.aio import SubscriptionClient
+    except ImportError:
+        print("ERROR: the azure-mgmt-resource package is required to get all regions, you can install it with 'pip install azure-mgmt-resource'.")
+        return []
+    async with SubscriptionClient(credential) as subscription_client:
+        return [location.name async for location in subscription_client.subscriptions.list_locations(subscription_id) if location.metadata is None or location.metadata.region_type == 'Physical']
+
+# Retrieves concurrently the VM sizes (with the async Compute client) and the prices (in a worker thread) of each region,
+# with at most max_parallel_regions regions in flight. All regions share the same credential and Compute client.
+# The VM sizes and the regions of the subscription are kept in the metadata cache for --vm-sizes-ttl seconds, and
+# the credential and the Compute client are only created if something has to be retrieved from Azure.
+# Returns the list of size columns of the regions that could be retrieved.
+async def get_vm_size_columns(regions, subscription_id, max_parallel_regions=4, base_url="https://prices.azure.com/api/retail/prices", api_version="2023-01-01-preview", currency="USD"):
+    import asyncio
+    import contextlib
+    semaphore = asyncio.Semaphore(max(max_parallel_regions, 1))
+    loop = asyncio.get_running_loop()
+    if regions == ['all']:
+        regions = metadata_cache_get('regions|' + subscription_id) or ['all']
+    cached_size_records = {region: metadata_cache_get('vm-sizes|{0}|{1}'.format(subscription_id, region)) for region in regions if region != 'all'}
+    async with contextlib.AsyncExitStack() as stack:
+        compute_client = None
+        if regions == ['all'] or None in cached_size_records.values():
+            credential = await stack.enter_async_context(CachedTokenCredential())
+            if regions == ['all']:
+                regions = await get_subscription_regions(credential, subscription_id)
+                if settings.verbose:
+                    print("DEBUG: Retrieved {0} regions for subscription '{1}'.".format(len(regions), subscription_id))
+                if len(regions) > 0:
+                    metadata_cache_put('regions|' + subscription_id, regions)
+            if None in [cached_size_records.get(region) for region in regions]:
+                from azure.mgmt.compute.aio import ComputeManagementClient
+                compute_client = await stack.enter_async_context(ComputeManagementClient(credential, subscription_id))
+        async def get_region_columns(region):
+            async with semaphore:
+                # Get the prices for the specified region
+                prices_future = loop.run_in_executor(None, functools.partial(load_price_index, f"armRegionName eq '{region}' and serviceName eq 'Virtual Machines' and priceType eq 'Consumption'", region=region, consumption_only=True, base_url=base_url, api_version=api_version, currency=currency))
+                size_records = cached_size_records.get(region)
+                if size_records is not None:
+                    if settings.verbose:
+                        print("DEBUG: Using {0} cached VM sizes for region '{1}'.".format(len(size_records), region))
+                else:
+                    # List VM sizes for a specific region
+                    size_records = [get_vm_size_record(size) async for size in compute_client.virtual_machine_sizes.list(location=region)]
+                    if settings.verbose:
+                        print("DEBUG: Retrieved {0} VM sizes for region '{1}' from the Microsoft.Compute API.".format(len(size_records), region))
+                    metadata_cache_put('vm-sizes|{0}|{1}'.format(subscription_id, region), size_records)
+                price_index = await prices_future
+            if price_index is None:
+                print("ERROR: Could not get pricing data for region '{0}'.".format(region))
+                return None
+            if settings.verbose:
+                print("DEBUG: Retrieved pricing data for region '{0}'. {1} SKUs found.".format(region, len(price_index)))
+            return build_size_columns(region, size_records, price_index=price_index)
+        results = await asyncio.gather(*[get_region_columns(region) for region in regions], return_exceptions=True)
+    columns_list = []
+    for region, result in zip(regions, results):
+        if isinstance(result, Exception):
+            print("ERROR: Could not get VM sizes for region '{0}': {1}".format(region, str(result)))
+        elif result is not None:
+            columns_list.append(result)
+    return columns_list
+
+# Get available VM sizes from one or more regions, equivalent to the Azure CLI command `az vm list-sizes --location <region>`
 # Use the Azure python SDK for Microsoft.Compute/VirtualMachines
-# Authenticate and initialize the client
-def get_vm_sizes(region, subscription_id="", cores=None, memory=None, cpu_arch=None, sku_version=None, hyperthreading=None, ephemeral_os_disk=None, sku_family=None):
-    if args.verbose:
-        print("DEBUG: Getting VM sizes for region '{0}' with filters: cores='{1}', memory='{2}', cpu_arch='{3}'".format(region, cores, memory, cpu_arch))
-    credential = DefaultAzureCredential()
+# The region parameter can be a comma-separated list of regions, a list of regions or "all"
+def get_vm_sizes(region, subscription_id="", cores=None, memory=None, cpu_arch=None, sku_version=None, hyperthreading=None, ephemeral_os_disk=None, sku_family=None, sort_by='price-per-core', top=None, max_parallel_regions=4, base_url="https://prices.azure.com/api/retail/prices", api_version="2023-01-01-preview", currency="USD"):
+    regions = [r.strip().lower() for r in region.split(',') if r.strip()] if isinstance(region, str) else list(region)
+    if settings.verbose:
+        print("DEBUG: Getting VM sizes for regions '{0}' with filters: cores='{1}', memory='{2}', cpu_arch='{3}'".format(','.join(regions), cores, memory, cpu_arch))
+    if not load_numpy():
+        return []
     if len(subscription_id) != 36:
         print("ERROR: subscription_id must be provided to get VM sizes.")
-        return
-    compute_client = ComputeManagementClient(credential, subscription_id)
-    # Get the prices for the specified region
-    region_prices = get_prices_json(query=f"armRegionName eq '{region}' and serviceName eq 'Virtual Machines' and priceType eq 'Consumption'")
-    if region_prices is None or 'Items' not in region_prices:
-        print("ERROR: Could not get pricing data for region '{0}'.".format(region))
-        return
-    if args.verbose:
-        print("DEBUG: Retrieved pricing data for region '{0}'. {1} items found.".format(region, len(region_prices['Items'])))
-    # List VM sizes for a specific region
-    vm_sizes = list(compute_client.virtual_machine_sizes.list(location=region))
-    size_list = []
-    if args.verbose:
-        print("DEBUG: Retrieved {0} VM sizes for region '{1}' from the Microsoft.Compute API.".format(len(vm_sizes), region))
-    for size in vm_sizes:
-        # if args.verbose:
-        #     print("DEBUG: Processing VM size '{0}' with {1} cores and {2} GB memory.".format(size.name, size.number_of_cores, round(size.memory_in_mb/1024, 0)))
-        # Add relevant fields to a new dictionary for easier access and filtering
-        this_size = {}
-        this_size['name'] = size.name
-        this_size['prefix'] = size.name.split('_')[0]
-        this_size['sku_family'] = size.name.split('_')[1]
-        this_size['sku_version'] = size.name.split('_')[-1].split('v')[-1]
-        if 'a' in str(this_size['sku_family']):
-            this_size['cpu_arch'] = 'amd'
-        elif 'p' in str(this_size['sku_family']):
-            this_size['cpu_arch'] = 'arm'
-        else:
-            this_size['cpu_arch'] = 'intel'
-        # Looks like the API doesnt return the capabilities
-        # https://learn.microsoft.com/rest/api/compute/virtual-machine-sizes/list?view=rest-compute-2025-04-01
-        # if 'EphemeralOSDiskSupported' in size['capabilities']:
-        #     size['ephemeral_os_disk'] = (size['capabilities']['EphemeralOSDiskSupported'].lower() == 'true')
-        # if 'vCPUsPerCore' in size['capabilities']:
-        #     size['hyperthreading'] = (size['capabilities']['vCPUsPerCore'] == '2')
-        # Filters
-        if (cores is not None and not number_in_range(size.number_of_cores, cores)):
-            # if args.verbose:
-            #     print("DEBUG: Skipping VM size '{0}' because number of cores {1} does not match filter '{2}'.".format(size.name, size.number_of_cores, cores))
-            continue
-        if (memory is not None and not number_in_range(round(size.memory_in_mb/1024, 0), memory)):
-            # if args.verbose:
-            #     print("DEBUG: Skipping VM size '{0}' because memory {1} GB does not match filter '{2}'.".format(size.name, round(size.memory_in_mb/1024, 0), memory))
-            continue
-        if (cpu_arch is not None and arch_in_list(this_size['cpu_arch'], cpu_arch.lower()) == False):
-            # if args.verbose:
-            #     print("DEBUG: Skipping VM size '{0}' because CPU architecture '{1}' does not match filter '{2}'.".format(size.name, size['cpu_arch'], cpu_arch))    
-            continue
-        if (sku_version is not None and sku_version != size['sku_version']):
-            # if args.verbose:
-            #     print("DEBUG: Skipping VM size '{0}' because SKU version '{1}' does not match filter '{2}'.".format(size.name, size['sku_version'], sku_version))
-            continue
-        if (sku_family is not None and not this_size['sku_family'][0].lower() in sku_family.lower()):
-            # if args.verbose:
-            #     print("DEBUG: Skipping VM size '{0}' because SKU family '{1}' does not match filter '{2}'.".format(size.name, this_size['sku_family'], sku_family))
-            continue
-        # Find the price for this VM size in the region_prices data
-        vm_price = None
-        for item in region_prices['Items']:
-            if item.get("armSkuName").lower() == size.name.lower():
-                if 'Windows' in item.get("productName", ""):
-                    # if args.verbose:
-                    #     print("DEBUG: Skipping Windows price for VM size '{0}'".format(size.name))
-                    continue
-                if "Low Priority" in item.get("skuName", "") or "Spot" in item.get("skuName", ""):
-                    # if args.verbose:
-                    #     print("DEBUG: Skipping Spot/Low Priority price for VM size '{0}'".format(size.name))
-                    continue
-                vm_price = item.get("retailPrice")
-                break
-        if vm_price is not None:
-            size_list.append({'size': size.name, 'price': vm_price, 'cores': size.number_of_cores, 'memory_gb': round(size.memory_in_mb / 1024, 0), 'price_per_core_month': round((vm_price * 730) / size.number_of_cores, 2), 'sku_family': this_size['sku_family'], 'cpu_arch': this_size['cpu_arch'], 'sku_version': this_size['sku_version']})
-        else:
-            if args.verbose:
-                print("DEBUG: No price found for VM size '{0}' in region '{1}'.".format(size.name, region))
-    # Debug
-    if args.verbose:
-        print("DEBUG: Found {0} VM sizes in region '{1}' matching the specified filters and with available pricing data.".format(len(size_list), region))
-    # Sort the list by price per core per month
-    size_list.sort(key=lambda x: x['price_per_core_month'])
-    return size_list
+        return []
+    import asyncio
+    columns_list = asyncio.run(get_vm_size_columns(regions, subscription_id, max_parallel_regions=max_parallel_regions, base_url=base_url, api_version=api_version, currency=currency))
+    if len(columns_list) == 0:
+        return []
+    # Filter and rank the sizes of all regions together
+    columns = concat_size_columns(columns_list)
+    mask = compile_size_filters(columns, cores=cores, memory=memory, cpu_arch=cpu_arch, sku_version=sku_version, sku_family=sku_family)
+    if settings.verbose:
+        print("DEBUG: Found {0} VM sizes in {1} regions matching the specified filters and with available pricing data.".format(int(mask.sum()), len(columns_list)))
+    return rank_sizes(columns, mask, sort_by=sort_by, top=top)
 
 # Print the VM sizes and prices generated by get_vm_sizes() in a table format
 def print_vm_sizes(size_list, number_of_rows=None):
+    # The region is only shown if the sizes of several regions are ranked together
+    show_region = len(set(entry['region'] for entry in size_list)) > 1
     # Print the header
-    print(f"{'VM Size':<25} {'Cores':>5} {'Memory':>7} {'Price (USD/hour)':>15} {'Price (USD/month)':>20} {'Price/core/month':>20}")
-    print("-" *  105)
+    if show_region:
+        print(f"{'Region':<20} ", end='')
+    print(f"{'VM Size':<25} {'Cores':>5} {'Memory':>7} {'Price (USD/hour)':>15} {'Price (USD/month)':>20} {'Price/core/month':>20} {'Price/GB/month':>20}")
+    print("-" *  (151 if show_region else 130))
     # Print the sizes and prices
     row_conter = 0
     for entry in size_list:
-        print(f"{entry['size']:<25} {entry['cores']:>3}   {entry['memory_gb']:6.0f}      ${entry['price']:7.4f}/h      ${round(entry['price'] * 730, 2):8.2f}/month      ${entry['price_per_core_month']:6.2f}/month*core")
+        if show_region:
+            print(f"{entry['region']:<20} ", end='')
+        print(f"{entry['size']:<25} {entry['cores']:>3}   {entry['memory_gb']:6.0f}      ${entry['price']:7.4f}/h      ${round(entry['price'] * 730, 2):8.2f}/month      ${entry['price_per_core_month']:6.2f}/month*core      ${entry['price_per_gb_month']:6.2f}/month*GB")
         row_conter += 1
         if number_of_rows is not None and row_conter >= number_of_rows:
             break
 
+# Returns the indexes of the sizes in the Pareto frontier of (cores, memory, price): sizes for which no other size has
+# at least as many cores and as much memory for at most the same price. Since a fleet can always use the dominating
+# size instead, the dominated sizes are never needed in an optimal mix.
+def pareto_frontier(cores, memory, price):
+    # Keep only the cheapest size of each (cores, memory) shape, so that the pairwise comparison runs over distinct shapes
+    order = np.lexsort((price, memory, cores))
+    shapes = np.stack([cores[order], memory[order]], axis=1)
+    first_of_shape = np.ones(len(order), dtype=bool)
+    first_of_shape[1:] = np.any(shapes[1:] != shapes[:-1], axis=1)
+    candidates = order[first_of_shape]
+    c, m, p = cores[candidates], memory[candidates], price[candidates]
+    # Shapes are distinct, so a size is dominated by any other size with at least as many cores and memory for at most its price
+    dominated = ((c[None, :] >= c[:, None]) & (m[None, :] >= m[:, None]) & (p[None, :] <= p[:, None]) & ~np.eye(len(candidates), dtype=bool)).any(axis=1)
+    return np.sort(candidates[~dominated])
+
+# Solves the linear relaxation of the fleet problem (fractional numbers of VMs), whose cost is a lower bound of the cost of
+# any mix. With two constraints the optimum uses at most two sizes, so all single sizes and pairs of sizes are evaluated.
+# Returns the cost and the fractional count of each size.
+def relax_fleet(cores, memory, price, need_cores, need_memory):
+    n = len(price)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        single_counts = np.maximum(np.where(need_cores > 0, need_cores / cores, 0), np.where(need_memory > 0, need_memory / memory, 0))
+        best = int(np.argmin(single_counts * price))
+        bound = float(single_counts[best] * price[best])
+        counts = np.zeros(n)
+        counts[best] = single_counts[best]
+        if n > 1 and need_cores > 0 and need_memory > 0:
+            # Counts x, y of a pair of sizes meeting both constraints exactly
+            determinant = cores[:, None] * memory[None, :] - cores[None, :] * memory[:, None]
+            x = (need_cores * memory[None, :] - need_memory * cores[None, :]) / determinant
+            y = (need_memory * cores[:, None] - need_cores * memory[:, None]) / determinant
+            pair_costs = np.where((x >= 0) & (y >= 0) & (determinant != 0), x * price[:, None] + y * price[None, :], np.inf)
+            i, j = np.unravel_index(np.argmin(pair_costs), pair_costs.shape)
+            if pair_costs[i, j] < bound:
+                bound = float(pair_costs[i, j])
+                counts = np.zeros(n)
+                counts[i], counts[j] = x[i, j], y[i, j]
+    return bound, counts
+
+# Returns the unit in which a dimension (cores or memory) of the fleet problem is discretized: the greatest common
+# divisor of the sizes and the requirement, or a coarser unit if the requirement would need more than resolution units
+def get_fleet_unit(values, need, resolution):
+    unit = int(np.gcd.reduce(np.append(values.astype(np.int64), int(need))))
+    if unit == 0 or need / unit > resolution:
+        unit = max(int(np.ceil(need / resolution)), 1)
+    return unit
+
+# Solves the fleet problem with dynamic programming over a grid of (cores, memory) units, where each cell holds the minimum
+# cost to cover at least those units. The grid is computed one row at a time, vectorized over sizes and columns. Sizes are
+# rounded down to whole units, so the mix always meets the requirements, and it is optimal if no unit had to be coarsened.
+# Returns the count of each size (or None if the requirements cannot be met) and whether the solution is exact.
+def solve_fleet_grid(cores, memory, price, need_cores, need_memory, resolution=512):
+    # Rows are the dimension with a requirement (cores unless only memory is required), so that every size used advances a row
+    if need_cores > 0:
+        row_values, column_values, need_rows, need_columns = cores, memory, need_cores, need_memory
+    else:
+        row_values, column_values, need_rows, need_columns = memory, cores, need_memory, need_cores
+    counts = np.zeros(len(price), dtype=np.int64)
+    if need_rows <= 0:
+        return counts, True
+    row_unit = get_fleet_unit(row_values, need_rows, resolution)
+    column_unit = get_fleet_unit(column_values, need_columns, resolution) if need_columns > 0 else 1
+    exact = bool(np.all(row_values % row_unit == 0) and need_rows % row_unit == 0 and np.all(column_values % column_unit == 0) and need_columns % column_unit == 0)
+    item_rows = (row_values // row_unit).astype(np.int64)
+    item_columns = (column_values // column_unit).astype(np.int64) if need_columns > 0 else np.zeros(len(price), dtype=np.int64)
+    n_rows = int(-(-need_rows // row_unit))
+    n_columns = int(-(-need_columns // column_unit)) if need_columns > 0 else 0
+    # Sizes smaller than a row unit cannot be used
+    usable = np.flatnonzero(item_rows > 0)
+    if len(usable) == 0:
+        return None, exact
+    item_rows, item_columns, item_price = item_rows[usable], item_columns[usable], price[usable]
+    cost = np.full((n_rows + 1, n_columns + 1), np.inf)
+    choice = np.full((n_rows + 1, n_columns + 1), -1, dtype=np.int32)
+    all_columns = np.arange(n_columns + 1)
+    previous_columns = np.maximum(all_columns[None, :] - item_columns[:, None], 0)
+    # Row 0 (no requirement left in the row dimension) only depends on itself
+    cost[0, 0] = 0
+    for column in range(1, n_columns + 1):
+        candidates = cost[0, previous_columns[:, column]] + item_price
+        best = int(np.argmin(candidates))
+        cost[0, column], choice[0, column] = candidates[best], best
+    for row in range(1, n_rows + 1):
+        previous_rows = np.maximum(row - item_rows, 0)
+        candidates = cost[previous_rows[:, None], previous_columns] + item_price[:, None]
+        best = np.argmin(candidates, axis=0)
+        cost[row] = candidates[best, all_columns]
+        choice[row] = best
+    if not np.isfinite(cost[n_rows, n_columns]):
+        return None, exact
+    # Walk back the choices from the full requirement
+    row, column = n_rows, n_columns
+    while row > 0 or column > 0:
+        item = choice[row, column]
+        counts[usable[item]] += 1
+        row, column = max(row - int(item_rows[item]), 0), max(column - int(item_columns[item]), 0)
+    return counts, exact
+
+# Returns the cheapest mix made of a single size, or None if no size can meet the requirements
+def cover_fleet_with_one_size(cores, memory, price, need_cores, need_memory):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vm_counts = np.maximum(np.where(need_cores > 0, np.ceil(need_cores / cores), 0), np.where(need_memory > 0, np.ceil(need_memory / memory), 0))
+        costs = np.where(np.isfinite(vm_counts), vm_counts * price, np.inf)
+    best = int(np.argmin(costs))
+    if not np.isfinite(costs[best]):
+        return None
+    counts = np.zeros(len(price), dtype=np.int64)
+    counts[best] = int(vm_counts[best])
+    return counts
+
+# Solves the fleet problem for the sizes of one region: the number of VMs of each size with at least need_cores cores and
+# need_memory of memory (in the unit of memory) in total, and minimum cost (an unbounded covering knapsack). Small fleets
+# are solved exactly with solve_fleet_grid(). For fleets too large for the grid, most VMs are taken from the solution of
+# the linear relaxation (which large optimal mixes follow closely), and only the remainder is solved on the grid. If the
+# sizes are too small for the units of the grid, the cheapest single-size mix is returned.
+# Returns the count of each size (or None if the requirements cannot be met) and whether the solution is proven optimal.
+def solve_fleet(cores, memory, price, need_cores, need_memory, resolution=512):
+    row_unit = get_fleet_unit(cores, need_cores, resolution) if need_cores > 0 else 1
+    column_unit = get_fleet_unit(memory, need_memory, resolution) if need_memory > 0 else 1
+    if np.all(cores % row_unit == 0) and need_cores % row_unit == 0 and np.all(memory % column_unit == 0) and need_memory % column_unit == 0:
+        return solve_fleet_grid(cores, memory, price, need_cores, need_memory, resolution=resolution)
+    # Leave about half of the grid of exact units for the remainder
+    exact_row_unit = int(np.gcd.reduce(cores.astype(np.int64)))
+    exact_column_unit = int(np.gcd.reduce(memory.astype(np.int64)))
+    share = 1.0
+    if need_cores > 0:
+        share = min(share, resolution * exact_row_unit / (2 * need_cores))
+    if need_memory > 0:
+        share = min(share, resolution * exact_column_unit / (2 * need_memory))
+    relaxed_counts = relax_fleet(cores, memory, price, need_cores, need_memory)[1]
+    bulk_counts = np.floor(relaxed_counts * (1 - share)).astype(np.int64)
+    remaining_cores = max(int(need_cores - np.dot(bulk_counts, cores)), 0)
+    remaining_memory = max(int(need_memory - np.dot(bulk_counts, memory)), 0)
+    counts = solve_fleet_grid(cores, memory, price, remaining_cores, remaining_memory, resolution=resolution)[0]
+    if counts is None:
+        counts = cover_fleet_with_one_size(cores, memory, price, remaining_cores, remaining_memory)
+        if counts is None:
+            return None, False
+    return bulk_counts + counts, False
+
+# Finds the cheapest mix of VM sizes in any single region of the size columns (see get_vm_sizes) with at least cores
+# cores and memory GB of memory in total, among the sizes selected by the mask. Regions are solved in order of their
+# lower bound (see relax_fleet), and regions whose bound is not lower than the best mix found are skipped.
+# Returns a dictionary with the region, the mix and its totals, or None if no region can meet the requirements.
+def optimize_fleet(columns, mask, cores=0, memory=0, resolution=512):
+    # Memory is optimized in whole MB, with the memory of the sizes rounded down, so that the mix never has less memory
+    # than requested (the whole GB shown by get-skus are rounded to the nearest GB)
+    need_memory = int(np.ceil(memory * 1024))
+    region_problems = []
+    for region in np.unique(columns['region'][mask]):
+        selected = np.flatnonzero(mask & (columns['region'] == region))
+        size_cores, size_memory, size_price = columns['cores'][selected].astype(np.int64), np.floor(columns['memory_mb'][selected]).astype(np.int64), columns['price'][selected] * 730
+        frontier = pareto_frontier(size_cores, size_memory, size_price)
+        selected, size_cores, size_memory, size_price = selected[frontier], size_cores[frontier], size_memory[frontier], size_price[frontier]
+        region_problems.append((relax_fleet(size_cores, size_memory, size_price, cores, need_memory)[0], region, selected, size_cores, size_memory, size_price))
+    region_problems.sort(key=lambda problem: problem[0])
+    best_fleet = None
+    for lower_bound, region, selected, size_cores, size_memory, size_price in region_problems:
+        if best_fleet is not None and lower_bound >= best_fleet['price_month']:
+            if settings.verbose:
+                print("DEBUG: Skipping region '{0}', its lower bound ${1:.2f}/month is not below the best mix found.".format(region, lower_bound))
+            continue
+        counts, exact = solve_fleet(size_cores, size_memory, size_price, cores, need_memory, resolution=resolution)
+        if counts is None:
+            continue
+        price_month = float(np.dot(counts, size_price))
+        if settings.verbose:
+            print("DEBUG: Best mix in region '{0}' with {1} Pareto-optimal sizes costs ${2:.2f}/month (lower bound ${3:.2f}/month{4}).".format(region, len(selected), price_month, lower_bound, '' if exact else ', approximate'))
+        if best_fleet is None or price_month < best_fleet['price_month']:
+            mix = [{'size': columns['size'][i], 'count': int(count), 'cores': int(columns['cores'][i]), 'memory_gb': float(columns['memory_mb'][i]) / 1024, 'price': float(columns['price'][i])}
+                   for i, count in zip(selected, counts) if count > 0]
+            mix.sort(key=lambda entry: -entry['count'])
+            best_fleet = {'region': region, 'mix': mix, 'vm_count': int(counts.sum()), 'cores': int(np.dot(counts, size_cores)),
+                          'memory_gb': float(np.dot(counts, columns['memory_mb'][selected])) / 1024,
+                          'price_month': round(price_month, 2), 'lower_bound_month': round(lower_bound, 2), 'exact': bool(exact)}
+    return best_fleet
+
+# Finds the cheapest mix of VM sizes in one of the regions with at least the requested cores and memory (GB) in total
+# The region parameter can be a comma-separated list of regions, a list of regions or "all", as in get_vm_sizes()
+def get_optimal_fleet(region, subscription_id="", cores=None, memory=None, cpu_arch=None, sku_version=None, sku_family=None, resolution=512, max_parallel_regions=4, base_url="https://prices.azure.com/api/retail/prices", api_version="2023-01-01-preview", currency="USD"):
+    regions = [r.strip().lower() for r in region.split(',') if r.strip()] if isinstance(region, str) else list(region)
+    if not load_numpy():
+        return None
+    if len(subscription_id) != 36:
+        print("ERROR: subscription_id must be provided to get VM sizes.")
+        return None
+    import asyncio
+    columns_list = asyncio.run(get_vm_size_columns(regions, subscription_id, max_parallel_regions=max_parallel_regions, base_url=base_url, api_version=api_version, currency=currency))
+    if len(columns_list) == 0:
+        return None
+    columns = concat_size_columns(columns_list)
+    mask = compile_size_filters(columns, cpu_arch=cpu_arch, sku_version=sku_version, sku_family=sku_family)
+    start_time = time.time()
+    fleet = optimize_fleet(columns, mask, cores=cores or 0, memory=memory or 0, resolution=resolution)
+    if settings.verbose:
+        print("DEBUG: Optimized the mix of {0} VM sizes in {1} regions in {2} ms.".format(int(mask.sum()), len(columns_list), round((time.time() - start_time) * 1000, 1)))
+    return fleet
+
+# Print the mix of VM sizes generated by get_optimal_fleet() in a table format
+def print_fleet(fleet):
+    print("Cheapest mix in region '{0}':".format(fleet['region']))
+    print(f"{'VM Size':<25} {'Count':>6} {'Cores':>7} {'Memory':>8} {'Price (USD/hour)':>17} {'Price (USD/month)':>20}")
+    print("-" * 88)
+    for entry in fleet['mix']:
+        print(f"{entry['size']:<25} {entry['count']:>6} {entry['count'] * entry['cores']:>7} {entry['count'] * entry['memory_gb']:>8.2f}      ${entry['count'] * entry['price']:9.4f}/h      ${round(entry['count'] * entry['price'] * 730, 2):10.2f}/month")
+    print("-" * 88)
+    print(f"{'Total':<25} {fleet['vm_count']:>6} {fleet['cores']:>7} {fleet['memory_gb']:>8.2f}      ${fleet['price_month'] / 730:9.4f}/h      ${fleet['price_month']:10.2f}/month")
+    if not fleet['exact']:
+        print("The VM sizes were rounded to coarser units, the mix may cost slightly more than the optimum (at least ${0:.2f}/month).".format(fleet['lower_bound_month']))
+
+# Keeps one async credential and Compute client alive in an event loop running in a background thread,
+# so that the serve command does not acquire a new credential for every VM size list
+class ComputeContext:
+    def __init__(self, subscription_id):
+        import asyncio
+        self.subscription_id = subscription_id
+        self.loop = asyncio.new_event_loop()
+        self.credential = None
+        self.compute_client = None
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    async def list_vm_sizes_async(self, region):
+        from azure.mgmt.compute.aio import ComputeManagementClient
+        if self.compute_client is None:
+            self.credential = CachedTokenCredential()
+            self.compute_client = ComputeManagementClient(self.credential, self.subscription_id)
+        return [get_vm_size_record(size) async for size in self.compute_client.virtual_machine_sizes.list(location=region)]
+
+    # Returns the VM size records of a region (see get_vm_size_record), from the metadata cache unless refresh is True
+    def list_vm_sizes(self, region, refresh=False):
+        import asyncio
+        cache_key = 'vm-sizes|{0}|{1}'.format(self.subscription_id, region)
+        size_records = metadata_cache_get(cache_key, refresh=refresh)
+        if size_records is None:
+            size_records = asyncio.run_coroutine_threadsafe(self.list_vm_sizes_async(region), self.loop).result()
+            metadata_cache_put(cache_key, size_records)
+        return size_records
+
+# Raised by the serve command when there is no pricing data for a region or SKU, answered with 404
+class PricingDataNotFoundError(LookupError):
+    pass
+
+# In-memory data of the serve command: price indexes per SKU or region pair, and VM size columns per region.
+# Entries are loaded on first use and refreshed in the background every refresh_interval seconds. Loads and
+# refreshes build a new dictionary that replaces the current one in a single assignment, so readers never
+# block on a refresh and keep seeing the previous data until the new data is complete.
+class WarmPricingState:
+    def __init__(self, subscription_id=None, refresh_interval=3600, base_url="https://prices.azure.com/api/retail/prices", api_version="2023-01-01-preview", currency="USD"):
+        self.base_url = base_url
+        self.api_version = api_version
+        self.currency = currency
+        self.refresh_interval = refresh_interval
+        self.compute_context = ComputeContext(subscription_id) if subscription_id else None
+        self.entries = {}
+        self.loaders = {}
+        self.write_lock = threading.Lock()
+        self.key_locks = {}
+
+    # Returns the value of a key, loading it with loader(refresh) if it is not in memory yet
+    def get(self, key, loader):
+        entries = self.entries
+        if key in entries:
+            return entries[key]
+        with self.write_lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        # Only one thread loads a given key, the others wait for it
+        with key_lock:
+            if key in self.entries:
+                return self.entries[key]
+            value = loader(False)
+            with self.write_lock:
+                new_entries = dict(self.entries)
+                new_entries[key] = value
+                self.loaders[key] = loader
+                self.entries = new_entries
+        return value
+
+    # Reloads all keys bypassing the response cache, swapping in the new values once all have been loaded
+    def refresh(self):
+        start_time = time.time()
+        refreshed_values = {}
+        for key, loader in list(self.loaders.items()):
+            try:
+                refreshed_values[key] = loader(True)
+            except Exception as e:
+                print("ERROR: could not refresh {0}, keeping the previous data: {1}".format(key, str(e)))
+        with self.write_lock:
+            new_entries = dict(self.entries)
+            new_entries.update(refreshed_values)
+            self.entries = new_entries
+        if settings.verbose:
+            print("DEBUG: refreshed {0} in-memory entries in {1} seconds".format(len(refreshed_values), round(time.time() - start_time, 1)))
+
+    def refresh_forever(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            self.refresh()
+
+    def get_price_index_loader(self, region=None, sku=None, consumption_only=False):
+        if region is not None and sku is not None:
+            query = f"armRegionName eq '{region}' and armSkuName eq '{sku}'"
+        elif sku is not None:
+            query = f"armSkuName eq '{sku}' and type eq 'Consumption'"
+        else:
+            query = f"armRegionName eq '{region}' and serviceName eq 'Virtual Machines' and priceType eq 'Consumption'"
+        def loader(refresh):
+            price_index = load_price_index(query, region=region, sku=sku, consumption_only=consumption_only, base_url=self.base_url, api_version=self.api_version, currency=self.currency, refresh=refresh)
+            if price_index is None:
+                raise PricingDataNotFoundError("no pricing data found")
+            return price_index
+        return loader
+
+    def get_price_index(self, region=None, sku=None, consumption_only=False):
+        return self.get(('prices', region, sku, consumption_only), self.get_price_index_loader(region=region, sku=sku, consumption_only=consumption_only))
+
+    def get_size_columns(self, region):
+        if self.compute_context is None:
+            raise RuntimeError("the server was started without --subscription-id")
+        def loader(refresh):
+            size_records = self.compute_context.list_vm_sizes(region, refresh=refresh)
+            # On refreshes the prices are reloaded too, instead of reusing the in-memory price index
+            if refresh:
+                price_index = self.get_price_index_loader(region=region, consumption_only=True)(True)
+            else:
+                price_index = self.get_price_index(region=region, consumption_only=True)
+            return build_size_columns(region, size_records, price_index)
+        return self.get(('sizes', region), loader)
+
+    def compare_regions(self, sku):
+        return get_region_prices(self.get_price_index(sku=sku.lower(), consumption_only=True))
+
+    def get_price(self, region, sku):
+        record = self.get_price_index(region=region.lower(), sku=sku.lower()).get((region.lower(), sku.lower()))
+        if record is None:
+            raise PricingDataNotFoundError("no pricing data found for SKU '{0}' in region '{1}'".format(sku, region))
+        return get_price_details(record)
+
+    def get_skus(self, regions, cores=None, memory=None, cpu_arch=None, sku_version=None, sku_family=None, sort_by='price-per-core', top=None):
+        if not load_numpy():
+            raise RuntimeError("the numpy package is required to get VM sizes")
+        columns = concat_size_columns([self.get_size_columns(region.strip().lower()) for region in regions.split(',') if region.strip()])
+        mask = compile_size_filters(columns, cores=cores, memory=memory, cpu_arch=cpu_arch, sku_version=sku_version, sku_family=sku_family)
+        return rank_sizes(columns, mask, sort_by=sort_by, top=top)
+
+# HTTP handler of the serve command, one JSON endpoint per command. It is combined with
+# http.server.BaseHTTPRequestHandler in serve(), so that http.server is only imported by the serve command:
+#   GET /compare-regions?sku=SKU
+#   GET /get-price?region=REGION&sku=SKU
+#   GET /get-skus?region=REGION1,REGION2&cores=4-8&memory=16&cpu_arch=a,i&sku_family=D&sku_version=5-6&sort_by=price-per-core&top=10
+# Unknown paths, missing parameters and malformed parameters are answered with 400, pricing data that is not found
+# (PricingDataNotFoundError) with 404, and other errors with 500.
+class PricingRequestHandler:
+    protocol_version = 'HTTP/1.1'
+
+    # Raises ValueError if a query parameter is not valid
+    @staticmethod
+    def validate_params(params):
+        for name in ('cores', 'memory', 'sku_version'):
+            if params.get(name) and parse_range(params[name]) is None:
+                raise ValueError("'{0}' must be a number or a range like 4-16, not '{1}'".format(name, params[name]))
+        if params.get('top') and not (params['top'].isascii() and params['top'].isdigit()):
+            raise ValueError("'top' must be a non-negative integer, not '{0}'".format(params['top']))
+        if params.get('sort_by') and params['sort_by'] not in ('price-per-core', 'price-per-gb', 'price'):
+            raise ValueError("'sort_by' must be price-per-core, price-per-gb or price, not '{0}'".format(params['sort_by']))
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        params = {key: values[0] for key, values in urllib.parse.parse_qs(url.query).items()}
+        state = self.server.pricing_state
+        try:
+            self.validate_params(params)
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        try:
+            if url.path == '/healthcheck':
+                self.send_json(200, {'health': 'OK'})
+            elif url.path == '/compare-regions' and params.get('sku'):
+                self.send_json(200, state.compare_regions(params['sku']))
+            elif url.path == '/get-price' and params.get('region') and params.get('sku'):
+                self.send_json(200, state.get_price(params['region'], params['sku']))
+            elif url.path == '/get-skus' and params.get('region') and (params.get('cores') or params.get('memory')):
+                top = int(params['top']) if params.get('top') else None
+                self.send_json(200, state.get_skus(params['region'], cores=params.get('cores'), memory=params.get('memory'), cpu_arch=params.get('cpu_arch'), sku_version=params.get('sku_version'),
+                                                   sku_family=params.get('sku_family'), sort_by=params.get('sort_by', 'price-per-core'), top=top))
+            else:
+                self.send_json(400, {'error': 'unknown path or missing parameters'})
+        except PricingDataNotFoundError as e:
+            self.send_json(404, {'error': str(e)})
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+
+    def log_message(self, format, *log_args):
+        if settings.verbose:
+            super().log_message(format, *log_args)
+
+# Runs the HTTP server of the serve command, with a background thread refreshing the in-memory data
+def serve(host='127.0.0.1', port=8080, subscription_id=None, refresh_interval=3600, base_url="https://prices.azure.com/api/retail/prices", api_version="2023-01-01-preview", currency="USD"):
+    import http.server
+    handler_class = type('PricingHTTPRequestHandler', (PricingRequestHandler, http.server.BaseHTTPRequestHandler), {})
+    state = WarmPricingState(subscription_id=subscription_id, refresh_interval=refresh_interval, base_url=base_url, api_version=api_version, currency=currency)
+    threading.Thread(target=state.refresh_forever, daemon=True).start()
+    server = http.server.ThreadingHTTPServer((host, port), handler_class)
+    server.daemon_threads = True
+    server.pricing_state = state
+    print("INFO: serving pricing endpoints on http://{0}:{1}".format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
 ################
 # Main program #
 ################
@@ -302,27 +1689,215 @@ base_url = "https://prices.azure.com/api/retail/prices"
 api_version = "2023-01-01-preview"
 currency = "USD"    # Could become an input argument later
 
-# Compare
-if args.command == 'compare-regions':
-    if args.sku:
-        get_prices_sku_all_regions(args.sku, base_url=base_url, api_version=api_version, currency=currency, format="table")
-    else:
-        print("ERROR: --sku argument is required for 'compare' command.")
-elif args.command == 'get-price':
-    if args.region and args.sku:
-        get_prices_sku(args.region, args.sku, base_url=base_url, api_version=api_version, currency=currency, format=args.format)
-    else:
-        print("ERROR: --region and --sku arguments are required for 'get-price' command.")
-elif args.command == 'get-skus':
-    if args.region and args.subscription_id:
-        if args.cores or args.memory:
-            vm_sizes = get_vm_sizes(args.region, subscription_id=args.subscription_id, cores=args.cores, memory=args.memory, cpu_arch=args.cpu_arch, sku_version=args.sku_version, sku_family=args.sku_family)
-            if args.only_cheapest:
-                vm_sizes = vm_sizes[:1]
-            print_vm_sizes(vm_sizes)
+# Returns the parser for the command-line arguments
+def get_arg_parser():
+    # Get input arguments
+    parser = argparse.ArgumentParser(description='Azure pricing CLI', prog='pricing')
+    subparsers = parser.add_subparsers(dest='command', help='Command help')
+    # Define common shared arguments
+    base_subparser = argparse.ArgumentParser(add_help=False)
+    base_subparser.add_argument('--verbose', dest='verbose', action='store_true',
+                        default=False,
+                        help='run in verbose mode (default: False)')
+    base_subparser.add_argument('--no-cache', dest='no_cache', action='store_true',
+                        default=False,
+                        help='do not read or write the local cache of Retail Prices API responses, VM sizes and access tokens (default: False)')
+    base_subparser.add_argument('--refresh', dest='refresh', action='store_true',
+                        default=False,
+                        help='ignore cached responses and VM sizes and refresh them from Azure (default: False)')
+    base_subparser.add_argument('--cache-ttl', dest='cache_ttl', metavar= 'SECONDS', action='store', type=int,
+                        default=86400,
+                        help='time in seconds after which cached responses expire (default: 86400)')
+    base_subparser.add_argument('--cache-max-mb', dest='cache_max_mb', metavar= 'MB', action='store', type=int,
+                        default=256,
+                        help='maximum size of the local cache in MB, least recently used responses are evicted first (default: 256)')
+    base_subparser.add_argument('--cache-file', dest='cache_file', metavar= 'CACHE_FILE', action='store',
+                        default=default_cache_file,
+                        help='SQLite file for the local cache (default: {0})'.format(default_cache_file))
+    base_subparser.add_argument('--concurrency', dest='concurrency', metavar= 'N', action='store', type=int,
+                        default=8,
+                        help='maximum number of Retail Prices API pages fetched in parallel, 1 to fetch pages sequentially (default: 8)')
+    base_subparser.add_argument('--offline', dest='offline', action='store_true',
+                        default=False,
+                        help='answer price queries from the local snapshot created with the sync command, without calling the Retail Prices API (default: False)')
+    base_subparser.add_argument('--snapshot-file', dest='snapshot_file', metavar= 'SNAPSHOT_FILE', action='store',
+                        default=default_snapshot_file,
+                        help='local snapshot of the VM price catalog (default: {0})'.format(default_snapshot_file))
+    # Define the arguments shared by the commands that get VM sizes from the Microsoft.Compute API
+    compute_subparser = argparse.ArgumentParser(add_help=False)
+    compute_subparser.add_argument('--vm-sizes-ttl', dest='vm_sizes_ttl', metavar= 'SECONDS', action='store', type=int, default=604800,
+                        help='time in seconds after which the cached VM sizes and regions of the subscription expire (default: 604800)')
+    compute_subparser.add_argument('--token-cache-file', dest='token_cache_file', metavar= 'TOKEN_CACHE_FILE', action='store', default=default_token_cache_file,
+                        help='file (only readable by the user) where Azure access tokens are cached between runs (default: {0})'.format(default_token_cache_file))
+    # Define the arguments shared by the commands that use the price history
+    history_subparser = argparse.ArgumentParser(add_help=False)
+    history_subparser.add_argument('--history-file', dest='history_file', metavar= 'HISTORY_FILE', action='store', default=default_history_file,
+                        help='SQLite file with the price history recorded by the sync command (default: {0})'.format(default_history_file))
+    # Create the 'compare-regions' command
+    compare_parser = subparsers.add_parser('compare-regions', help='Compare prices of a SKU across regions', parents=[base_subparser])
+    compare_parser.add_argument('--sku', '-s', dest='sku', metavar= 'SKU', action='store',
+                        help='SKU to be analyzed across regions, for example Standard_NC24ads_A100_v4')
+    # Create the 'get-skus' command
+    get_skus_parser = subparsers.add_parser('get-skus', help='Get available VM sizes and prices in one or more regions', parents=[base_subparser, compute_subparser])
+    get_skus_parser.add_argument('--region', '--location', '-l', dest='region', metavar= 'REGION', action='store',
+                        help='Comma-separated Azure regions to get available VM sizes for, for example eastus2,swedencentral, or "all" for all regions of the subscription')
+    get_skus_parser.add_argument('--max-parallel-regions', dest='max_parallel_regions', metavar= 'N', action='store', type=int, default=4,
+                        help='Maximum number of regions whose VM sizes and prices are retrieved in parallel (default: 4)')
+    get_skus_parser.add_argument('--cores', '-c', dest='cores', metavar= 'CORES', action='store',
+                        help='Number of CPUs for the VM sizes to be listed. Either single number or range (e.g., 4-16)')
+    get_skus_parser.add_argument('--memory', '-m', dest='memory', metavar= 'MEMORY_GB', action='store',
+                        help='Amount of memory (in GB) for the VM sizes to be listed. Either single number or range (e.g., 16-64)')
+    get_skus_parser.add_argument('--cpu-arch', dest='cpu_arch', metavar= 'CPU_ARCH', action='store',
+                        help='Comma-separated CPU architectures for the VM sizes to be listed ("i" for Intel, "a" for AMD, "p" for ARM)'),
+    get_skus_parser.add_argument('--sku-family', dest='sku_family', metavar= 'SKU_FAMILY', action='store',
+                        help='Comma-separated SKU families for the VM sizes to be listed (e.g., "A,N,D,E")'),
+    get_skus_parser.add_argument('--sku-version', dest='sku_version', metavar= 'VM_SKU_VERSION', action='store',
+                        help='VM SKU version to filter the VM sizes to be listed (e.g., "6" or "5-6")')
+    get_skus_parser.add_argument('--subscription-id', dest='subscription_id', metavar= 'SUBSCRIPTION_ID', action='store',
+                        help='Azure Subscription ID to use for authentication')
+    get_skus_parser.add_argument('--only-cheapest', dest='only_cheapest', action='store_true',
+                        default=False, help='only return the cheapest SKU (default: False)')
+    get_skus_parser.add_argument('--sort-by', dest='sort_by', metavar= 'SORT_BY', action='store', default='price-per-core',
+                        choices=['price-per-core', 'price-per-gb', 'price'],
+                        help='Ranking criteria for the VM sizes: price-per-core (default), price-per-gb or price')
+    get_skus_parser.add_argument('--top', dest='top', metavar= 'N', action='store', type=int,
+                        help='only return the N cheapest VM sizes according to --sort-by')
+    # Create the 'optimize' command
+    optimize_parser = subparsers.add_parser('optimize', help='Find the cheapest mix of VM sizes with a total number of cores and memory in one of several regions', parents=[base_subparser, compute_subparser])
+    optimize_parser.add_argument('--region', '--location', '-l', dest='region', metavar= 'REGION', action='store',
+                        help='Comma-separated Azure regions to consider, for example eastus2,swedencentral, or "all" for all regions of the subscription')
+    optimize_parser.add_argument('--max-parallel-regions', dest='max_parallel_regions', metavar= 'N', action='store', type=int, default=4,
+                        help='Maximum number of regions whose VM sizes and prices are retrieved in parallel (default: 4)')
+    optimize_parser.add_argument('--cores', '-c', dest='cores', metavar= 'CORES', action='store', type=int,
+                        help='Minimum total number of CPUs of the mix')
+    optimize_parser.add_argument('--memory', '-m', dest='memory', metavar= 'MEMORY_GB', action='store', type=int,
+                        help='Minimum total amount of memory (in GB) of the mix')
+    optimize_parser.add_argument('--cpu-arch', dest='cpu_arch', metavar= 'CPU_ARCH', action='store',
+                        help='Comma-separated CPU architectures of the VM sizes to use ("i" for Intel, "a" for AMD, "p" for ARM)')
+    optimize_parser.add_argument('--sku-family', dest='sku_family', metavar= 'SKU_FAMILY', action='store',
+                        help='Comma-separated SKU families of the VM sizes to use (e.g., "D,E")')
+    optimize_parser.add_argument('--sku-version', dest='sku_version', metavar= 'VM_SKU_VERSION', action='store',
+                        help='VM SKU versions of the VM sizes to use (e.g., "6" or "5-6")')
+    optimize_parser.add_argument('--subscription-id', dest='subscription_id', metavar= 'SUBSCRIPTION_ID', action='store',
+                        help='Azure Subscription ID to use for authentication')
+    optimize_parser.add_argument('--resolution', dest='resolution', metavar= 'N', action='store', type=int, default=512,
+                        help='Maximum number of units in which the cores and the memory are discretized, higher values are slower but more accurate for large fleets (default: 512)')
+    optimize_parser.add_argument('--format', '-f', '-o', dest='format', metavar= 'FORMAT', action='store', default='table',
+                        help='Output format: table (default), json')
+    # Create the 'get-price' command
+    get_price_parser = subparsers.add_parser('get-price', help='Get price for a specific SKU in a region', parents=[base_subparser])
+    get_price_parser.add_argument('--region', '--location', '-l', dest='region', metavar= 'REGION', action='store',
+                        help='Azure region to get the price for, for example eastus2')
+    get_price_parser.add_argument('--sku', '-s', dest='sku', metavar= 'SKU', action='store',
+                        help='SKU to get the price for, for example Standard_NC24ads_A100_v4')
+    get_price_parser.add_argument('--format', '-f', '-o', dest='format', metavar= 'FORMAT', action='store', default='details',
+                        help='Output format: details (default), json, table')
+    # Create the 'batch' command
+    batch_parser = subparsers.add_parser('batch', help='Get prices for a list of SKUs and regions read from a JSONL or CSV file', parents=[base_subparser])
+    batch_parser.add_argument('--input', '-i', dest='input', metavar= 'INPUT_FILE', action='store', default='-',
+                        help='JSONL file with one {"region": ..., "sku": ...} object per line, or CSV file with region and sku columns (default: stdin)')
+    batch_parser.add_argument('--max-filter-length', dest='max_filter_length', metavar= 'CHARS', action='store', type=int, default=1500,
+                        help='Maximum URL-encoded length of each coalesced $filter query (default: 1500)')
+    batch_parser.add_argument('--parallel-queries', dest='parallel_queries', metavar= 'N', action='store', type=int, default=4,
+                        help='Maximum number of coalesced queries sent in parallel (default: 4)')
+    # Create the 'sync' command
+    sync_parser = subparsers.add_parser('sync', help='Download the VM price catalog into a local snapshot for --offline usage', parents=[base_subparser, history_subparser])
+    sync_parser.add_argument('--no-history', dest='no_history', action='store_true',
+                        default=False, help='do not append the downloaded prices to the price history (default: False)')
+    sync_parser.add_argument('--full', dest='full', action='store_true',
+                        default=False, help='download the full catalog instead of only the prices changed since the last sync (default: False)')
+    # Create the 'history' command
+    history_parser = subparsers.add_parser('history', help='Show the prices of a SKU over time, or the biggest price changes since a date, from the price history', parents=[base_subparser, history_subparser])
+    history_parser.add_argument('--sku', '-s', dest='sku', metavar= 'SKU', action='store',
+                        help='SKU to show the prices over time for, for example Standard_D4s_v5')
+    history_parser.add_argument('--movers-since', dest='movers_since', metavar= 'DATE', action='store',
+                        help='show the prices with the largest relative change since DATE (YYYY-MM-DD) instead')
+    history_parser.add_argument('--region', '--location', '-l', dest='region', metavar= 'REGION', action='store',
+                        help='Comma-separated Azure regions to include (default: all regions)')
+    history_parser.add_argument('--since', dest='since', metavar= 'DATE', action='store',
+                        help='only show the prices of --sku effective on or after DATE (YYYY-MM-DD)')
+    history_parser.add_argument('--top', dest='top', metavar= 'N', action='store', type=int, default=20,
+                        help='Number of prices shown with --movers-since (default: 20)')
+    history_parser.add_argument('--format', '-f', '-o', dest='format', metavar= 'FORMAT', action='store', default='table',
+                        help='Output format: table (default), json')
+    # Create the 'serve' command
+    serve_parser = subparsers.add_parser('serve', help='Serve compare-regions, get-price and get-skus as HTTP/JSON endpoints with warm in-memory data', parents=[base_subparser, compute_subparser])
+    serve_parser.add_argument('--host', dest='host', metavar= 'HOST', action='store', default='127.0.0.1',
+                        help='Address to listen on (default: 127.0.0.1)')
+    serve_parser.add_argument('--port', '-p', dest='port', metavar= 'PORT', action='store', type=int, default=8080,
+                        help='TCP port to listen on (default: 8080)')
+    serve_parser.add_argument('--refresh-interval', dest='refresh_interval', metavar= 'SECONDS', action='store', type=int, default=3600,
+                        help='Interval in seconds to refresh the prices and VM sizes kept in memory (default: 3600)')
+    serve_parser.add_argument('--subscription-id', dest='subscription_id', metavar= 'SUBSCRIPTION_ID', action='store',
+                        help='Azure Subscription ID to use for the get-skus endpoint')
+    return parser
+
+def main(argv=None):
+    parser = get_arg_parser()
+    args = parser.parse_args(argv)
+    # Apply the shared arguments to the module settings
+    configure(**{key: value for key, value in vars(args).items() if hasattr(settings, key)})
+
+    # Compare
+    if args.command == 'compare-regions':
+        if args.sku:
+            get_prices_sku_all_regions(args.sku, base_url=base_url, api_version=api_version, currency=currency, format="table")
         else:
-            print("ERROR: At least one of --cores or --memory arguments must be provided to filter VM sizes.")
+            print("ERROR: --sku argument is required for 'compare' command.")
+    elif args.command == 'get-price':
+        if args.region and args.sku:
+            get_prices_sku(args.region, args.sku, base_url=base_url, api_version=api_version, currency=currency, format=args.format)
+        else:
+            print("ERROR: --region and --sku arguments are required for 'get-price' command.")
+    elif args.command == 'get-skus':
+        if args.region and args.subscription_id:
+            if args.cores or args.memory:
+                top = 1 if args.only_cheapest else args.top
+                vm_sizes = get_vm_sizes(args.region, subscription_id=args.subscription_id, cores=args.cores, memory=args.memory, cpu_arch=args.cpu_arch, sku_version=args.sku_version, sku_family=args.sku_family, sort_by=args.sort_by, top=top, max_parallel_regions=args.max_parallel_regions, base_url=base_url, api_version=api_version, currency=currency)
+                print_vm_sizes(vm_sizes)
+            else:
+                print("ERROR: At least one of --cores or --memory arguments must be provided to filter VM sizes.")
+        else:
+            print("ERROR: --region and --subscription-id arguments are required for 'get-skus' command.")
+    elif args.command == 'optimize':
+        if args.region and args.subscription_id:
+            if args.cores or args.memory:
+                fleet = get_optimal_fleet(args.region, subscription_id=args.subscription_id, cores=args.cores, memory=args.memory, cpu_arch=args.cpu_arch, sku_version=args.sku_version, sku_family=args.sku_family, resolution=args.resolution, max_parallel_regions=args.max_parallel_regions, base_url=base_url, api_version=api_version, currency=currency)
+                if fleet is None:
+                    print("ERROR: No mix of VM sizes with pricing data meets the specified requirements.")
+                elif args.format == 'json':
+                    print(json.dumps(fleet, indent=4))
+                else:
+                    print_fleet(fleet)
+            else:
+                print("ERROR: At least one of --cores or --memory arguments must be provided for 'optimize' command.")
+        else:
+            print("ERROR: --region and --subscription-id arguments are required for 'optimize' command.")
+    elif args.command == 'serve':
+        serve(host=args.host, port=args.port, subscription_id=args.subscription_id, refresh_interval=args.refresh_interval, base_url=base_url, api_version=api_version, currency=currency)
+    elif args.command == 'sync':
+        sync_price_snapshot(args.snapshot_file, full=args.full, record_history=not args.no_history, base_url=base_url, api_version=api_version, currency=currency)
+    elif args.command == 'history':
+        regions = [r.strip() for r in args.region.split(',') if r.strip()] if args.region else None
+        if args.movers_since:
+            result = get_price_movers(args.movers_since, regions=regions, sku=args.sku, top=args.top)
+            print_function = print_price_movers
+        elif args.sku:
+            result = get_price_history(args.sku, regions=regions, since=args.since)
+            print_function = print_price_history
+        else:
+            print("ERROR: --sku or --movers-since argument is required for 'history' command.")
+            result = None
+        if result is not None:
+            if args.format == 'json':
+                print(json.dumps(result, indent=4))
+            else:
+                print_function(result)
+    elif args.command == 'batch':
+        batch_queries = read_batch_queries(args.input)
+        get_prices_batch(batch_queries, base_url=base_url, api_version=api_version, currency=currency, max_filter_length=args.max_filter_length, parallel_queries=args.parallel_queries)
     else:
-        print("ERROR: --region and --subscription-id arguments are required for 'get-skus' command.")
-else:
-    parser.print_help()
\ No newline at end of file
+        parser.print_help()
+
+if __name__ == "__main__":
+    main()
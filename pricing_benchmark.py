@@ -0,0 +1,534 @@
+#!/usr/bin/python
+# Offline benchmark suite for pricing.py
+# A local stand-in for the Azure Retail Prices API replays a price catalog (recorded from the live API with the
+# 'record' command, or generated synthetically) with the same $filter and $skip-based NextPageLink pagination,
+# and a fake async Compute client returns the VM sizes of the catalog. Each scenario runs in a separate process
+# and reports latency, pages/sec, peak RSS and allocations, so that changes to get_prices_json, get_vm_sizes
+# and the output formatting can be compared without hitting Azure.
+# The 'startup' command measures the cold start of each pricing.py command, also in a separate process per run. Since
+# that process loads this module too, pricing.py and the modules that are not needed by every command (http.server,
+# statistics, subprocess, tracemalloc...) are imported by the functions that use them.
+import argparse
+import importlib.abc
+import importlib.util
+import json
+import os
+import re
+import sys
+import threading
+import time
+import types
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Get input arguments
+parser = argparse.ArgumentParser(description='Offline benchmark suite for the Azure pricing CLI', prog='pricing_benchmark')
+subparsers = parser.add_subparsers(dest='command', help='Command help')
+# Create the 'run' command
+run_parser = subparsers.add_parser('run', help='Run the benchmark scenarios against a local stand-in of the Retail Prices API')
+run_parser.add_argument('--fixture-dir', dest='fixture_dir', metavar= 'DIR', action='store',
+                    help='Directory with a catalog recorded with the record command (default: generate a synthetic catalog)')
+run_parser.add_argument('--scenarios', dest='scenarios', metavar= 'SCENARIOS', action='store', default='get-prices-json,compare-regions,get-price,get-skus',
+                    help='Comma-separated scenarios to run (default: get-prices-json,compare-regions,get-price,get-skus)')
+run_parser.add_argument('--concurrency', dest='concurrency', metavar= 'N', action='store', default='1,8',
+                    help='Comma-separated values of the pricing.py --concurrency setting to benchmark (default: 1,8)')
+run_parser.add_argument('--repeat', dest='repeat', metavar= 'N', action='store', type=int, default=5,
+                    help='Number of timed runs per scenario, the median is reported (default: 5)')
+run_parser.add_argument('--latency-ms', dest='latency_ms', metavar= 'MS', action='store', type=int, default=20,
+                    help='Latency added by the stand-in server to every page, to simulate the round-trip time (default: 20)')
+run_parser.add_argument('--page-size', dest='page_size', metavar= 'N', action='store', type=int, default=1000,
+                    help='Number of items per page served by the stand-in server (default: 1000)')
+run_parser.add_argument('--regions', dest='regions', metavar= 'N', action='store', type=int, default=4,
+                    help='Number of regions of the synthetic catalog (default: 4)')
+# Create the 'record' command
+record_parser = subparsers.add_parser('record', help='Record a catalog from the live Retail Prices API (and optionally VM sizes) into a fixture directory')
+record_parser.add_argument('--fixture-dir', dest='fixture_dir', metavar= 'DIR', action='store', required=True,
+                    help='Directory to write the fixtures to')
+record_parser.add_argument('--region', '-l', dest='regions', metavar= 'REGIONS', action='store', required=True,
+                    help='Comma-separated regions whose VM prices are recorded')
+record_parser.add_argument('--subscription-id', dest='subscription_id', metavar= 'SUBSCRIPTION_ID', action='store',
+                    help='Azure Subscription ID to record the VM sizes of the regions too')
+# Internal command to run a single scenario in a separate process
+scenario_parser = subparsers.add_parser('run-scenario')
+scenario_parser.add_argument('--scenario', dest='scenario', action='store', required=True)
+scenario_parser.add_argument('--base-url', dest='base_url', action='store', required=True)
+scenario_parser.add_argument('--fixture-dir', dest='fixture_dir', action='store', required=True)
+scenario_parser.add_argument('--concurrency', dest='concurrency', action='store', type=int, default=8)
+scenario_parser.add_argument('--repeat', dest='repeat', action='store', type=int, default=5)
+# Create the 'startup' command
+startup_parser = subparsers.add_parser('startup', help='Measure the cold-start time of each pricing.py command and fail if it exceeds a budget')
+startup_parser.add_argument('--budget-ms', dest='budget_ms', metavar= 'MS', action='store', type=int,
+                    help='Maximum cold-start time in milliseconds for every command (default: 300, 1000 for get-skus and optimize)')
+startup_parser.add_argument('--runs', dest='runs', metavar= 'N', action='store', type=int, default=5,
+                    help='Number of runs per command, the median is compared with the budget (default: 5)')
+# Internal command to run a single pricing.py command in a separate process, the arguments after the options are passed to pricing.py
+startup_command_parser = subparsers.add_parser('startup-command')
+startup_command_parser.add_argument('--base-url', dest='base_url', action='store', required=True)
+startup_command_parser.add_argument('--fixture-dir', dest='fixture_dir', action='store', required=True)
+startup_command_parser.add_argument('pricing_args', nargs=argparse.REMAINDER)
+
+###########
+# Catalog #
+###########
+
+# Generates a synthetic VM catalog: for every size and region, Linux and Windows on-demand, spot and low-priority
+# prices plus 1 and 3 year reservations, with the same fields as the Retail Prices API items
+def generate_catalog(regions=4):
+    sizes = []
+    for family in ['A', 'B', 'D', 'E', 'F', 'L', 'M', 'N']:
+        for suffix in ['', 's', 'as', 'ps']:
+            for version in [3, 4, 5, 6]:
+                for cores in [2, 4, 8, 16, 32, 48, 64, 96]:
+                    memory_gb = cores * {'E': 8, 'M': 16, 'F': 2}.get(family, 4)
+                    sizes.append({'name': f"Standard_{family}{cores}{suffix}_v{version}", 'number_of_cores': cores, 'memory_in_mb': memory_gb * 1024})
+    items = []
+    meter_id = 0
+    for region_no in range(regions):
+        region = f"benchregion{region_no}"
+        for size in sizes:
+            price = round(size['number_of_cores'] * 0.045 * (1 + 0.03 * region_no) * (1.2 if size['name'].split('_')[1][0] in 'MN' else 1.0), 4)
+            sku_name = size['name'].split('_', 1)[1].replace('_', ' ')
+            product_name = f"Virtual Machines {size['name'].split('_')[1][0]} Series"
+            for item_type, sku_suffix, product_suffix, factor, term in [('Consumption', '', '', 1.0, None), ('Consumption', ' Spot', '', 0.2, None), ('Consumption', ' Low Priority', '', 0.25, None),
+                                                                       ('Consumption', '', ' Windows', 1.4, None), ('Consumption', ' Spot', ' Windows', 0.3, None),
+                                                                       ('Reservation', '', '', 730 * 12 * 0.6, '1 Year'), ('Reservation', '', '', 730 * 36 * 0.4, '3 Years')]:
+                meter_id += 1
+                items.append({'currencyCode': 'USD', 'tierMinimumUnits': 0.0, 'retailPrice': round(price * factor, 4), 'unitPrice': round(price * factor, 4),
+                              'armRegionName': region, 'location': region, 'effectiveStartDate': '2024-01-01T00:00:00Z', 'meterId': f"{meter_id:08d}-0000-0000-0000-000000000000",
+                              'meterName': sku_name + sku_suffix, 'productId': 'DZH318Z0BQ4L', 'skuId': 'DZH318Z0BQ4L/00' + str(meter_id % 100), 'productName': product_name + product_suffix,
+                              'skuName': sku_name + sku_suffix, 'serviceName': 'Virtual Machines', 'serviceId': 'DZH313Z7MMC8', 'serviceFamily': 'Compute',
+                              'unitOfMeasure': '1 Hour', 'type': item_type, 'isPrimaryMeterRegion': True, 'armSkuName': size['name'],
+                              'reservationTerm': term, 'priceType': item_type})
+    return items, {f"benchregion{region_no}": sizes for region_no in range(regions)}
+
+# Writes a catalog and its VM sizes into a fixture directory
+def save_fixtures(fixture_dir, items, sizes):
+    os.makedirs(fixture_dir, exist_ok=True)
+    with open(os.path.join(fixture_dir, 'catalog.json'), 'w') as f:
+        json.dump(items, f)
+    with open(os.path.join(fixture_dir, 'vm_sizes.json'), 'w') as f:
+        json.dump(sizes, f)
+
+# Reads a catalog and its VM sizes from a fixture directory
+def load_fixtures(fixture_dir):
+    with open(os.path.join(fixture_dir, 'catalog.json')) as f:
+        items = json.load(f)
+    sizes = {}
+    if os.path.exists(os.path.join(fixture_dir, 'vm_sizes.json')):
+        with open(os.path.join(fixture_dir, 'vm_sizes.json')) as f:
+            sizes = json.load(f)
+    return items, sizes
+
+# Records the VM prices (and optionally the VM sizes) of some regions from the live APIs
+def record_fixtures(fixture_dir, regions, subscription_id=None):
+    import pricing
+    items = []
+    sizes = {}
+    for region in regions:
+        json_data = pricing.get_prices_json_from_api(query=f"armRegionName eq '{region}' and serviceName eq 'Virtual Machines'")
+        items += json_data.get('Items', [])
+        print("INFO: recorded {0} prices for region '{1}'".format(len(json_data.get('Items', [])), region))
+        if subscription_id:
+            from azure.identity import DefaultAzureCredential
+            from azure.mgmt.compute import ComputeManagementClient
+            compute_client = ComputeManagementClient(DefaultAzureCredential(), subscription_id)
+            sizes[region] = [{'name': size.name, 'number_of_cores': size.number_of_cores, 'memory_in_mb': size.memory_in_mb} for size in compute_client.virtual_machine_sizes.list(location=region)]
+            print("INFO: recorded {0} VM sizes for region '{1}'".format(len(sizes[region]), region))
+    save_fixtures(fixture_dir, items, sizes)
+
+##########################
+# Retail Prices stand-in #
+##########################
+
+# Compiles the subset of OData used by pricing.py ('eq', 'ne', 'ge', 'gt', 'le', 'lt', 'and', 'or' and parentheses)
+# into a predicate over catalog items. String comparisons are case-insensitive, like in the Retail Prices API
+def compile_filter(query):
+    tokens = re.findall(r"\(|\)|'(?:[^']|'')*'|[^\s()']+", query or '')
+    position = [0]
+    def peek():
+        return tokens[position[0]] if position[0] < len(tokens) else None
+    def take():
+        position[0] += 1
+        return tokens[position[0] - 1]
+    def parse_or():
+        predicates = [parse_and()]
+        while peek() == 'or':
+            take()
+            predicates.append(parse_and())
+        return predicates[0] if len(predicates) == 1 else (lambda item: any(p(item) for p in predicates))
+    def parse_and():
+        predicates = [parse_factor()]
+        while peek() == 'and':
+            take()
+            predicates.append(parse_factor())
+        return predicates[0] if len(predicates) == 1 else (lambda item: all(p(item) for p in predicates))
+    def parse_factor():
+        if peek() == '(':
+            take()
+            predicate = parse_or()
+            take()
+            return predicate
+        field, operator, value = take(), take(), take()
+        if value.startswith("'"):
+            value = value[1:-1].replace("''", "'")
+        value = value.lower()
+        compare = {'eq': lambda a, b: a == b, 'ne': lambda a, b: a != b, 'ge': lambda a, b: a >= b, 'gt': lambda a, b: a > b, 'le': lambda a, b: a <= b, 'lt': lambda a, b: a < b}[operator]
+        return lambda item: compare(str(item.get(field) or '').lower(), value)
+    if len(tokens) == 0:
+        return lambda item: True
+    return parse_or()
+
+# HTTP handler replaying the catalog with the pagination of the Retail Prices API
+# It is combined with http.server.BaseHTTPRequestHandler by start_stand_in_server, so that http.server is only imported then
+class RetailPricesStandInHandler:
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        url = urllib.parse.urlparse(self.path)
+        params = {key: values[0] for key, values in urllib.parse.parse_qs(url.query).items()}
+        query = params.get('$filter', '')
+        skip = int(params.get('$skip', 0))
+        with server.lock:
+            matching_items = server.filter_cache.get(query)
+        if matching_items is None:
+            predicate = compile_filter(query)
+            matching_items = [item for item in server.catalog if predicate(item)]
+            with server.lock:
+                server.filter_cache[query] = matching_items
+        page_items = matching_items[skip:skip + server.page_size]
+        next_page_link = None
+        if skip + server.page_size < len(matching_items):
+            next_page_link = "http://{0}:{1}/api/retail/prices?api-version={2}&currencyCode='USD'&$filter={3}&$skip={4}".format(server.server_address[0], server.server_address[1],
+                             params.get('api-version', ''), urllib.parse.quote(query), skip + server.page_size)
+        body = json.dumps({'BillingCurrency': 'USD', 'CustomerEntityId': 'Default', 'CustomerEntityType': 'Retail', 'Items': page_items, 'NextPageLink': next_page_link, 'Count': len(page_items)}).encode('utf-8')
+        if server.latency_ms > 0:
+            time.sleep(server.latency_ms / 1000)
+        with server.lock:
+            server.pages_served += 1
+            server.bytes_served += len(body)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *log_args):
+        pass
+
+# Starts the stand-in server on a free local port in a background thread
+def start_stand_in_server(catalog, page_size=1000, latency_ms=20):
+    import http.server
+    # Threaded HTTP server with a listen backlog large enough for the parallel page requests of pricing.py
+    # (the default backlog of 5 makes bursts of connections wait for SYN retransmissions)
+    class StandInHTTPServer(http.server.ThreadingHTTPServer):
+        request_queue_size = 128
+    class StandInHandler(RetailPricesStandInHandler, http.server.BaseHTTPRequestHandler):
+        pass
+    server = StandInHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    server.catalog = catalog
+    server.page_size = page_size
+    server.latency_ms = latency_ms
+    server.lock = threading.Lock()
+    server.filter_cache = {}
+    server.pages_served = 0
+    server.bytes_served = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+#############
+# Scenarios #
+#############
+
+# Installs fake azure.identity.aio and azure.mgmt.compute.aio modules whose virtual_machine_sizes.list() returns the fixture sizes
+def install_fake_compute(sizes):
+    class AsyncContextManager:
+        async def __aenter__(self):
+            return self
+        async def __aexit__(self, *exc_info):
+            await self.close()
+        async def close(self):
+            pass
+    class FakeCredential(AsyncContextManager):
+        def __init__(self, *args, **kwargs):
+            pass
+    class FakeVirtualMachineSizes:
+        def list(self, location):
+            async def list_sizes():
+                for size in sizes.get(location, []):
+                    yield types.SimpleNamespace(**size)
+            return list_sizes()
+    class FakeComputeManagementClient(AsyncContextManager):
+        def __init__(self, credential, subscription_id, **kwargs):
+            self.virtual_machine_sizes = FakeVirtualMachineSizes()
+    identity_module = types.ModuleType('azure.identity.aio')
+    identity_module.DefaultAzureCredential = FakeCredential
+    compute_module = types.ModuleType('azure.mgmt.compute.aio')
+    compute_module.ComputeManagementClient = FakeComputeManagementClient
+    sys.modules['azure.identity.aio'] = identity_module
+    sys.modules['azure.mgmt.compute.aio'] = compute_module
+
+# Returns a function running a scenario once, with the output of pricing.py captured (so formatting is measured too)
+def get_scenario(scenario, base_url, items, sizes):
+    import pricing
+    regions = sorted(set(item['armRegionName'] for item in items))
+    region = regions[0]
+    sku = next(item['armSkuName'] for item in items if item['armRegionName'] == region and item['type'] == 'Consumption')
+    if scenario == 'get-prices-json':
+        return lambda: pricing.get_prices_json(query=f"armRegionName eq '{region}' and serviceName eq 'Virtual Machines' and priceType eq 'Consumption'", base_url=base_url)
+    elif scenario == 'compare-regions':
+        return lambda: pricing.get_prices_sku_all_regions(sku, base_url=base_url, format="table")
+    elif scenario == 'get-price':
+        return lambda: pricing.get_prices_sku(region, sku, base_url=base_url, format="details")
+    elif scenario == 'get-skus':
+        install_fake_compute(sizes)
+        return lambda: pricing.print_vm_sizes(pricing.get_vm_sizes(','.join(sizes.keys()) or region, subscription_id='00000000-0000-0000-0000-000000000000', cores='2-64', base_url=base_url))
+    raise ValueError("unknown scenario '{0}'".format(scenario))
+
+# Runs a scenario repeat times (plus one run under tracemalloc) and prints its measurements as JSON
+def run_scenario(scenario, base_url, fixture_dir, concurrency=8, repeat=5):
+    import contextlib
+    import io
+    import resource
+    import tracemalloc
+    import pricing
+    items, sizes = load_fixtures(fixture_dir)
+    pricing.configure(no_cache=True, concurrency=concurrency)
+    run_once = get_scenario(scenario, base_url, items, sizes)
+    elapsed_ms = []
+    output_bytes = 0
+    for _ in range(max(repeat, 1)):
+        output = io.StringIO()
+        start_time = time.perf_counter()
+        with contextlib.redirect_stdout(output):
+            run_once()
+        elapsed_ms.append((time.perf_counter() - start_time) * 1000)
+        output_bytes = len(output.getvalue())
+    # Allocations are measured in a separate run, since tracemalloc slows everything down
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    with contextlib.redirect_stdout(io.StringIO()):
+        run_once()
+    after = tracemalloc.take_snapshot()
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    allocated_blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename') if stat.count_diff > 0)
+    print(json.dumps({'elapsed_ms': elapsed_ms, 'output_bytes': output_bytes, 'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      'traced_peak_bytes': traced_peak, 'allocated_blocks': allocated_blocks}))
+
+# Runs all scenarios against a stand-in server, each in a separate process, and prints a results table
+def run_benchmark(fixture_dir=None, scenarios=None, concurrency_values=None, repeat=5, latency_ms=20, page_size=1000, regions=4):
+    import statistics
+    import subprocess
+    temp_dir = None
+    if fixture_dir is None:
+        import tempfile
+        temp_dir = tempfile.TemporaryDirectory()
+        fixture_dir = temp_dir.name
+        items, sizes = generate_catalog(regions=regions)
+        save_fixtures(fixture_dir, items, sizes)
+    else:
+        items, sizes = load_fixtures(fixture_dir)
+    server = start_stand_in_server(items, page_size=page_size, latency_ms=latency_ms)
+    base_url = "http://{0}:{1}/api/retail/prices".format(server.server_address[0], server.server_address[1])
+    print("INFO: serving {0} prices and {1} VM sizes with {2} items per page and {3} ms latency per page".format(len(items), sum(len(s) for s in sizes.values()), page_size, latency_ms))
+    print(f"{'Scenario':<18} {'Concurrency':>11} {'Median (ms)':>12} {'Min (ms)':>10} {'Pages/run':>10} {'Pages/sec':>10} {'Peak RSS (MB)':>14} {'Traced peak (MB)':>17} {'Alloc blocks':>13} {'Output (KB)':>12}")
+    print("-" * 136)
+    for scenario in scenarios:
+        for concurrency in concurrency_values:
+            with server.lock:
+                pages_before = server.pages_served
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), 'run-scenario', '--scenario', scenario, '--base-url', base_url, '--fixture-dir', fixture_dir,
+                                     '--concurrency', str(concurrency), '--repeat', str(repeat)], capture_output=True, text=True)
+            if output.returncode != 0:
+                print("ERROR: scenario '{0}' failed: {1}".format(scenario, output.stderr.strip().splitlines()[-1] if output.stderr.strip() else output.returncode))
+                continue
+            result = json.loads(output.stdout.strip().splitlines()[-1])
+            with server.lock:
+                pages_per_run = (server.pages_served - pages_before) / (max(repeat, 1) + 1)
+            median_ms = statistics.median(result['elapsed_ms'])
+            print(f"{scenario:<18} {concurrency:>11} {median_ms:>12.1f} {min(result['elapsed_ms']):>10.1f} {pages_per_run:>10.1f} {pages_per_run / (median_ms / 1000):>10.1f} "
+                  f"{result['peak_rss_kb'] / 1024:>14.1f} {result['traced_peak_bytes'] / 1048576:>17.1f} {result['allocated_blocks']:>13} {result['output_bytes'] / 1024:>12.1f}")
+    server.shutdown()
+    if temp_dir is not None:
+        temp_dir.cleanup()
+
+#####################
+# Startup benchmark #
+#####################
+
+# Cold-start benchmark: for each command, a new Python process runs pricing.main() with the command (see run_startup_command),
+# against the stand-in server and with fake Azure credentials and Compute client, so that the lazy imports of each command
+# path are exercised. serve is measured until it accepts connections. The module load time does not include the standard
+# modules that this module imports too (argparse, json, re...), the cold-start time of the whole process does.
+startup_commands = ['compare-regions', 'get-price', 'get-skus', 'optimize', 'batch', 'sync', 'history', 'serve']
+startup_heavy_modules = ['requests', 'numpy', 'azure', 'asyncio', 'http.server']
+# Heavy modules each command is expected to import, and cold-start budget of the commands loading numpy and the Azure SDK
+startup_expected_modules = {'compare-regions': ['requests'], 'get-price': ['requests'], 'get-skus': ['requests', 'numpy', 'azure', 'asyncio'],
+                            'optimize': ['requests', 'numpy', 'azure', 'asyncio'], 'batch': ['requests'], 'sync': ['requests'], 'history': [], 'serve': ['http.server']}
+startup_budgets_ms = {'get-skus': 1000, 'optimize': 1000}
+
+# Creates fake azure.identity.aio and azure.mgmt.compute.aio modules when they are imported, whose Compute client returns
+# the VM sizes of the fixtures. The packages containing them are imported for real, so their import time is measured.
+class FakeAzureFinder(importlib.abc.MetaPathFinder, importlib.abc.Loader):
+    def __init__(self, fixture_dir):
+        self.fixture_dir = fixture_dir
+
+    def find_spec(self, name, path, target=None):
+        return importlib.util.spec_from_loader(name, self) if name in ('azure.identity.aio', 'azure.mgmt.compute.aio') else None
+
+    def create_module(self, spec):
+        return None
+
+    def exec_module(self, module):
+        fixture_dir = self.fixture_dir
+        class FakeClient:
+            def __init__(self, *args, **kwargs):
+                self.virtual_machine_sizes = self
+            async def __aenter__(self):
+                return self
+            async def __aexit__(self, *exc_info):
+                pass
+            async def close(self):
+                pass
+            async def list_sizes(self, location):
+                with open(os.path.join(fixture_dir, 'vm_sizes.json')) as f:
+                    for size in json.load(f).get(location, []):
+                        yield types.SimpleNamespace(**size)
+            def list(self, location):
+                return self.list_sizes(location)
+        module.DefaultAzureCredential = FakeClient
+        module.ComputeManagementClient = FakeClient
+
+# Runs a pricing.py command (its arguments start with the command name) and prints its module load and run times, the
+# ERROR lines of its output and the modules that were imported as JSON. The process exits as soon as the command is done.
+def run_startup_command(base_url, fixture_dir, pricing_args):
+    import io
+    import socket
+    start_time = time.perf_counter()
+    sys.meta_path.insert(0, FakeAzureFinder(fixture_dir))
+    import pricing
+    loaded_time = time.perf_counter()
+    pricing.base_url = base_url
+    stdout = sys.stdout
+    sys.stdout = output = io.StringIO()
+    if pricing_args[0] == 'serve':
+        threading.Thread(target=pricing.main, args=(pricing_args,), daemon=True).start()
+        port = int(pricing_args[pricing_args.index('--port') + 1])
+        while time.perf_counter() - start_time < 30:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.001)
+    else:
+        pricing.main(pricing_args)
+    sys.stdout = stdout
+    errors = [line for line in output.getvalue().splitlines() if line.startswith('ERROR')]
+    print(json.dumps({'elapsed_ms': (time.perf_counter() - start_time) * 1000, 'load_ms': (loaded_time - start_time) * 1000, 'errors': errors,
+                      'modules': sorted(set(module.split('.')[0] if module.startswith('azure') else module for module in sys.modules))}))
+    sys.stdout.flush()
+    os._exit(0)
+
+# Runs each pricing.py command runs times, each in a new process, and prints the median cold-start time (whole process),
+# module load time and command time per command, and the heavy modules that were imported. Returns False if the median
+# cold-start time of a command exceeds its budget (budget_ms for all commands if set), if it imports a heavy module that
+# it does not need, or if it fails.
+def run_startup_benchmark(budget_ms=None, runs=5):
+    import socket
+    import statistics
+    import subprocess
+    import tempfile
+    # A small catalog of one region served without latency, so that the benchmark measures pricing.py and not the network
+    items, sizes = generate_catalog(regions=1)
+    region = next(iter(sizes))
+    sizes = {region: [size for size in sizes[region] if size['number_of_cores'] <= 16][:64]}
+    size_names = set(size['name'] for size in sizes[region])
+    items = [item for item in items if item['armSkuName'] in size_names]
+    sku = sizes[region][0]['name']
+    server = start_stand_in_server(items, page_size=1000, latency_ms=0)
+    base_url = "http://{0}:{1}/api/retail/prices".format(server.server_address[0], server.server_address[1])
+    within_budget = True
+    with tempfile.TemporaryDirectory() as temp_dir:
+        save_fixtures(temp_dir, items, sizes)
+        batch_file = os.path.join(temp_dir, 'batch.jsonl')
+        with open(batch_file, 'w') as f:
+            f.write(''.join(json.dumps({'region': region, 'sku': size['name']}) + '\n' for size in sizes[region][:8]))
+        history_file = os.path.join(temp_dir, 'history.sqlite')
+        subscription_id = '00000000-0000-0000-0000-000000000000'
+        command_args = {
+            'compare-regions': ['--sku', sku],
+            'get-price': ['--region', region, '--sku', sku],
+            'get-skus': ['--region', region, '--subscription-id', subscription_id, '--cores', '2-8'],
+            'optimize': ['--region', region, '--subscription-id', subscription_id, '--cores', '64', '--memory', '256'],
+            'batch': ['--input', batch_file],
+            'sync': ['--snapshot-file', os.path.join(temp_dir, 'snapshot'), '--history-file', history_file],
+            'history': ['--sku', sku, '--history-file', history_file],
+            'serve': ['--host', '127.0.0.1'],
+        }
+        print("INFO: running the commands against a stand-in of the Retail Prices API with {0} prices and {1} VM sizes".format(len(items), len(sizes[region])))
+        print(f"{'Command':<20} {'Cold start (ms)':>16} {'Module load (ms)':>17} {'Command (ms)':>13} {'Budget (ms)':>12}   {'Heavy modules imported':<40}")
+        print("-" * 120)
+        for command in startup_commands:
+            command_budget_ms = budget_ms or startup_budgets_ms.get(command, 300)
+            import_times = []
+            command_times = []
+            process_times = []
+            problems = []
+            for _ in range(max(runs, 1)):
+                pricing_args = [command] + command_args[command] + ['--no-cache', '--cache-file', os.path.join(temp_dir, 'cache.sqlite')]
+                if command == 'serve':
+                    with socket.socket() as free_socket:
+                        free_socket.bind(('127.0.0.1', 0))
+                        pricing_args += ['--port', str(free_socket.getsockname()[1])]
+                start_time = time.perf_counter()
+                process = subprocess.run([sys.executable, os.path.abspath(__file__), 'startup-command', '--base-url', base_url, '--fixture-dir', temp_dir] + pricing_args,
+                                         capture_output=True, text=True)
+                process_times.append((time.perf_counter() - start_time) * 1000)
+                if process.returncode != 0 or not process.stdout.strip():
+                    problems = ['failed: ' + (process.stderr.strip().splitlines() or ['exit code ' + str(process.returncode)])[-1]]
+                    break
+                result = json.loads(process.stdout.strip().splitlines()[-1])
+                import_times.append(result['load_ms'])
+                command_times.append(result['elapsed_ms'] - result['load_ms'])
+                problems = ['failed: ' + error for error in result['errors'][:1]]
+            if len(import_times) == 0:
+                within_budget = False
+                print(f"{command:<20} {problems[0]}")
+                continue
+            heavy_modules = [module for module in startup_heavy_modules if module in result['modules']]
+            unexpected_modules = [module for module in heavy_modules if module not in startup_expected_modules[command]]
+            if len(unexpected_modules) > 0:
+                problems.append('UNEXPECTED ' + ', '.join(unexpected_modules))
+            median_ms = statistics.median(process_times)
+            if median_ms > command_budget_ms:
+                problems.append('OVER BUDGET')
+            if len(problems) > 0:
+                within_budget = False
+            print(f"{command:<20} {median_ms:>16.1f} {statistics.median(import_times):>17.1f} {statistics.median(command_times):>13.1f} {command_budget_ms:>12}   {', '.join(heavy_modules) or '-':<40}"
+                  f"{'  ' + '; '.join(problems) if problems else ''}")
+    server.shutdown()
+    return within_budget
+
+################
+# Main program #
+################
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.command == 'run':
+        run_benchmark(fixture_dir=args.fixture_dir, scenarios=[s.strip() for s in args.scenarios.split(',') if s.strip()], concurrency_values=[int(c) for c in args.concurrency.split(',')],
+                      repeat=args.repeat, latency_ms=args.latency_ms, page_size=args.page_size, regions=args.regions)
+    elif args.command == 'record':
+        record_fixtures(args.fixture_dir, [r.strip() for r in args.regions.split(',') if r.strip()], subscription_id=args.subscription_id)
+    elif args.command == 'run-scenario':
+        run_scenario(args.scenario, args.base_url, args.fixture_dir, concurrency=args.concurrency, repeat=args.repeat)
+    elif args.command == 'startup':
+        if not run_startup_benchmark(budget_ms=args.budget_ms, runs=args.runs):
+            sys.exit(1)
+    elif args.command == 'startup-command':
+        run_startup_command(args.base_url, args.fixture_dir, args.pricing_args)
+    else:
+        parser.print_help()